@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+
+import pyglet.media
+
+import obj_3D_loading
+from Textures import load_texture_data, upload_texture
+
+def load_model(file_location, file_name, lods=False):
+	return obj_3D_loading.load_obj_file(file_location, file_name, upload=False, lods=lods)
+
+def load_sound(path_string):
+	return pyglet.media.load(path_string, streaming=False)
+
+def upload_model(mesh_model):
+	mesh_model.set_opengl_buffers()
+	return mesh_model
+
+def run_timed(load, args):
+	start = time.perf_counter()
+	result = load(*args)
+	return result, time.perf_counter() - start
+
+# Decodes and parses assets on a pool of worker threads. Anything touching
+# OpenGL is passed in as an upload function which finish() calls on the
+# thread that owns the context as each asset becomes ready
+class AssetLoader:
+	def __init__(self, max_workers=4):
+		self.executor = ThreadPoolExecutor(max_workers=max_workers)
+		self.jobs = dict()
+		self.assets = dict()
+		self.timings = dict()
+		self.start_time = time.perf_counter()
+
+	def add(self, name, load, args, upload=None):
+		future = self.executor.submit(run_timed, load, args)
+		self.jobs[future] = (name, upload)
+
+	def add_texture(self, name, path_string, compress=False):
+		self.add(name, load_texture_data, (path_string,), lambda levels: upload_texture(levels, compress))
+
+	def add_model(self, name, file_location, file_name, lods=False):
+		self.add(name, load_model, (file_location, file_name, lods), upload_model)
+
+	def add_sound(self, name, path_string):
+		self.add(name, load_sound, (path_string,))
+
+	# If a load or upload raises, the loads that haven't started are
+	# cancelled and the workers are still shut down before it is passed on
+	def finish(self):
+		try:
+			for future in as_completed(self.jobs):
+				name, upload = self.jobs[future]
+				asset, load_time = future.result()
+
+				upload_start = time.perf_counter()
+				if upload != None:
+					asset = upload(asset)
+				upload_end = time.perf_counter()
+
+				self.assets[name] = asset
+				self.timings[name] = (load_time, upload_end - upload_start, upload_end - self.start_time)
+		finally:
+			self.jobs = dict()
+			self.executor.shutdown(cancel_futures=True)
+		return self.assets
+
+	def print_timings(self):
+		for name, (load_time, upload_time, ready_time) in sorted(self.timings.items(), key=lambda item: item[1][2]):
+			print(f"{name:<20} load {load_time * 1000:7.1f} ms  upload {upload_time * 1000:6.1f} ms  ready at {ready_time * 1000:7.1f} ms")
+		print(f"Assets loaded in {(time.perf_counter() - self.start_time) * 1000:.1f} ms")
@@ -4,8 +4,11 @@ from math import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
+import ctypes
 import numpy
 
+INSTANCE_FLOATS = 20 # Model matrix, health fraction and colour
+
 class Color:
 	def __init__(self, r, g, b):
 		self.r = r
@@ -13,6 +16,8 @@ class Color:
 		self.b = b
 
 class Point:
+	__slots__ = ("x", "y", "z")
+
 	def __init__(self, x, y, z):
 		self.x = x
 		self.y = y
@@ -24,7 +29,32 @@ class Point:
 	def __sub__(self, other):
 		return Vector(self.x - other.x, self.y - other.y, self.z - other.z)
 
+	def __iadd__(self, other):
+		self.x += other.x
+		self.y += other.y
+		self.z += other.z
+		return self
+
+	def __isub__(self, other):
+		self.x -= other.x
+		self.y -= other.y
+		self.z -= other.z
+		return self
+
+	def __str__(self):
+		return "(%f, %f, %f)" % (self.x, self.y, self.z)
+
+	def add_scaled(self, other, scalar):
+		self.x += other.x * scalar
+		self.y += other.y * scalar
+		self.z += other.z * scalar
+
+	def copy(self):
+		return Point(self.x, self.y, self.z)
+
 class Vector:
+	__slots__ = ("x", "y", "z")
+
 	def __init__(self, x, y, z):
 		self.x = x
 		self.y = y
@@ -38,6 +68,24 @@ class Vector:
 
 	def __mul__(self, scalar):
 		return Vector(self.x * scalar, self.y * scalar, self.z * scalar)
+
+	def __iadd__(self, other):
+		self.x += other.x
+		self.y += other.y
+		self.z += other.z
+		return self
+
+	def __isub__(self, other):
+		self.x -= other.x
+		self.y -= other.y
+		self.z -= other.z
+		return self
+
+	def __imul__(self, scalar):
+		self.x *= scalar
+		self.y *= scalar
+		self.z *= scalar
+		return self
 	
 	def __len__(self):
 		return sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
@@ -45,6 +93,14 @@ class Vector:
 	def __str__(self):
 		return "(%f, %f, %f)" % (self.x, self.y, self.z)
 
+	def add_scaled(self, other, scalar):
+		self.x += other.x * scalar
+		self.y += other.y * scalar
+		self.z += other.z * scalar
+
+	def copy(self):
+		return Vector(self.x, self.y, self.z)
+
 	def normalize(self):
 		length = self.__len__()
 		self.x /= length
@@ -57,6 +113,104 @@ class Vector:
 	def cross(self, other):
 		return Vector(self.y*other.z - self.z*other.y, self.z*other.x - self.x*other.z, self.x*other.y - self.y*other.x)
 
+# Batched version of Vector, holding N vectors as the rows of an (N, 3)
+# array so the same operations can be done on all of them at once. Made
+# from an existing float array it works on that array in place, so the
+# arrays of EnemyBatch and BulletSystem can be wrapped without copying
+class Vec3Array:
+	def __init__(self, count=0, data=None, dtype=numpy.float64):
+		if data is None:
+			self.data = numpy.zeros((count, 3), dtype=dtype)
+		else:
+			self.data = numpy.asarray(data, dtype=dtype).reshape(-1, 3)
+
+	@classmethod
+	def from_vectors(cls, vectors, dtype=numpy.float64):
+		array = cls(len(vectors), dtype=dtype)
+		for i, vec in enumerate(vectors):
+			array[i] = vec
+		return array
+
+	@property
+	def x(self):
+		return self.data[:, 0]
+
+	@property
+	def y(self):
+		return self.data[:, 1]
+
+	@property
+	def z(self):
+		return self.data[:, 2]
+
+	def __len__(self):
+		return self.data.shape[0]
+
+	# A single index gives a Vector, anything else the selected vectors
+	def __getitem__(self, index):
+		if isinstance(index, (int, numpy.integer)):
+			return Vector(float(self.data[index, 0]), float(self.data[index, 1]), float(self.data[index, 2]))
+		return Vec3Array(data=self.data[index], dtype=self.data.dtype)
+
+	def __setitem__(self, index, vec):
+		self.data[index] = self.other_data(vec)
+
+	def __add__(self, other):
+		return Vec3Array(data=self.data + self.other_data(other), dtype=self.data.dtype)
+
+	def __sub__(self, other):
+		return Vec3Array(data=self.data - self.other_data(other), dtype=self.data.dtype)
+
+	def __mul__(self, scalar):
+		return Vec3Array(data=self.data * self.scalar_data(scalar), dtype=self.data.dtype)
+
+	def __iadd__(self, other):
+		self.data += self.other_data(other)
+		return self
+
+	def __isub__(self, other):
+		self.data -= self.other_data(other)
+		return self
+
+	def __imul__(self, scalar):
+		self.data *= self.scalar_data(scalar)
+		return self
+
+	# Other operand can be another array of N vectors, or a single
+	# Point/Vector that is broadcast over all of them
+	def other_data(self, other):
+		if isinstance(other, Vec3Array):
+			return other.data
+		if isinstance(other, numpy.ndarray):
+			return other
+		return numpy.array([other.x, other.y, other.z], dtype=self.data.dtype)
+
+	# Scalars can be one number or one per vector
+	def scalar_data(self, scalar):
+		scalar = numpy.asarray(scalar)
+		if scalar.ndim == 1:
+			return scalar[:, None]
+		return scalar
+
+	def add_scaled(self, other, scalar):
+		self.data += self.other_data(other) * self.scalar_data(scalar)
+
+	def copy(self):
+		return Vec3Array(data=self.data.copy(), dtype=self.data.dtype)
+
+	def lengths(self):
+		return numpy.sqrt(numpy.einsum("ij,ij->i", self.data, self.data))
+
+	def normalize(self):
+		lengths = self.lengths()[:, None]
+		numpy.divide(self.data, lengths, out=self.data, where=lengths > 0.0)
+
+	def dot(self, other):
+		return numpy.einsum("ij,ij->i", self.data, numpy.broadcast_to(self.other_data(other), self.data.shape))
+
+	def cross(self, other):
+		return Vec3Array(data=numpy.cross(self.data, self.other_data(other)), dtype=self.data.dtype)
+
 class Cube:
 	def __init__(self, length = 1):
 		self.position_array = [
@@ -165,19 +319,50 @@ class Cube:
 			0.0, self.uv_ly,
 			self.uv_lx, self.uv_ly,
 		]
+
+		self.vertex_buffer_id = None
+		self.vertex_array_id = None
+		self.vertex_count = 36
+		self.instance_buffer = InstanceBuffer()
+
+	# The geometry is uploaded the first time the cube is used, after that
+	# setting the vertices is only a vertex array bind
+	def set_opengl_buffers(self, shader):
+		positions, normals, uvs = self.get_triangle_arrays()
+		self.vertex_buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer_id)
+		glBufferData(GL_ARRAY_BUFFER, numpy.hstack((positions, normals, uvs)), GL_STATIC_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+		self.instance_buffer.set_opengl_buffers()
+		self.vertex_array_id = shader.create_vertex_array(self.vertex_buffer_id, instance_buffer_id=self.instance_buffer.buffer_id)
 	
 	def set_vertices(self, shader):
-		shader.set_position_attribute(self.position_array)
-		shader.set_normal_attribute(self.normal_array)
-		shader.set_uv_attribute(self.uv_array)
+		if self.vertex_array_id == None:
+			self.set_opengl_buffers(shader)
+		shader.set_vertex_array(self.vertex_array_id)
+
+	# Splits each of the six triangle fans into two triangles so the cube
+	# can be batched with other geometry using GL_TRIANGLES
+	def get_triangle_arrays(self):
+		face_indices = numpy.array([0, 1, 2, 0, 2, 3])
+		indices = (numpy.arange(0, 24, 4)[:, None] + face_indices).reshape(-1)
+		positions = numpy.array(self.position_array, dtype='float32').reshape(-1, 3)[indices]
+		normals = numpy.array(self.normal_array, dtype='float32').reshape(-1, 3)[indices]
+		uvs = numpy.array(self.uv_array, dtype='float32').reshape(-1, 2)[indices]
+		return positions, normals, uvs
 
 	def draw(self):
-		glDrawArrays(GL_TRIANGLE_FAN, 0, 4)
-		glDrawArrays(GL_TRIANGLE_FAN, 4, 4)
-		glDrawArrays(GL_TRIANGLE_FAN, 8, 4)
-		glDrawArrays(GL_TRIANGLE_FAN, 12, 4)
-		glDrawArrays(GL_TRIANGLE_FAN, 16, 4)
-		glDrawArrays(GL_TRIANGLE_FAN, 20, 4)
+		glDrawArrays(GL_TRIANGLES, 0, self.vertex_count)
+
+	def draw_instanced(self, shader, transforms, health=None, colors=None):
+		if len(transforms) == 0:
+			return
+		
+		self.set_vertices(shader)
+		self.instance_buffer.upload(transforms, health, colors)
+		shader.set_use_instancing(True)
+		glDrawArraysInstanced(GL_TRIANGLES, 0, self.vertex_count, len(transforms))
+		shader.set_use_instancing(False)
 
 class Sphere:
 	def __init__(self, stacks=12, slices=24):
@@ -202,30 +387,57 @@ class Sphere:
 				self.vertex_array.append(sin(stack_angle + stack_interval) * sin(slice_angle))
 
 				self.vertex_count += 2
+
+		self.vertex_buffer_id = None
+		self.vertex_array_id = None
+
+	def set_opengl_buffers(self, shader):
+		self.vertex_buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer_id)
+		glBufferData(GL_ARRAY_BUFFER, numpy.array(self.vertex_array, dtype='float32'), GL_STATIC_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+		# Positions on a unit sphere are also its normals
+		self.vertex_array_id = shader.create_vertex_array(self.vertex_buffer_id, stride=3, normal_offset=0, uv_offset=None)
 		
 	def set_vertices(self, shader):
-		shader.set_position_attribute(self.vertex_array)
-		shader.set_normal_attribute(self.vertex_array)
+		if self.vertex_array_id == None:
+			self.set_opengl_buffers(shader)
+		shader.set_vertex_array(self.vertex_array_id)
 	
 	def draw(self):
 		for i in range(0, self.vertex_count, (self.slices + 1) * 2):
 			glDrawArrays(GL_TRIANGLE_STRIP, i, (self.slices + 1) * 2)
 
-class Bullet:
-	def __init__(self, position, rotation, velocity, damage):
-		self.position = position
-		self.rotation = rotation
-		self.x = position.x
-		self.y = position.y
-		self.z = position.z
-		self.velocity = velocity
-		self.damage = damage
-		self.speed = 50
-	
-	def move(self, delta_time):
-		self.position += self.velocity * self.speed * delta_time
-		self.x += self.velocity.x * self.speed * delta_time
-		self.z += self.velocity.z * self.speed * delta_time
+# Per instance data for instanced draws. Each row holds a model matrix,
+# stored column by column as the shader reads it, and a health fraction
+class InstanceBuffer:
+	def __init__(self):
+		self.buffer_id = None
+		self.data = numpy.zeros((16, INSTANCE_FLOATS), dtype='float32')
+		self.data[:, 0:16] = numpy.identity(4, dtype='float32').reshape(16)
+		self.data[:, 16:20] = 1.0
+
+	def set_opengl_buffers(self):
+		# Starts out holding a single identity instance so the attributes
+		# always read valid data, even in non-instanced draws
+		self.buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, self.buffer_id)
+		glBufferData(GL_ARRAY_BUFFER, self.data[:1], GL_STREAM_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+	def upload(self, transforms, health=None, colors=None):
+		count = len(transforms)
+		if count > len(self.data):
+			self.data = numpy.zeros((max(count, len(self.data) * 2), INSTANCE_FLOATS), dtype='float32')
+
+		self.data[:count, 0:16] = numpy.transpose(transforms, (0, 2, 1)).reshape(count, 16)
+		self.data[:count, 16] = 1.0 if health is None else health
+		self.data[:count, 17:20] = 1.0 if colors is None else colors
+
+		glBindBuffer(GL_ARRAY_BUFFER, self.buffer_id)
+		glBufferData(GL_ARRAY_BUFFER, self.data[:count], GL_STREAM_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
 
 class Material:
 	def __init__(self, diffuse = None, specular = None, shininess = None):
@@ -233,21 +445,50 @@ class Material:
 		self.specular = Color(0.0, 0.0, 0.0) if specular == None else specular
 		self.shininess = 1 if shininess == None else shininess
 
+# A model made of several meshes (one per material) that share one indexed
+# vertex buffer. Vertices are interleaved position, normal and uv and each
+# mesh is a range of the index buffer
 class MeshModel:
 	def __init__(self):
-		self.vertex_arrays = dict()
-		# self.index_arrays = dict()
+		self.vertex_array = numpy.zeros((0, 8), dtype='float32')
+		self.index_array = numpy.zeros(0, dtype='uint32')
 		self.mesh_materials = dict()
 		self.materials = dict()
-		self.vertex_counts = dict()
-		self.vertex_buffer_ids = dict()
-
-	def add_vertex(self, mesh_id, position, normal, uv = None):
-		if mesh_id not in self.vertex_arrays:
-			self.vertex_arrays[mesh_id] = []
-			self.vertex_counts[mesh_id] = 0
-		self.vertex_arrays[mesh_id] += [position.x, position.y, position.z, normal.x, normal.y, normal.z]
-		self.vertex_counts[mesh_id] += 1
+		self.index_offsets = dict()
+		self.index_counts = dict()
+		# Index ranges of every level of detail, level 0 is the full model
+		self.lod_index_offsets = [self.index_offsets]
+		self.lod_index_counts = [self.index_counts]
+		self.vertex_buffer_id = None
+		self.index_buffer_id = None
+		self.vertex_array_id = None
+		self.instance_buffer = InstanceBuffer()
+		self.set_bounds()
+
+	def set_mesh_data(self, vertex_array, index_array):
+		self.vertex_array = vertex_array
+		self.index_array = index_array
+		self.set_bounds()
+
+	# Box and sphere around the vertex positions in model space, for culling
+	def set_bounds(self):
+		positions = numpy.asarray(self.vertex_array)[:, 0:3]
+		if len(positions) == 0:
+			positions = numpy.zeros((1, 3))
+		self.bounds_min = positions.min(axis=0)
+		self.bounds_max = positions.max(axis=0)
+		self.bounding_center = (self.bounds_min + self.bounds_max) / 2
+		self.bounding_radius = float(numpy.sqrt(((positions - self.bounding_center) ** 2).sum(axis=1).max()))
+
+	def add_mesh(self, mesh_id, index_offset, index_count, level=0):
+		while len(self.lod_index_offsets) <= level:
+			self.lod_index_offsets.append(dict())
+			self.lod_index_counts.append(dict())
+		self.lod_index_offsets[level][mesh_id] = index_offset
+		self.lod_index_counts[level][mesh_id] = index_count
+
+	def get_lod_count(self):
+		return len(self.lod_index_offsets)
 
 	def set_mesh_material(self, mesh_id, mat_id):
 		self.mesh_materials[mesh_id] = mat_id
@@ -256,18 +497,56 @@ class MeshModel:
 		self.materials[mat_id] = mat
 
 	def set_opengl_buffers(self):
+		self.vertex_buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer_id)
+		glBufferData(GL_ARRAY_BUFFER, numpy.asarray(self.vertex_array, dtype='float32'), GL_STATIC_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+		self.index_buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer_id)
+		glBufferData(GL_ELEMENT_ARRAY_BUFFER, numpy.asarray(self.index_array, dtype='uint32'), GL_STATIC_DRAW)
+		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+	def set_vertex_arrays(self, shader):
+		self.instance_buffer.set_opengl_buffers()
+		self.vertex_array_id = shader.create_vertex_array(self.vertex_buffer_id, instance_buffer_id=self.instance_buffer.buffer_id, index_buffer_id=self.index_buffer_id)
+
+	def set_material(self, shader, mesh_id):
+		material = self.materials[self.mesh_materials[mesh_id]]
+		shader.set_material_diffuse_color(material.diffuse)
+		shader.set_material_specular_color(material.specular)
+		shader.set_material_shininess(material.shininess)
+
+	def draw(self, shader, level=0):
+		if self.vertex_array_id == None:
+			self.set_vertex_arrays(shader)
+
+		index_offsets = self.lod_index_offsets[min(level, len(self.lod_index_offsets) - 1)]
+		index_counts = self.lod_index_counts[min(level, len(self.lod_index_counts) - 1)]
+		shader.set_vertex_array(self.vertex_array_id)
+		for mesh_id in self.mesh_materials.keys():
+			self.set_material(shader, mesh_id)
+			glDrawElements(GL_TRIANGLES, index_counts[mesh_id], GL_UNSIGNED_INT, ctypes.c_void_p(index_offsets[mesh_id] * 4))
+		shader.set_vertex_array(0)
+
+	# Draws the model once for every (row major) matrix in transforms,
+	# using one draw call per mesh no matter how many instances there are
+	def draw_instanced(self, shader, transforms, health=None, level=0):
+		if len(transforms) == 0:
+			return
+		
+		if self.vertex_array_id == None:
+			self.set_vertex_arrays(shader)
+		
+		index_offsets = self.lod_index_offsets[min(level, len(self.lod_index_offsets) - 1)]
+		index_counts = self.lod_index_counts[min(level, len(self.lod_index_counts) - 1)]
+		self.instance_buffer.upload(transforms, health)
+		shader.set_use_instancing(True)
+		shader.set_vertex_array(self.vertex_array_id)
+
 		for mesh_id in self.mesh_materials.keys():
-			self.vertex_buffer_ids[mesh_id] = glGenBuffers(1)
-			glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer_ids[mesh_id])
-			glBufferData(GL_ARRAY_BUFFER, numpy.array(self.vertex_arrays[mesh_id], dtype='float32'), GL_STATIC_DRAW)
-			glBindBuffer(GL_ARRAY_BUFFER, 0)
-
-	def draw(self, shader):
-		for mesh_id, mesh_material in self.mesh_materials.items():
-			material = self.materials[mesh_material]
-			shader.set_material_diffuse_color(material.diffuse)
-			shader.set_material_specular_color(material.specular)
-			shader.set_material_shininess(material.shininess)
-			shader.set_attribute_buffers(self.vertex_buffer_ids[mesh_id])
-			glDrawArrays(GL_TRIANGLES, 0, self.vertex_counts[mesh_id])
-			glBindBuffer(GL_ARRAY_BUFFER, 0)
\ No newline at end of file
+			self.set_material(shader, mesh_id)
+			glDrawElementsInstanced(GL_TRIANGLES, index_counts[mesh_id], GL_UNSIGNED_INT, ctypes.c_void_p(index_offsets[mesh_id] * 4), len(transforms))
+		
+		shader.set_vertex_array(0)
+		shader.set_use_instancing(False)
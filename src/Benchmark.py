@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+
+import numpy
+
+# Scripted, fixed timestep runs of the game that report how long each phase
+# of a tick takes. Simulation only by default, --render also draws every
+# tick (--offscreen for a software GL context without a window):
+#   python Benchmark.py --render --offscreen --output bench.json
+#
+# Phases nest, Maze.collide_batch is called from update_enemies,
+# update_bullets and the player movement so its time is part of those as well
+#
+# The game's modules are imported where they are used, since PyOpenGL picks
+# its platform when it is first imported and --offscreen has to set it before
+
+PERCENTILES = [50, 90, 99]
+MAZE_SIZES = [10, 100, 1000]
+# Whole levels (walls, collision tables, geometry and visible sets) take
+# far longer to build than the layout alone, so they get their own sizes
+MAZE_BUILD_SIZES = [10, 50, 100, 200]
+
+class PhaseTimer:
+	def __init__(self):
+		self.samples = dict()
+		self.calls = dict()
+		self.current = dict()
+
+	# Returns func wrapped so its time is added to the phase on every call
+	def wrap(self, phase, func):
+		self.samples[phase] = []
+		self.calls[phase] = 0
+		self.current[phase] = 0.0
+
+		def timed(*args, **kwargs):
+			start = time.perf_counter()
+			result = func(*args, **kwargs)
+			self.current[phase] += time.perf_counter() - start
+			self.calls[phase] += 1
+			return result
+		return timed
+
+	def end_tick(self):
+		for phase, duration in self.current.items():
+			self.samples[phase].append(duration)
+			self.current[phase] = 0.0
+
+	def get_report(self):
+		report = dict()
+		for phase, samples in self.samples.items():
+			samples = numpy.array(samples) * 1000
+			report[phase] = {"mean_ms": float(samples.mean()), "max_ms": float(samples.max()), "calls": self.calls[phase]}
+			for percentile, value in zip(PERCENTILES, numpy.percentile(samples, PERCENTILES)):
+				report[phase][f"p{percentile}_ms"] = float(value)
+		return report
+
+# Input tracks, each one gives the input for a tick
+def patrol_input(tick):
+	from Simulation import PlayerInput
+	return PlayerInput(forward=tick % 240 < 180, right=tick % 240 >= 180, shooting=tick % 90 < 45, mouse_x=30 if tick % 120 < 15 else 0)
+
+def strafe_input(tick):
+	from Simulation import PlayerInput
+	return PlayerInput(left=True, shooting=True, mouse_x=8)
+
+def turret_input(tick):
+	from Simulation import PlayerInput
+	return PlayerInput(shooting=True, mouse_x=10)
+
+# Scenario setup, run once the game has been created
+def setup_boss(game):
+	game.generate_boss_maze()
+
+def setup_sustained_fire(game):
+	game.fire_rate = 60
+
+def setup_max_enemies(game):
+	game.num_enemies = 96 # Every cell enemies are allowed to spawn in
+	game.generate_maze()
+
+# Keeps the magazine full so the gun never stops to reload
+def refill_magazine(game, tick):
+	game.shots_fired = 0
+
+SCENARIOS = {
+	"normal": (None, patrol_input, None),
+	"boss": (setup_boss, strafe_input, None),
+	"sustained_fire": (setup_sustained_fire, turret_input, refill_magazine),
+	"max_enemies": (setup_max_enemies, patrol_input, None)
+}
+
+def create_game(render, width, height, maze_seed):
+	if render:
+		from main import GraphicsProgram3D
+		return GraphicsProgram3D(width, height, audio=False, maze_seed=maze_seed)
+	from Simulation import Simulation
+	return Simulation(maze_seed)
+
+def run_scenario(name, ticks, delta_time, seed, render, width, height):
+	from Maze import Maze
+	setup, input_track, tick_hook = SCENARIOS[name]
+
+	random.seed(seed)
+	game = create_game(render, width, height, seed)
+	if setup != None:
+		setup(game)
+
+	timer = PhaseTimer()
+	game.update_enemies = timer.wrap("update_enemies", game.update_enemies)
+	game.update_bullets = timer.wrap("update_bullets", game.update_bullets)
+	step = timer.wrap("step", game.step)
+	if render:
+		game.draw_first_person = timer.wrap("draw_first_person", game.draw_first_person)
+		game.draw_minimap = timer.wrap("draw_minimap", game.draw_minimap)
+		game.draw_ui = timer.wrap("draw_ui", game.draw_ui)
+		draw = timer.wrap("draw", game.draw)
+		from OpenGL.GL import glFinish
+		finish = timer.wrap("gl_finish", glFinish)
+		shaders = [game.shader, game.shader_td]
+		for shader in shaders:
+			shader.reset_uniform_counters()
+
+	collide = Maze.collide_batch
+	Maze.collide_batch = timer.wrap("maze_collide", collide)
+	start = time.perf_counter()
+	try:
+		for tick in range(ticks):
+			if tick_hook != None:
+				tick_hook(game, tick)
+			step(delta_time, input_track(tick))
+			if render:
+				draw()
+				finish()
+			timer.end_tick()
+	finally:
+		Maze.collide_batch = collide
+	wall_time = time.perf_counter() - start
+
+	report = {
+		"ticks": ticks,
+		"wall_time_s": wall_time,
+		"ticks_per_second": ticks / wall_time,
+		"phases": timer.get_report(),
+		"final_state": {"enemies": len(game.enemies), "bullets": len(game.bullets), "health": game.health, "boss_fight": game.boss_figth}
+	}
+	if render:
+		# Uniforms sent per tick, and the ones the shaders skipped because the
+		# location already had the value
+		report["uniform_updates_per_tick"] = sum([shader.uniform_updates for shader in shaders]) / ticks
+		report["uniform_updates_skipped_per_tick"] = sum([shader.uniform_updates_skipped for shader in shaders]) / ticks
+	return report
+
+# Times each maze generator on its own, without building the walls
+def run_maze_generation(sizes, seed):
+	from Maze import MAZE_GENERATORS
+	report = dict()
+	for algorithm, generate in MAZE_GENERATORS.items():
+		report[algorithm] = dict()
+		for size in sizes:
+			start = time.perf_counter()
+			generate(size, numpy.random.default_rng(seed))
+			report[algorithm][str(size)] = {"seconds": time.perf_counter() - start}
+	return report
+
+# Times building a whole level with each generator, as Simulation.create_maze
+# does but without uploading anything to the GPU
+def run_maze_building(sizes, seed, cell_width=10, player_radius=1.0):
+	from Maze import Maze, MAZE_GENERATORS
+	from Base3DObjects import Cube
+	report = dict()
+	for algorithm in MAZE_GENERATORS:
+		report[algorithm] = dict()
+		for size in sizes:
+			start = time.perf_counter()
+			Maze(None, None, Cube(cell_width), player_radius, None, cell_width, size, algorithm, seed)
+			report[algorithm][str(size)] = {"seconds": time.perf_counter() - start}
+	return report
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run scripted benchmark scenarios and report phase timings as JSON")
+	parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help="scenarios to run, all of them by default: " + ", ".join(SCENARIOS))
+	parser.add_argument("--ticks", type=int, default=600)
+	parser.add_argument("--dt", type=float, default=1 / 60)
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--render", action="store_true", help="draw every tick as well")
+	parser.add_argument("--offscreen", action="store_true", help="render without a window using a software EGL context")
+	parser.add_argument("--width", type=int, default=1280)
+	parser.add_argument("--height", type=int, default=720)
+	parser.add_argument("--output", help="file to write the JSON report to instead of stdout")
+	parser.add_argument("--mazes", type=int, nargs="*", metavar="SIZE", help="also time the maze generators at these grid sizes, " + " ".join(map(str, MAZE_SIZES)) + " if none are given")
+	parser.add_argument("--maze-builds", type=int, nargs="*", metavar="SIZE", help="also time building whole levels at these grid sizes, " + " ".join(map(str, MAZE_BUILD_SIZES)) + " if none are given")
+	args = parser.parse_args()
+
+	for name in args.scenarios:
+		if name not in SCENARIOS:
+			parser.error("unknown scenario " + name)
+
+	# These have to be set before pygame, PyOpenGL and pyglet are imported
+	if args.offscreen:
+		os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+		os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+		os.environ.setdefault("LIBGL_ALWAYS_SOFTWARE", "1")
+		import pyglet
+		pyglet.options["headless"] = True
+
+	# Shaders, textures and models are loaded relative to this folder
+	os.chdir(os.path.dirname(os.path.abspath(__file__)))
+	sys.path.insert(0, os.getcwd())
+
+	report = {
+		"settings": {"ticks": args.ticks, "dt": args.dt, "seed": args.seed, "render": args.render, "width": args.width, "height": args.height},
+		"scenarios": dict()
+	}
+	# The game's own messages go to stderr so stdout is only the report
+	with contextlib.redirect_stdout(sys.stderr):
+		for name in args.scenarios:
+			report["scenarios"][name] = run_scenario(name, args.ticks, args.dt, args.seed, args.render, args.width, args.height)
+		if args.mazes != None:
+			report["maze_generation"] = run_maze_generation(args.mazes if len(args.mazes) > 0 else MAZE_SIZES, args.seed)
+		if args.maze_builds != None:
+			report["maze_building"] = run_maze_building(args.maze_builds if len(args.maze_builds) > 0 else MAZE_BUILD_SIZES, args.seed)
+
+	output = json.dumps(report, indent=4)
+	if args.output == None:
+		print(output)
+	else:
+		fout = open(args.output, "w")
+		fout.write(output)
+		fout.close()
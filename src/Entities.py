@@ -2,84 +2,384 @@ from Matrices import *
 from Base3DObjects import *
 from math import *
 
+import numpy
+
 from Helpers import look_at
+from LevelOfDetail import select_lods
+
+# Per enemy values kept in EnemyBatch, by attribute name and array type
+ENEMY_ARRAYS = {
+	"y": float,
+	"max_health": int,
+	"health": int,
+	"rotation": float,
+	"radius": float,
+	"collision_radius": float,
+	"speed": float,
+	"last_known_hit": float,
+	"hit_cooldown": float,
+	"damage": int,
+	"health_bar_offset": float,
+	"scale_factor": float,
+	"bounding_radius": float,
+	"lod": int,
+	"alive": bool,
+	"dist": float
+}
+
+# Every enemy of a level stored as arrays, so the whole horde is updated at
+# once. Enemies are never removed from the batch, dead ones stay in place
+# with alive set to False until the next level makes a new batch
+class EnemyBatch:
+	def __init__(self, capacity=32):
+		self.capacity = capacity
+		self.count = 0
+		self.enemies = []
+		self.positions = numpy.zeros((capacity, 3))
+		for name, dtype in ENEMY_ARRAYS.items():
+			setattr(self, name, numpy.zeros(capacity, dtype=dtype))
+
+	def __len__(self):
+		return self.count
+
+	def grow(self):
+		self.capacity *= 2
+		positions = numpy.zeros((self.capacity, 3))
+		positions[:self.count] = self.positions[:self.count]
+		self.positions = positions
+		for name, dtype in ENEMY_ARRAYS.items():
+			array = numpy.zeros(self.capacity, dtype=dtype)
+			array[:self.count] = getattr(self, name)[:self.count]
+			setattr(self, name, array)
+
+	# Returns the index of the new enemy
+	def add(self, enemy, pos, values):
+		if self.count == self.capacity:
+			self.grow()
+		index = self.count
+		self.positions[index] = (pos.x, pos.y, pos.z)
+		for name, value in values.items():
+			getattr(self, name)[index] = value
+		self.enemies.append(enemy)
+		self.count += 1
+		return index
+
+	# Living enemies within far of the player, by the distances of the last
+	# update. With a maze only the ones in the cells it can see from the
+	# player's cell are kept
+	def get_visible(self, far, maze=None, frustum=None):
+		visible = self.alive[:self.count] & (self.dist[:self.count] <= far)
+		if maze != None:
+			visible &= maze.get_view_mask()[maze.get_cells(self.positions[:self.count])]
+		if frustum != None:
+			indices = numpy.flatnonzero(visible)
+			centers = self.positions[indices]
+			centers[:, 1] = self.y[indices]
+			visible[indices] = frustum.test_spheres(centers, self.bounding_radius[indices], "enemies")
+		return [self.enemies[i] for i in numpy.flatnonzero(visible).tolist()]
+
+	# Turns every living enemy within far towards the player, moves the ones
+	# close enough to chase along the maze's flow field (see
+	# Maze.update_flow_field) and returns the enemies that hit the player
+	# this update, in the order they were added
+	def update(self, delta_time, player_pos, far, maze):
+		n = self.count
+		alive = self.alive[:n]
+		positions = Vec3Array(data=self.positions[:n])
+		offsets = positions - player_pos # From the player to each enemy
+		dist = offsets.lengths()
+		numpy.copyto(self.dist[:n], dist, where=alive)
+
+		active = alive & (dist <= far)
+		self.last_known_hit[:n] += numpy.where(active, delta_time, 0.0)
+
+		# Same angle as look_at(pos, player_pos, pi / 2)
+		look_dir = -offsets.z / numpy.maximum(dist, 1e-9)
+		facing = numpy.where(player_pos.x > positions.x, numpy.arccos(-look_dir) - pi / 2, numpy.arccos(look_dir) + pi / 2)
+		numpy.copyto(self.rotation[:n], facing, where=active)
+
+		chasing = numpy.flatnonzero(active & (dist <= self.radius[:n]) & (dist > self.collision_radius[:n] - 0.1))
+		if len(chasing) > 0:
+			# Enemies follow the maze's flow field to the player
+			chasers = positions[chasing]
+			steps = Vec3Array(data=maze.get_flow_targets(chasers.data, player_pos)) - chasers
+			steps.normalize()
+			steps *= self.speed[chasing] * delta_time
+			steps, hit = maze.collide_batch(chasers.data, steps.data, self.collision_radius[chasing])
+			cells = chasers.data[:, [0, 2]] // maze.cell_width
+			chasers += steps
+			positions[chasing] = chasers
+
+			# Only the enemies that moved to another cell are moved in their grid
+			moved = chasing[numpy.any(chasers.data[:, [0, 2]] // maze.cell_width != cells, axis=1)]
+			for index in moved.tolist():
+				enemy = self.enemies[index]
+				if enemy.grid != None:
+					enemy.grid.move(enemy)
+
+		# Distances from before the move, like the chase
+		attacking = numpy.flatnonzero(active & (dist < self.collision_radius[:n]) & (self.last_known_hit[:n] > self.hit_cooldown[:n]))
+		if len(attacking) == 0:
+			return []
+		self.last_known_hit[attacking] = 0.0
+		return [self.enemies[i] for i in attacking.tolist()]
+
+# Attribute of an Enemy that reads and writes its slot in the batch array
+def batch_property(name):
+	def get_value(self):
+		return getattr(self.batch, name)[self.index].item()
+	def set_value(self, value):
+		getattr(self.batch, name)[self.index] = value
+	return property(get_value, set_value)
 
+# A single enemy, its values live in an EnemyBatch and are read and written
+# through the attributes. Enemies made without a batch get one of their own
 class Enemy:
-	def __init__(self, maze, model_matrix, pos, obj, health=100, collision_radius=2, speed=10, hit_cooldown=1, damage=25, health_bar_offset=4, scale_factor=1.0):
+	def __init__(self, maze, pos, obj, health=100, collision_radius=2, speed=10, hit_cooldown=1, damage=25, health_bar_offset=4, scale_factor=1.0, batch=None):
 		self.maze = maze
-		self.model_matrix = model_matrix
-		self.pos = pos
-		self.y = pos.y
-		self.vel = Vector(0, 0, 0)
-		self.max_health = health
-		self.health = health
-		self.rotation = 0
-		self.cube = Cube()
-		self.radius = maze.cell_width * 1.5
 		self.obj = obj
-		self.collision_radius = collision_radius
-		self.speed = speed
-		self.last_known_hit = 1000
-		self.hit_cooldown = hit_cooldown
-		self.damage = damage
-		self.health_bar_offset = health_bar_offset
-		self.scale_factor = scale_factor
-		self.alive = True
-		self.dist = 0
-
-	def update(self, delta_time, player_pos):
-		if self.health <= 0:
-			self.alive = False
-			return
-		
-		self.last_known_hit += delta_time
-		dist_vec = player_pos - self.pos
-		self.dist = self.get_distance_to(player_pos)
-		
-		self.rotation = look_at(self.pos, player_pos, pi / 2)
-		
-		dist = self.get_distance_to(player_pos)
-		if dist <= self.radius and dist > self.collision_radius - 0.1:
-			dist_vec.normalize()
-			self.vel = dist_vec * self.speed * delta_time
-			self.vel = self.maze.collide(self.pos, self.vel, radius=self.collision_radius)
-			self.pos += self.vel
+		self.grid = None
+		self.grid_key = None
+		self.batch = EnemyBatch(1) if batch == None else batch
+
+		# Around the model turned any way and the health bar above it
+		bounding_radius = abs(health_bar_offset) + sqrt(0.25 ** 2 * 2 + 2 ** 2)
+		if obj != None:
+			bounding_radius = max(bounding_radius, (float(numpy.linalg.norm(obj.bounding_center)) + obj.bounding_radius) * scale_factor)
+
+		self.index = self.batch.add(self, pos, {
+			"y": pos.y,
+			"max_health": health,
+			"health": health,
+			"rotation": 0,
+			"radius": maze.cell_width * 1.5,
+			"collision_radius": collision_radius,
+			"speed": speed,
+			"last_known_hit": 1000,
+			"hit_cooldown": hit_cooldown,
+			"damage": damage,
+			"health_bar_offset": health_bar_offset,
+			"scale_factor": scale_factor,
+			"bounding_radius": bounding_radius,
+			"lod": 0,
+			"alive": True,
+			"dist": 0
+		})
+
+	def get_pos(self):
+		return Point(*self.batch.positions[self.index].tolist())
+
+	def set_pos(self, pos):
+		self.batch.positions[self.index] = (pos.x, pos.y, pos.z)
+
+	pos = property(get_pos, set_pos)
 
 	def get_distance_to(self, other):
 		return (other - self.pos).__len__()
 
-	def draw(self, shader):
-		if not self.alive:
+for name in ENEMY_ARRAYS:
+	setattr(Enemy, name, batch_property(name))
+del name
+
+# Cells are keyed by one integer per (column, row) so whole arrays of
+# bullet positions can be turned into cell keys at once
+CELL_KEY_OFFSET = 2
+CELL_KEY_STRIDE = 1 << 20
+NEIGHBOUR_OFFSETS = numpy.array([(col, row) for row in range(-1, 2) for col in range(-1, 2)])
+
+# Uniform grid of enemies with cells as wide as the maze cells. Enemies keep
+# track of their own cell and move between cells as they update, anything
+# closer to a point than the cell width is in the 3x3 cells around it
+class EnemyGrid:
+	def __init__(self, cell_width):
+		self.cell_width = cell_width
+		self.cells = dict()
+
+	def get_cell_key(self, col, row):
+		return (col + CELL_KEY_OFFSET) * CELL_KEY_STRIDE + row + CELL_KEY_OFFSET
+
+	def get_key(self, x, z):
+		return self.get_cell_key(int(x // self.cell_width), int(z // self.cell_width))
+
+	# Keys of the cells around each of the (x, z) positions, shape (N, 9)
+	def get_neighbour_keys(self, positions):
+		cells = numpy.floor(positions / self.cell_width).astype(int)
+		return self.get_cell_key(cells[:, None, 0] + NEIGHBOUR_OFFSETS[:, 0], cells[:, None, 1] + NEIGHBOUR_OFFSETS[:, 1])
+
+	def add(self, enemy):
+		enemy.grid = self
+		enemy.grid_key = self.get_key(enemy.pos.x, enemy.pos.z)
+		if enemy.grid_key not in self.cells:
+			self.cells[enemy.grid_key] = []
+		self.cells[enemy.grid_key].append(enemy)
+
+	def remove(self, enemy):
+		if enemy.grid_key == None:
 			return
-		
-		self.model_matrix.push_matrix()
-		self.model_matrix.add_translation(self.pos.x, self.y, self.pos.z)
-		self.model_matrix.add_rotation_y(-self.rotation)
-		self.model_matrix.add_scale(self.scale_factor, self.scale_factor, self.scale_factor)
-		shader.set_model_matrix(self.model_matrix.matrix)
-		self.obj.draw(shader)
-		self.model_matrix.pop_matrix()
-
-		### DRAW CUBE ABOVE ENEMY FOR HEALTH BAR ###
-		self.model_matrix.push_matrix()
-		self.model_matrix.add_translation(self.pos.x, self.y + self.health_bar_offset, self.pos.z)
-		self.model_matrix.add_rotation_y(-self.rotation)
-		self.model_matrix.add_scale(0.5, 0.5, (self.health / self.max_health) * 4)
-		shader.set_material_diffuse(1.0, 0.1, 0.1)
-		shader.set_model_matrix(self.model_matrix.matrix)
-		self.cube.set_vertices(shader)
-		self.cube.draw()
-		self.model_matrix.pop_matrix()
-	
-	def draw_minimap(self, shader):
-		if not self.alive:
+		cell = self.cells[enemy.grid_key]
+		cell.remove(enemy)
+		if len(cell) == 0:
+			del self.cells[enemy.grid_key]
+		enemy.grid_key = None
+
+	def move(self, enemy):
+		if enemy.grid_key != None and enemy.grid_key != self.get_key(enemy.pos.x, enemy.pos.z):
+			self.remove(enemy)
+			self.add(enemy)
+
+	# Enemies in the cell of the point and the eight around it
+	def query(self, x, z):
+		enemies = []
+		for key in self.get_neighbour_keys(numpy.array([[x, z]]))[0].tolist():
+			cell = self.cells.get(key)
+			if cell != None:
+				enemies += cell
+		return enemies
+
+	# The enemies of the occupied cells among the given sorted keys, as
+	# arrays grouped by cell. Cell i holds enemies starts[i]:starts[i] + counts[i]
+	def get_cell_arrays(self, keys):
+		cell_keys = []
+		cell_starts = []
+		cell_counts = []
+		enemies = []
+		for key in keys:
+			cell = self.cells.get(key)
+			if cell != None:
+				cell_keys.append(key)
+				cell_starts.append(len(enemies))
+				cell_counts.append(len(cell))
+				enemies += cell
+
+		if len(enemies) == 0:
+			return enemies, numpy.zeros((0, 3)), numpy.zeros(0), numpy.array(cell_keys, dtype=int), numpy.array(cell_starts, dtype=int), numpy.array(cell_counts, dtype=int)
+		batch = enemies[0].batch
+		indices = [e.index for e in enemies]
+		positions = batch.positions[indices]
+		radii = batch.collision_radius[indices]
+		return enemies, positions, radii, numpy.array(cell_keys, dtype=int), numpy.array(cell_starts, dtype=int), numpy.array(cell_counts, dtype=int)
+
+# Every bullet in flight, stored as arrays with the live bullets packed at
+# the front in the order they were fired. When full the oldest bullet makes
+# room for a new one
+class BulletSystem:
+	def __init__(self, capacity=30, speed=50, lifetime=10.0):
+		self.capacity = capacity
+		self.speed = speed
+		self.lifetime = lifetime
+		self.count = 0
+		self.positions = numpy.zeros((capacity, 3))
+		self.velocities = numpy.zeros((capacity, 3))
+		self.rotations = numpy.zeros(capacity)
+		self.damage = numpy.zeros(capacity, dtype=int)
+		self.age = numpy.zeros(capacity)
+		self.alive = numpy.zeros(capacity, dtype=bool)
+
+	def __len__(self):
+		return self.count
+
+	def get_arrays(self):
+		return [self.positions, self.velocities, self.rotations, self.damage, self.age, self.alive]
+
+	def spawn(self, position, rotation, velocity, damage):
+		if self.count == self.capacity:
+			for array in self.get_arrays():
+				array[:-1] = array[1:]
+			self.count -= 1
+
+		index = self.count
+		self.positions[index] = (position.x, position.y, position.z)
+		self.velocities[index] = (velocity.x, velocity.y, velocity.z)
+		self.rotations[index] = rotation
+		self.damage[index] = damage
+		self.age[index] = 0.0
+		self.alive[index] = True
+		self.count += 1
+
+	# Moves every live bullet and ages all of them
+	def move(self, delta_time):
+		alive = self.alive[:self.count]
+		positions = Vec3Array(data=self.positions[:self.count])
+		positions.add_scaled(self.velocities[:self.count], numpy.where(alive, self.speed * delta_time, 0.0))
+		self.age[:self.count] += delta_time
+
+	# Drops dead and expired bullets, keeping the rest in order
+	def compact(self):
+		keep = self.alive[:self.count] & (self.age[:self.count] < self.lifetime)
+		kept = int(numpy.count_nonzero(keep))
+		if kept == self.count:
 			return
-		
-		self.cube.set_vertices(shader)
-		shader.set_material_diffuse(0.9, 0.1, 0.1)
-		self.model_matrix.push_matrix()
-		self.model_matrix.add_translation(self.pos.x, 1, self.pos.z)
-		shader.set_model_matrix(self.model_matrix.matrix)
-		self.cube.set_vertices(shader)
-		self.cube.draw()
-		self.model_matrix.pop_matrix()
\ No newline at end of file
+		for array in self.get_arrays():
+			array[:kept] = array[:self.count][keep]
+		self.count = kept
+
+	# Returns (bullet index, enemy) for every bullet inside an enemy, in
+	# bullet order. Every bullet is paired with the enemies in the 3x3 grid
+	# cells around it and all the pairs are tested at once
+	def collide_enemies(self, enemy_grid):
+		if self.count == 0 or len(enemy_grid.cells) == 0:
+			return []
+		positions = self.positions[:self.count]
+		neighbour_keys = enemy_grid.get_neighbour_keys(positions[:, [0, 2]]).reshape(-1)
+
+		# Only the cells near a bullet are gathered
+		enemies, enemy_positions, radii, cell_keys, cell_starts, cell_counts = enemy_grid.get_cell_arrays(numpy.unique(neighbour_keys).tolist())
+		if len(enemies) == 0:
+			return []
+
+		slots = numpy.minimum(numpy.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+		found = cell_keys[slots] == neighbour_keys
+		bullets = numpy.repeat(numpy.arange(self.count), len(NEIGHBOUR_OFFSETS))[found]
+		slots = slots[found]
+
+		counts = cell_counts[slots]
+		pair_bullets = numpy.repeat(bullets, counts)
+		pair_enemies = numpy.repeat(cell_starts[slots], counts) + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+
+		offsets = Vec3Array(data=positions[pair_bullets]) - enemy_positions[pair_enemies]
+		inside = offsets.dot(offsets) < radii[pair_enemies] ** 2
+		return [(bullet, enemies[enemy]) for bullet, enemy in zip(pair_bullets[inside].tolist(), pair_enemies[inside].tolist())]
+
+# Draws all the given enemies with instancing, one instanced draw per mesh
+# of each model and level of detail plus a single draw for every health
+# bar. With a screen_scale (1 / tan(fovy / 2)) each enemy's level is picked
+# by how big it looks, otherwise they are all drawn in full
+def draw_enemies(shader, enemies, cube, screen_scale=None):
+	models = dict()
+	for e in enemies:
+		if e.alive:
+			if e.obj not in models:
+				models[e.obj] = []
+			models[e.obj].append(e)
+	
+	bar_positions = []
+	bar_rotations = []
+	bar_health = []
+
+	for obj, model_enemies in models.items():
+		batch = model_enemies[0].batch
+		indices = [e.index for e in model_enemies]
+		positions = batch.positions[indices]
+		positions[:, 1] = batch.y[indices]
+		rotations = -batch.rotation[indices]
+		transforms = build_model_matrices(positions, rotations, batch.scale_factor[indices])
+
+		if screen_scale == None or obj.get_lod_count() == 1:
+			obj.draw_instanced(shader, transforms)
+		else:
+			sizes = obj.bounding_radius * batch.scale_factor[indices] * screen_scale / numpy.maximum(batch.dist[indices], 1e-6)
+			levels = select_lods(sizes, batch.lod[indices], obj.get_lod_count())
+			batch.lod[indices] = levels
+			for level in numpy.unique(levels).tolist():
+				obj.draw_instanced(shader, transforms[levels == level], level=level)
+
+		positions[:, 1] += batch.health_bar_offset[indices]
+		bar_positions.append(positions)
+		bar_rotations.append(rotations)
+		bar_health.append(batch.health[indices] / batch.max_health[indices])
+	
+	if len(bar_positions) > 0:
+		shader.set_material_diffuse(1.0, 0.1, 0.1)
+		shader.set_health_bar(True)
+		cube.draw_instanced(shader, build_model_matrices(numpy.concatenate(bar_positions), numpy.concatenate(bar_rotations), [(0.5, 0.5, 4.0)]), numpy.concatenate(bar_health))
+		shader.set_health_bar(False)
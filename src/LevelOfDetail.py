@@ -0,0 +1,186 @@
+import heapq
+
+import numpy
+
+# Fraction of each mesh's triangles kept by the simplified levels (level 0
+# is the full mesh), and the screen size (bounding sphere radius over the
+# half height of the view) below which each of those levels is used
+LOD_TRIANGLE_RATIOS = [0.5, 0.25, 0.1]
+LOD_SCREEN_SIZES = [0.35, 0.2, 0.1]
+# Meshes are never cut below this many triangles, so small parts like the
+# cubes of the models keep their shape
+LOD_MIN_TRIANGLES = 24
+# How far past a screen size an enemy has to get before changing level
+LOD_HYSTERESIS = 0.2
+# Weight of the planes that keep open borders of a mesh in place
+BOUNDARY_WEIGHT = 100.0
+
+# Sum of the squared distances to the planes (a, b, c, d), as 4x4 matrices
+def get_plane_quadrics(planes, weights):
+	return planes[:, :, None] * planes[:, None, :] * weights[:, None, None]
+
+# Simplifies the triangles (T, 3) of one mesh by collapsing edges in the
+# order of their quadric error, moving one end onto the other so the
+# vertices stay where they are. Vertices at the same position are welded
+# first, so seams between normals or uvs can close. Returns the triangles
+# left when the count first gets down to each of the targets (largest
+# first), as indices into positions
+def simplify_triangles(positions, normals, triangles, targets):
+	welded, groups = numpy.unique(positions, axis=0, return_inverse=True)
+	groups = groups.reshape(-1)
+	tris = groups[triangles]
+	keep = (tris[:, 0] != tris[:, 1]) & (tris[:, 1] != tris[:, 2]) & (tris[:, 2] != tris[:, 0])
+	tris = tris[keep]
+	corners = triangles[keep]
+	points = welded.astype(float)
+	homogeneous = numpy.concatenate((points, numpy.ones((len(points), 1))), axis=1)
+
+	# Every group's original vertices, to pick a normal and uv from later
+	group_vertices = [[] for _ in range(len(welded))]
+	for vertex in numpy.unique(triangles).tolist():
+		group_vertices[groups[vertex]].append(vertex)
+
+	edges_a = points[tris[:, 1]] - points[tris[:, 0]]
+	edges_b = points[tris[:, 2]] - points[tris[:, 0]]
+	crossed = numpy.cross(edges_a, edges_b)
+	areas = numpy.sqrt((crossed ** 2).sum(axis=1))
+	face_normals = crossed / numpy.maximum(areas, 1e-12)[:, None]
+	planes = numpy.concatenate((face_normals, -(face_normals * points[tris[:, 0]]).sum(axis=1)[:, None]), axis=1)
+	quadrics = numpy.zeros((len(points), 4, 4))
+	for corner in range(3):
+		numpy.add.at(quadrics, tris[:, corner], get_plane_quadrics(planes, areas / 2))
+
+	# Edges with one triangle are borders, held by planes standing on them
+	directed = numpy.concatenate((tris[:, [0, 1]], tris[:, [1, 2]], tris[:, [2, 0]]))
+	owners = numpy.tile(numpy.arange(len(tris)), 3)
+	undirected = numpy.sort(directed, axis=1)
+	unique_edges, edge_index, edge_uses = numpy.unique(undirected, axis=0, return_index=True, return_counts=True)
+	border = edge_index[edge_uses == 1]
+	if len(border) > 0:
+		starts = points[directed[border, 0]]
+		along = points[directed[border, 1]] - starts
+		normals_out = numpy.cross(along, face_normals[owners[border]])
+		lengths = numpy.sqrt((normals_out ** 2).sum(axis=1))
+		normals_out /= numpy.maximum(lengths, 1e-12)[:, None]
+		border_planes = numpy.concatenate((normals_out, -(normals_out * starts).sum(axis=1)[:, None]), axis=1)
+		border_quadrics = get_plane_quadrics(border_planes, BOUNDARY_WEIGHT * (along ** 2).sum(axis=1))
+		numpy.add.at(quadrics, directed[border, 0], border_quadrics)
+		numpy.add.at(quadrics, directed[border, 1], border_quadrics)
+
+	vertex_tris = [set() for _ in range(len(points))]
+	for tri, corner_groups in enumerate(tris.tolist()):
+		for group in corner_groups:
+			vertex_tris[group].add(tri)
+	tris = tris.tolist()
+	alive = [True] * len(tris)
+	versions = [0] * len(points)
+
+	def get_cost(source, target):
+		q = quadrics[source] + quadrics[target]
+		return float(homogeneous[target] @ q @ homogeneous[target])
+
+	heap = []
+	def push_edges(group):
+		neighbours = set()
+		for tri in vertex_tris[group]:
+			neighbours.update(tris[tri])
+		neighbours.discard(group)
+		for neighbour in neighbours:
+			heapq.heappush(heap, (get_cost(group, neighbour), group, neighbour, versions[group], versions[neighbour]))
+			heapq.heappush(heap, (get_cost(neighbour, group), neighbour, group, versions[neighbour], versions[group]))
+
+	for a, b in unique_edges.tolist():
+		heapq.heappush(heap, (get_cost(a, b), a, b, 0, 0))
+		heapq.heappush(heap, (get_cost(b, a), b, a, 0, 0))
+
+	# Moving source onto target must not turn any remaining triangle over
+	def flips(source, target):
+		for tri in vertex_tris[source]:
+			corner_groups = tris[tri]
+			if target in corner_groups:
+				continue
+			moved = [target if group == source else group for group in corner_groups]
+			before = numpy.cross(points[corner_groups[1]] - points[corner_groups[0]], points[corner_groups[2]] - points[corner_groups[0]])
+			after = numpy.cross(points[moved[1]] - points[moved[0]], points[moved[2]] - points[moved[0]])
+			if before @ after <= 0:
+				return True
+		return False
+
+	def get_level():
+		indices = []
+		for tri in range(len(tris)):
+			if not alive[tri]:
+				continue
+			corner_groups = tris[tri]
+			normal = numpy.cross(points[corner_groups[1]] - points[corner_groups[0]], points[corner_groups[2]] - points[corner_groups[0]])
+			for corner in range(3):
+				vertex = int(corners[tri, corner])
+				if groups[vertex] != corner_groups[corner]:
+					# Moved corners take the vertex facing most like the triangle
+					choices = group_vertices[corner_groups[corner]]
+					vertex = choices[int(numpy.argmax(normals[choices] @ normal))]
+				indices.append(vertex)
+		return numpy.array(indices, dtype="uint32").reshape(-1, 3)
+
+	levels = []
+	triangle_count = len(tris)
+	for target in targets:
+		while triangle_count > target and len(heap) > 0:
+			cost, source, dest, source_version, dest_version = heapq.heappop(heap)
+			if versions[source] != source_version or versions[dest] != dest_version:
+				continue
+			if flips(source, dest):
+				continue
+
+			for tri in list(vertex_tris[source]):
+				if dest in tris[tri]:
+					alive[tri] = False
+					triangle_count -= 1
+					for group in tris[tri]:
+						vertex_tris[group].discard(tri)
+				else:
+					tris[tri] = [dest if group == source else group for group in tris[tri]]
+					vertex_tris[dest].add(tri)
+			vertex_tris[source] = set()
+			quadrics[dest] += quadrics[source]
+			versions[source] += 1
+			versions[dest] += 1
+			push_edges(dest)
+		levels.append(get_level())
+	return levels
+
+# Adds the simplified levels of LOD_TRIANGLE_RATIOS to a loaded model. Their
+# indices go after the full meshes in the same index array and point into
+# the same vertices, so every level draws from the one vertex buffer
+def generate_lods(mesh_model):
+	vertex_array = numpy.asarray(mesh_model.vertex_array)
+	index_array = numpy.asarray(mesh_model.index_array)
+	if len(vertex_array) == 0:
+		return
+	positions = vertex_array[:, 0:3]
+	normals = vertex_array[:, 3:6]
+
+	level_indices = [[] for _ in LOD_TRIANGLE_RATIOS]
+	offset = len(index_array)
+	for mesh_id in list(mesh_model.index_offsets.keys()):
+		start = mesh_model.index_offsets[mesh_id]
+		triangles = index_array[start:start + mesh_model.index_counts[mesh_id]].reshape(-1, 3).astype("int64")
+		targets = [max(int(len(triangles) * ratio), min(len(triangles), LOD_MIN_TRIANGLES)) for ratio in LOD_TRIANGLE_RATIOS]
+		levels = simplify_triangles(positions, normals, triangles, targets) if len(triangles) > 0 else [triangles] * len(targets)
+		for level, triangles in enumerate(levels):
+			level_indices[level].append(triangles.reshape(-1))
+
+	for level in range(len(LOD_TRIANGLE_RATIOS)):
+		for mesh_id, indices in zip(mesh_model.index_offsets.keys(), level_indices[level]):
+			mesh_model.add_mesh(mesh_id, offset, len(indices), level + 1)
+			offset += len(indices)
+	all_indices = [index_array] + [indices for level in level_indices for indices in level]
+	mesh_model.set_mesh_data(vertex_array, numpy.concatenate(all_indices).astype("uint32"))
+
+# The level each of the given sizes (see LOD_SCREEN_SIZES) should use,
+# staying on its current level until it is clearly past a threshold
+def select_lods(sizes, current, level_count):
+	thresholds = numpy.array(LOD_SCREEN_SIZES[:level_count - 1])
+	coarsest = (sizes[:, None] < thresholds * (1 + LOD_HYSTERESIS)).sum(axis=1)
+	finest = (sizes[:, None] < thresholds * (1 - LOD_HYSTERESIS)).sum(axis=1)
+	return numpy.clip(current, finest, coarsest)
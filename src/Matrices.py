@@ -1,104 +1,137 @@
 from math import *
 from Base3DObjects import *
 
+import numpy
+
+IDENTITY_MATRIX = numpy.identity(4, dtype=numpy.float32)
+
 class ModelMatrix:
-	def __init__(self):
-		self.matrix = [ 1, 0, 0, 0,
-						0, 1, 0, 0,
-						0, 0, 1, 0,
-						0, 0, 0, 1 ]
-		self.stack = []
+	def __init__(self, stack_capacity=32):
+		self.matrix = numpy.identity(4, dtype=numpy.float32)
+		self.stack = [numpy.identity(4, dtype=numpy.float32) for _ in range(stack_capacity)]
 		self.stack_count = 0
-		self.stack_capacity = 0
+		self.stack_capacity = stack_capacity
+
+		# Scratch matrices reused by every transformation so composing allocates nothing
+		self.other_matrix = numpy.identity(4, dtype=numpy.float32)
+		self.other_matrix_flat = self.other_matrix.reshape(16)
+		self.result_matrix = numpy.identity(4, dtype=numpy.float32)
 
 	def load_identity(self):
-		self.matrix = [ 1, 0, 0, 0,
-						0, 1, 0, 0,
-						0, 0, 1, 0,
-						0, 0, 0, 1 ]
+		numpy.copyto(self.matrix, IDENTITY_MATRIX)
 
 	def copy_matrix(self):
-		new_matrix = [0] * 16
-		for i in range(16):
-			new_matrix[i] = self.matrix[i]
-		return new_matrix
+		return self.matrix.copy()
 
 	def add_transformation(self, matrix2):
-		counter = 0
-		new_matrix = [0] * 16
-		for row in range(4):
-			for col in range(4):
-				for i in range(4):
-					new_matrix[counter] += self.matrix[row*4 + i]*matrix2[col + 4*i]
-				counter += 1
-		self.matrix = new_matrix
+		self.other_matrix_flat[:] = matrix2
+		self.apply_other_matrix()
+
+	def apply_other_matrix(self):
+		numpy.matmul(self.matrix, self.other_matrix, out=self.result_matrix)
+		numpy.copyto(self.matrix, self.result_matrix)
+
+	def reset_other_matrix(self):
+		numpy.copyto(self.other_matrix, IDENTITY_MATRIX)
+		return self.other_matrix
 
 	def add_translation(self, x, y, z):
-		other_matrix = [1, 0, 0, x,
-						0, 1, 0, y,
-						0, 0, 1, z,
-						0, 0, 0, 1]
-		self.add_transformation(other_matrix)
+		other_matrix = self.reset_other_matrix()
+		other_matrix[0, 3] = x
+		other_matrix[1, 3] = y
+		other_matrix[2, 3] = z
+		self.apply_other_matrix()
 	
 	def add_scale(self, Sx, Sy, Sz):
-		other_matrix = [Sx, 0,  0,  0,
-						0,  Sy, 0,  0,
-						0,  0,  Sz, 0,
-						0,  0,  0,  1]
-		self.add_transformation(other_matrix)
+		other_matrix = self.reset_other_matrix()
+		other_matrix[0, 0] = Sx
+		other_matrix[1, 1] = Sy
+		other_matrix[2, 2] = Sz
+		self.apply_other_matrix()
 	
 	def add_rotation(self, x, y, z):
-		x = self.add_rotation_x(x * pi / 180.0)
-		y = self.add_rotation_y(y * pi / 180.0)
-		z = self.add_rotation_z(z * pi / 180.0)
+		self.add_rotation_x(x * pi / 180.0)
+		self.add_rotation_y(y * pi / 180.0)
+		self.add_rotation_z(z * pi / 180.0)
 	
 	def add_rotation_x(self, angle):
 		c = cos(angle)
 		s = sin(angle)
-		other_matrix = [1, 0, 0,  0,
-						0, c, -s, 0,
-						0, s, c,  0,
-						0, 0, 0,  1]
-		self.add_transformation(other_matrix)
+		other_matrix = self.reset_other_matrix()
+		other_matrix[1, 1] = c
+		other_matrix[1, 2] = -s
+		other_matrix[2, 1] = s
+		other_matrix[2, 2] = c
+		self.apply_other_matrix()
 	
 	def add_rotation_y(self, angle):
 		c = cos(angle)
 		s = sin(angle)
-		other_matrix = [c,  0, s, 0,
-						0,  1, 0, 0,
-						-s, 0, c, 0,
-						0,  0, 0, 1]
-		self.add_transformation(other_matrix)
+		other_matrix = self.reset_other_matrix()
+		other_matrix[0, 0] = c
+		other_matrix[0, 2] = s
+		other_matrix[2, 0] = -s
+		other_matrix[2, 2] = c
+		self.apply_other_matrix()
 	
 	def add_rotation_z(self, angle):
 		c = cos(angle)
 		s = sin(angle)
-		other_matrix = [c, -s, 0, 0,
-						s, c,  0, 0,
-						0, 0,  1, 0,
-						0, 0,  0, 1]
-		self.add_transformation(other_matrix)
-
-	# YOU CAN TRY TO MAKE PUSH AND POP (AND COPY) LESS DEPENDANT ON GARBAGE COLLECTION
-	# THAT CAN FIX SMOOTHNESS ISSUES ON SOME COMPUTERS
+		other_matrix = self.reset_other_matrix()
+		other_matrix[0, 0] = c
+		other_matrix[0, 1] = -s
+		other_matrix[1, 0] = s
+		other_matrix[1, 1] = c
+		self.apply_other_matrix()
+
+	# The stack is preallocated so pushing and popping only copies into
+	# existing arrays instead of creating new ones for the garbage collector
 	def push_matrix(self):
-		self.stack.append(self.copy_matrix())
+		if self.stack_count == self.stack_capacity:
+			self.stack += [numpy.identity(4, dtype=numpy.float32) for _ in range(self.stack_capacity)]
+			self.stack_capacity *= 2
+		numpy.copyto(self.stack[self.stack_count], self.matrix)
+		self.stack_count += 1
 
 	def pop_matrix(self):
-		self.matrix = self.stack.pop()
+		if self.stack_count == 0:
+			raise IndexError("pop from empty matrix stack")
+		self.stack_count -= 1
+		numpy.copyto(self.matrix, self.stack[self.stack_count])
 
 	# This operation mainly for debugging
 	def __str__(self):
 		ret_str = ""
-		counter = 0
-		for _ in range(4):
+		for row in range(4):
 			ret_str += "["
-			for _ in range(4):
-				ret_str += " " + str(self.matrix[counter]) + " "
-				counter += 1
+			for col in range(4):
+				ret_str += " " + str(self.matrix[row, col]) + " "
 			ret_str += "]\n"
 		return ret_str
 
+# Builds translation * rotation_y * scale model matrices for N objects at
+# once, the same thing ModelMatrix does one add_* call at a time.
+# positions is (N, 3), angles and scales are (N,) or scalars, scales can also be (N, 3)
+def build_model_matrices(positions, angles, scales=1.0):
+	positions = numpy.asarray(positions, dtype=numpy.float32).reshape(-1, 3)
+	count = len(positions)
+	scales = numpy.asarray(scales, dtype=numpy.float32)
+	if scales.ndim < 2:
+		scales = scales.reshape(-1, 1)
+	scales = numpy.broadcast_to(scales, (count, 3))
+	c = numpy.cos(angles)
+	s = numpy.sin(angles)
+
+	matrices = numpy.zeros((count, 4, 4), dtype=numpy.float32)
+	matrices[:, 0, 0] = c * scales[:, 0]
+	matrices[:, 0, 2] = s * scales[:, 2]
+	matrices[:, 1, 1] = scales[:, 1]
+	matrices[:, 2, 0] = -s * scales[:, 0]
+	matrices[:, 2, 2] = c * scales[:, 2]
+	matrices[:, 0:3, 3] = positions
+	matrices[:, 3, 3] = 1.0
+	return matrices
+
 # The Camera class holds the camera's coordinate frame and
 # set's up a transformation concerning the camera's position
 # and orientation
@@ -110,7 +143,7 @@ class Camera:
 		self.n = Vector(0, 0, 1)
 
 	def look(self, eye, center, up):
-		self.eye = eye
+		self.eye = eye.copy()
 		self.n = eye - center
 		self.u = up.cross(self.n)
 		self.n.normalize()
@@ -118,7 +151,12 @@ class Camera:
 		self.v = self.n.cross(self.u)
 
 	def get_velocity(self, world_space_vel):
-		return self.u * world_space_vel.x + self.v * world_space_vel.y + self.n * world_space_vel.z
+		x = world_space_vel.x
+		y = world_space_vel.y
+		z = world_space_vel.z
+		return Vector(self.u.x * x + self.v.x * y + self.n.x * z,
+					  self.u.y * x + self.v.y * y + self.n.y * z,
+					  self.u.z * x + self.v.z * y + self.n.z * z)
 
 	def move(self, vel):
 		self.eye += vel
@@ -127,9 +165,11 @@ class Camera:
 		c = cos(angle)
 		s = sin(angle)
 
-		temp_n = self.n * c + self.u * s
-		self.u = self.n * -s + self.u * c
-		self.n = temp_n
+		n = self.n
+		u = self.u
+		n.x, u.x = n.x * c + u.x * s, n.x * -s + u.x * c
+		n.y, u.y = n.y * c + u.y * s, n.y * -s + u.y * c
+		n.z, u.z = n.z * c + u.z * s, n.z * -s + u.z * c
 
 	def get_matrix(self):
 		minusEye = Vector(-self.eye.x, -self.eye.y, -self.eye.z)
@@ -194,3 +234,43 @@ class ProjectionMatrix:
 					0,C,D, 0,
 					0,0,E, F,
 					0,0,-1,0]
+
+# The six planes of a camera's view volume as rows (a, b, c, d), with
+# a * x + b * y + c * z + d the distance inside the plane, taken from the
+# rows of projection * view. Every test counts what it kept and dropped
+# under its kind until the planes are set again
+class Frustum:
+	def __init__(self):
+		self.planes = numpy.zeros((6, 4))
+		self.counts = dict()
+
+	def set_matrices(self, view_matrix, projection_matrix):
+		matrix = numpy.reshape(projection_matrix, (4, 4)) @ numpy.reshape(view_matrix, (4, 4))
+		self.planes = numpy.array([matrix[3] + matrix[0], matrix[3] - matrix[0], matrix[3] + matrix[1], matrix[3] - matrix[1], matrix[3] + matrix[2], matrix[3] - matrix[2]])
+		self.planes /= numpy.linalg.norm(self.planes[:, :3], axis=1)[:, None]
+		self.counts = dict()
+
+	def count(self, kind, visible):
+		if kind == None:
+			return
+		kept = int(numpy.count_nonzero(visible))
+		counts = self.counts.setdefault(kind, [0, 0])
+		counts[0] += kept
+		counts[1] += len(visible) - kept
+
+	# Which spheres, centers (N, 3) with one radius or N, are not wholly
+	# outside any plane
+	def test_spheres(self, centers, radii, kind=None):
+		distances = centers @ self.planes[:, :3].T + self.planes[:, 3]
+		visible = numpy.all(distances >= -numpy.reshape(radii, (-1, 1)), axis=1)
+		self.count(kind, visible)
+		return visible
+
+	# Which boxes, corners mins and maxs (N, 3), have their corner furthest
+	# along every plane's normal inside that plane
+	def test_boxes(self, mins, maxs, kind=None):
+		corners = numpy.where(self.planes[:, :3] >= 0, maxs[:, None, :], mins[:, None, :])
+		distances = numpy.einsum("npk,pk->np", corners, self.planes[:, :3]) + self.planes[:, 3]
+		visible = numpy.all(distances >= 0, axis=1)
+		self.count(kind, visible)
+		return visible
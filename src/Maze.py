@@ -1,6 +1,8 @@
 from Base3DObjects import *
 from Shaders import *
+from Matrices import ModelMatrix, IDENTITY_MATRIX
 import random
+import numpy
 
 from OpenGL.GL import *
 
@@ -15,406 +17,675 @@ class MazeStruct:
 	def __str__(self):
 		return "[South: %s, East: %s]" % (self.south_wall, self.east_wall)
 
-class Wall:
-	def __init__(self, shader, model_matrix, cube, length, pos, color=Vector(1.0, 1.0, 1.0), rotated=False, width=1):
-		self.width = width
-		self.length = length
-		self.rotated = rotated
-		self.pos = pos
-		self.color = color
-		self.shader = shader
-		self.model_matrix = model_matrix
-		self.cube = cube
-		self.height = 5.0
-	
-	def draw(self):
-		self.shader.set_material_diffuse(self.color.x, self.color.y, self.color.z)
-		self.shader.set_material_specular(0.0, 0.0, 0.0)
-
-		self.model_matrix.push_matrix()
-		
-		if self.rotated:
-			self.model_matrix.add_translation(self.pos.x - self.length / 2, self.height / 2, self.pos.z - self.width / 2)
-			self.model_matrix.add_rotation(0.0, 90.0, 0.0)
+# Maze generators. Each one takes the grid size and a numpy random
+# generator and returns the south and east walls as boolean arrays indexed
+# [row, col]. A cell's south wall is the one towards the row below it and
+# its east wall the one towards the column below it, the walls of row 0
+# and column 0 are the perimeter and always there
+
+# Recursive backtracker (a depth first search) with an explicit stack.
+# Cells are numbered on a grid with a border of visited cells around it so
+# no move needs a bounds check
+def generate_backtracker(grid_size, rng):
+	width = grid_size + 2
+	visited = bytearray(b"\x01") * (width * width)
+	for row in range(1, grid_size + 1):
+		visited[row * width + 1:row * width + 1 + grid_size] = bytes(grid_size)
+	south_walls = bytearray(b"\x01") * (width * width)
+	east_walls = bytearray(b"\x01") * (width * width)
+	picks = rng.random(grid_size * grid_size).tolist()
+	pick = 0
+
+	cell = width + 1
+	visited[cell] = 1
+	stack = [cell]
+	while stack:
+		cell = stack[-1]
+		available = []
+		if not visited[cell - 1]:
+			available.append(cell - 1)
+		if not visited[cell + 1]:
+			available.append(cell + 1)
+		if not visited[cell - width]:
+			available.append(cell - width)
+		if not visited[cell + width]:
+			available.append(cell + width)
+		if not available:
+			stack.pop()
+			continue
+
+		next_cell = available[int(picks[pick] * len(available))]
+		pick += 1
+		if next_cell == cell - 1:
+			east_walls[cell] = 0
+		elif next_cell == cell + 1:
+			east_walls[next_cell] = 0
+		elif next_cell < cell:
+			south_walls[cell] = 0
 		else:
-			self.model_matrix.add_translation(self.pos.x - self.width / 2, self.height / 2, self.pos.z - self.length / 2)
-
-		self.model_matrix.add_scale(self.width, self.height, self.length)
-		self.shader.set_model_matrix(self.model_matrix.matrix)
-		self.cube.draw()
-		self.model_matrix.pop_matrix()
+			south_walls[next_cell] = 0
+		visited[next_cell] = 1
+		stack.append(next_cell)
+
+	south_walls = numpy.frombuffer(south_walls, dtype=bool).reshape(width, width)
+	east_walls = numpy.frombuffer(east_walls, dtype=bool).reshape(width, width)
+	return south_walls[1:-1, 1:-1].copy(), east_walls[1:-1, 1:-1].copy()
+
+# Every cell opens its south or east wall at random, only one of them is
+# possible along row 0 and column 0. Long corridors along both of them
+def generate_binary_tree(grid_size, rng):
+	open_south = rng.random((grid_size, grid_size)) < 0.5
+	open_south[0, :] = False
+	open_south[:, 0] = True
+	south_walls = ~open_south
+	east_walls = open_south.copy()
+	south_walls[0, :] = True
+	east_walls[:, 0] = True
+	return south_walls, east_walls
+
+# Row 0 is one corridor, every other row is split into runs of open cells
+# at random and each run opens the south wall of one of its cells
+def generate_sidewinder(grid_size, rng):
+	close_run = rng.random((grid_size, grid_size)) < 0.5
+	close_run[:, -1] = True
+	south_walls = numpy.ones((grid_size, grid_size), dtype=bool)
+	east_walls = numpy.ones((grid_size, grid_size), dtype=bool)
+	east_walls[0, 1:] = False
+	east_walls[1:, 1:] = close_run[1:, :-1]
+
+	# Runs never cross rows since the last cell of a row always closes one
+	run_ends = numpy.flatnonzero(close_run[1:])
+	run_starts = numpy.concatenate(([0], run_ends[:-1] + 1))
+	openings = run_starts + (rng.random(len(run_starts)) * (run_ends - run_starts + 1)).astype(int)
+	south_walls[1:].reshape(-1)[openings] = False
+	return south_walls, east_walls
+
+MAZE_GENERATORS = {
+	"backtracker": generate_backtracker,
+	"binary_tree": generate_binary_tree,
+	"sidewinder": generate_sidewinder
+}
+
+# Sample points per side of a cell for the potentially visible sets, and
+# how many sight lines are tested at once
+PVS_SAMPLES = 2
+PVS_BATCH_SIZE = 1 << 17
 
 class Maze:
-	def __init__(self, shader, model_matrix, cube, player_radius, sphere, cell_width=10, grid_size=10):
+	def __init__(self, shader, model_matrix, cube, player_radius, sphere, cell_width=10, grid_size=10, algorithm="backtracker", seed=None):
 		self.shader = shader
 		self.model_matrix = model_matrix
 		self.cube = cube
 		self.cell_width = cell_width
 		self.grid_size = grid_size
 		self.size = self.grid_size * self.cell_width
-		self.maze = []
+		self.algorithm = algorithm
+		# Without a seed the maze follows the random module, like the rest of the game
+		self.seed = random.getrandbits(32) if seed == None else seed
 		self.wall_thickness = 1.0
 		self.player_radius = player_radius
-		self.collision_radius = 0
 		self.max_index = self.grid_size - 1
 		self.sphere = sphere
 		self.end_indices = [x for x in range(5, self.grid_size)]
 		self.display_radius = 3
 		self.player_row = 0
 		self.player_col = 0
+		self.wall_height = 5.0
+		self.vertex_buffer_id = None
+		self.vertex_array_id = None
+		# Wall ranges last drawn with a frustum, by player cell and which of
+		# its set's chunks were in view
+		self.culled_key = None
+		self.culled_ranges = None
+		self.cells = None
+		self.flow_cell = None
 
 		self.create_walls()
+		self.build_cell_links()
+		self.build_collision_table()
+		self.build_geometry()
+		self.build_visibility()
+		# Without a shader (e.g. in the headless simulation) nothing is uploaded
+		if self.shader != None:
+			self.set_opengl_buffers()
 	
 	def pick_end(self):
 		self.end = (random.choice(self.end_indices), random.choice(self.end_indices))
 	
-	def draw_floor(self, floor_texture):
+	def get_wall_vertices(self, rotated):
+		# Shape of every wall before it is moved into place, in the same
+		# interleaved position/normal/uv layout that is uploaded to the GPU
+		matrix = ModelMatrix()
+		if rotated:
+			matrix.add_rotation(0.0, 90.0, 0.0)
+		matrix.add_scale(self.wall_thickness, self.wall_height, self.cell_width)
+		return self.get_cube_vertices(matrix.matrix)
+
+	def get_cube_vertices(self, matrix):
+		positions, normals, uvs = self.cube.get_triangle_arrays()
+		rotation = matrix[:3, :3]
+		positions = positions @ rotation.T + matrix[:3, 3]
+		normals = normals @ rotation.T
+		normals /= numpy.linalg.norm(normals, axis=1)[:, None]
+		return numpy.hstack((positions, normals, uvs)).astype('float32')
+
+	# Every wall as an (x_min, z_min, x_max, z_max) box, and two tables of
+	# the boxes near each cell. Collisions use the boxes within a cell width
+	# of the cell, which is as far as anything inside it can reach in one
+	# move, and raycasts the boxes within a wall thickness of it
+	def build_collision_table(self):
+		wall_x, wall_z, rotated, present = self.get_walls()
+		boxes = numpy.stack((
+			wall_x - numpy.where(rotated, self.cell_width, self.wall_thickness),
+			wall_z - numpy.where(rotated, self.wall_thickness, self.cell_width),
+			wall_x,
+			wall_z
+		), axis=3)
+		self.wall_boxes = boxes[present]
+
+		# Missing walls become boxes far outside the maze
+		boxes[~present] = -self.size * 10
+		self.cell_wall_boxes = self.get_cell_box_table(boxes, self.cell_width)
+		self.cell_ray_boxes = self.get_cell_box_table(boxes, self.wall_thickness)
+
+	# The boxes within margin of each cell, stored as (cell, side, box) so
+	# each side is contiguous. Walls lie inside their own cell (give or take
+	# the 0.0001 they are moved by) so only the boxes of the 3x3 cells around
+	# a cell are looked at. Cells with fewer boxes are padded with boxes far
+	# outside the maze
+	def get_cell_box_table(self, boxes, margin):
+		padded = numpy.full((self.grid_size + 2, self.grid_size + 2) + boxes.shape[2:], -self.size * 10.0)
+		padded[1:-1, 1:-1] = boxes
+		candidates = numpy.concatenate([padded[row:row + self.grid_size, col:col + self.grid_size] for row in range(3) for col in range(3)], axis=2)
+		candidates = candidates.reshape(self.grid_size ** 2, -1, 4)
+
+		rows, cols = numpy.indices((self.grid_size, self.grid_size)).reshape(2, -1, 1) * self.cell_width
+		near = (candidates[:, :, 0] < cols + self.cell_width + margin) & (candidates[:, :, 2] > cols - margin)
+		near &= (candidates[:, :, 1] < rows + self.cell_width + margin) & (candidates[:, :, 3] > rows - margin)
+
+		counts = near.sum(axis=1)
+		width = counts.max()
+		order = numpy.argsort(~near, axis=1, kind="stable")[:, :width]
+		table = numpy.take_along_axis(candidates, order[:, :, None], axis=1)
+		table[numpy.arange(width)[None, :] >= counts[:, None]] = -self.size * 10
+		return numpy.ascontiguousarray(table.transpose(0, 2, 1))
+
+	# (x, z) of the far corner of every wall, whether it runs along x
+	# (rotated) and whether it is there, as (row, col, wall) arrays with four
+	# places for walls per cell. The outer ones make up the perimeter
+	def get_walls(self):
+		rows, cols = numpy.indices((self.grid_size, self.grid_size))
+		row_ends = (rows + 1) * self.cell_width
+		col_ends = (cols + 1) * self.cell_width
+		edge = numpy.full(rows.shape, float(self.size))
+
+		wall_x = numpy.stack((numpy.where(cols == 0, 1.0, cols * self.cell_width + self.wall_thickness - 0.0001), edge, col_ends, col_ends), axis=2)
+		wall_z = numpy.stack((row_ends, row_ends, numpy.where(rows == 0, 1.0, rows * self.cell_width + self.wall_thickness - 0.0001), edge), axis=2)
+		rotated = numpy.broadcast_to(numpy.array([False, False, True, True]), wall_x.shape)
+		present = numpy.stack(((cols == 0) | self.east_walls, cols == self.max_index, (rows == 0) | self.south_walls, rows == self.max_index), axis=2)
+		return wall_x, wall_z, rotated, present
+
+	# Bakes every wall and the floor into a single pre-transformed vertex array.
+	# Walls are stored cell by cell (row major) so any row of cells in the
+	# display radius is one contiguous range of vertices
+	def build_geometry(self):
+		wall_x, wall_z, rotated, present = self.get_walls()
+		cell_wall_counts = present.sum(axis=2).reshape(-1)
+		wall_x = wall_x[present]
+		wall_z = wall_z[present]
+		rotated = rotated[present]
+
+		translations = numpy.stack((
+			numpy.where(rotated, wall_x - self.cell_width / 2, wall_x - self.wall_thickness / 2),
+			numpy.full(len(wall_x), self.wall_height / 2),
+			numpy.where(rotated, wall_z - self.wall_thickness / 2, wall_z - self.cell_width / 2)
+		), axis=1)
+		
+		wall_shapes = numpy.stack((self.get_wall_vertices(False), self.get_wall_vertices(True)))
+		wall_vertices = wall_shapes[rotated.astype(int)]
+		wall_vertices[:, :, 0:3] += translations.astype('float32')[:, None, :]
+
+		# Each cell's walls are a chunk with a box around them for culling,
+		# cells without walls keep an empty box
+		wall_mins = wall_vertices[:, :, 0:3].min(axis=1)
+		wall_maxs = wall_vertices[:, :, 0:3].max(axis=1)
+		wall_starts = (numpy.cumsum(cell_wall_counts) - cell_wall_counts)[cell_wall_counts > 0]
+		self.chunk_mins = numpy.full((self.grid_size ** 2, 3), numpy.inf)
+		self.chunk_maxs = numpy.full((self.grid_size ** 2, 3), -numpy.inf)
+		if len(wall_starts) > 0:
+			self.chunk_mins[cell_wall_counts > 0] = numpy.minimum.reduceat(wall_mins, wall_starts)
+			self.chunk_maxs[cell_wall_counts > 0] = numpy.maximum.reduceat(wall_maxs, wall_starts)
+		wall_vertices = wall_vertices.reshape(-1, 8)
+
+		floor_matrix = ModelMatrix()
+		floor_matrix.add_translation(self.size / 2, -0.5, self.size / 2)
+		floor_matrix.add_scale(self.size, 1, self.size)
+		floor_vertices = self.get_cube_vertices(floor_matrix.matrix)
+
+		vertices_per_wall = len(wall_shapes[0])
+		self.cell_offsets = numpy.concatenate(([0], numpy.cumsum(cell_wall_counts) * vertices_per_wall))
+		self.floor_offset = len(wall_vertices)
+		self.floor_vertex_count = len(floor_vertices)
+		self.vertex_array = numpy.concatenate((wall_vertices, floor_vertices))
+
+	# The potentially visible set of every cell: the cells within the
+	# display radius that can be seen from somewhere in it. Sight lines
+	# between a grid of sample points in the open part of each cell are
+	# tested against the walls, so a cell only seen through a gap narrower
+	# than the samples can be missed. For each cell it keeps the visible
+	# cells, those plus the cells open to them (what enemies can be seen in)
+	# and the vertex ranges of the walls around the visible cells
+	def build_visibility(self):
+		reach = self.display_radius - 1
+		cells = numpy.arange(self.grid_size ** 2)
+		rows = cells // self.grid_size
+		cols = cells % self.grid_size
+
+		# Each pair of cells is tested once, from the one with the lower index.
+		# A sight line between two cells crosses a staircase of cells that
+		# are open to each other, so only pairs joined by such a staircase
+		# are tested
+		staircases = self.get_staircases(reach)
+		firsts = []
+		seconds = []
+		for (row, col), joined in staircases.items():
+			if row > 0 or col > 0:
+				firsts.append(cells[joined.reshape(-1)])
+				seconds.append(cells[joined.reshape(-1)] + row * self.grid_size + col)
+		firsts = numpy.concatenate(firsts)
+		seconds = numpy.concatenate(seconds)
+
+		samples = self.wall_thickness + (numpy.arange(PVS_SAMPLES) + 0.5) / PVS_SAMPLES * (self.cell_width - self.wall_thickness)
+		samples = numpy.stack(numpy.meshgrid(samples, samples), axis=2).reshape(-1, 2)
+		sample_pairs = numpy.indices((len(samples), len(samples))).reshape(2, -1)
+		starts = samples[sample_pairs[0]]
+		ends = samples[sample_pairs[1]]
+
+		visible = numpy.zeros(len(firsts), dtype=bool)
+		pairs_per_batch = max(PVS_BATCH_SIZE // len(starts), 1)
+		for batch in range(0, len(firsts), pairs_per_batch):
+			first = firsts[batch:batch + pairs_per_batch]
+			second = seconds[batch:batch + pairs_per_batch]
+			origins = numpy.zeros((len(first), len(starts), 3))
+			origins[:, :, 0] = (cols[first] * self.cell_width)[:, None] + starts[:, 0]
+			origins[:, :, 2] = (rows[first] * self.cell_width)[:, None] + starts[:, 1]
+			targets = numpy.zeros(origins.shape)
+			targets[:, :, 0] = (cols[second] * self.cell_width)[:, None] + ends[:, 0]
+			targets[:, :, 2] = (rows[second] * self.cell_width)[:, None] + ends[:, 1]
+			hit = self.raycast_batch(origins.reshape(-1, 3), (targets - origins).reshape(-1, 3))[0]
+			visible[batch:batch + pairs_per_batch] = ~hit.reshape(len(first), -1).all(axis=1)
+
+		firsts = firsts[visible]
+		seconds = seconds[visible]
+		self.visible_cells = self.group_cells(numpy.concatenate((cells, firsts, seconds)), numpy.concatenate((cells, seconds, firsts)))
+
+		# Enemies can stand partly in a cell open to a visible one
+		linked = numpy.array([(cell, neighbour) for cell in range(self.grid_size ** 2) for neighbour in self.cell_links[cell]], dtype=int).reshape(-1, 2)
+		pairs = [(numpy.full(len(visible_cells), cell), visible_cells) for cell, visible_cells in enumerate(self.visible_cells)]
+		owners = numpy.concatenate([pair[0] for pair in pairs])
+		seen = numpy.concatenate([pair[1] for pair in pairs])
+		link_starts = numpy.searchsorted(linked[:, 0], seen)
+		link_counts = numpy.searchsorted(linked[:, 0], seen, side="right") - link_starts
+		link_indices = numpy.repeat(link_starts, link_counts) + numpy.arange(link_counts.sum()) - numpy.repeat(numpy.cumsum(link_counts) - link_counts, link_counts)
+		self.view_cells = self.group_cells(numpy.concatenate((owners, numpy.repeat(owners, link_counts))), numpy.concatenate((seen, linked[link_indices, 1])))
+
+		# A cell's walls on its high x and z sides belong to the next cells
+		high_x = seen[(seen % self.grid_size) < self.max_index] + 1
+		high_x_owners = owners[(seen % self.grid_size) < self.max_index]
+		high_z = seen[seen < self.grid_size * self.max_index] + self.grid_size
+		high_z_owners = owners[seen < self.grid_size * self.max_index]
+		wall_cells = self.group_cells(numpy.concatenate((owners, high_x_owners, high_z_owners)), numpy.concatenate((seen, high_x, high_z)))
+
+		cell_offsets = self.cell_offsets
+		self.wall_cells = [draw_cells[cell_offsets[draw_cells + 1] > cell_offsets[draw_cells]] for draw_cells in wall_cells]
+		self.wall_ranges = [self.get_wall_ranges(draw_cells) for draw_cells in self.wall_cells]
+
+	# Vertex ranges (starts, counts) for the walls of the given sorted cells,
+	# chunks that follow each other in the vertex array are one range
+	def get_wall_ranges(self, cells):
+		if len(cells) == 0:
+			return numpy.zeros(0, dtype='int32'), numpy.zeros(0, dtype='int32')
+		starts = self.cell_offsets[cells]
+		ends = self.cell_offsets[cells + 1]
+		breaks = numpy.flatnonzero(starts[1:] != ends[:-1]) + 1
+		run_starts = starts[numpy.concatenate(([0], breaks))]
+		run_ends = ends[numpy.concatenate((breaks - 1, [len(cells) - 1]))]
+		return run_starts.astype('int32'), (run_ends - run_starts).astype('int32')
+
+	# For every offset (row, col) with 0 <= row <= reach and |col| <= reach,
+	# whether each cell is joined to the cell at that offset by a path of
+	# open cells that only steps towards it, as (row, col) arrays
+	def get_staircases(self, reach):
+		def shift(array, row, col):
+			shifted = numpy.zeros(array.shape, dtype=bool)
+			shifted[:self.grid_size - row, max(-col, 0):self.grid_size - max(col, 0)] = array[row:, max(col, 0):self.grid_size + min(col, 0)]
+			return shifted
+
+		open_down = numpy.zeros((self.grid_size, self.grid_size), dtype=bool)
+		open_down[:-1] = ~self.south_walls[1:]
+		open_right = numpy.zeros((self.grid_size, self.grid_size), dtype=bool)
+		open_right[:, :-1] = ~self.east_walls[:, 1:]
+		open_left = shift(open_right, 0, -1)
+
+		staircases = {(0, 0): numpy.ones((self.grid_size, self.grid_size), dtype=bool)}
+		for row in range(reach + 1):
+			for step in range(1, reach + 1) if row == 0 else range(reach + 1):
+				for side, open_side in ((1, open_right), (-1, open_left)):
+					col = side * step
+					if (row, col) in staircases:
+						continue
+					joined = numpy.zeros((self.grid_size, self.grid_size), dtype=bool)
+					if row > 0:
+						joined |= staircases[(row - 1, col)] & shift(open_down, row - 1, col)
+					if step > 0:
+						joined |= staircases[(row, col - side)] & shift(open_side, row, col - side)
+					staircases[(row, col)] = joined
+		return staircases
+
+	# Sorted, unique values for every owner cell from (owner, value) pairs
+	def group_cells(self, owners, values):
+		pairs = numpy.unique(owners * self.grid_size ** 2 + values)
+		bounds = numpy.searchsorted(pairs // self.grid_size ** 2, numpy.arange(self.grid_size ** 2 + 1))
+		return numpy.split(pairs % self.grid_size ** 2, bounds[1:-1])
+
+	# Which cells are in view from the player's cell, for culling enemies
+	def get_view_mask(self):
+		mask = numpy.zeros(self.grid_size ** 2, dtype=bool)
+		mask[self.view_cells[self.player_row * self.grid_size + self.player_col]] = True
+		return mask
+
+	def set_opengl_buffers(self):
+		self.vertex_buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer_id)
+		glBufferData(GL_ARRAY_BUFFER, self.vertex_array, GL_STATIC_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+		self.vertex_array_id = self.shader.create_vertex_array(self.vertex_buffer_id)
+
+	def delete_opengl_buffers(self):
+		if self.vertex_array_id != None:
+			glDeleteVertexArrays(1, [self.vertex_array_id])
+			self.vertex_array_id = None
+		if self.vertex_buffer_id != None:
+			glDeleteBuffers(1, [self.vertex_buffer_id])
+			self.vertex_buffer_id = None
+
+	def draw_floor(self, shader, floor_texture):
 		if floor_texture:
-			self.shader.set_material_diffuse(1.0, 1.0, 1.0)
+			shader.set_material_diffuse(1.0, 1.0, 1.0)
 		else:
-			self.shader.set_material_diffuse(0.0, 0.0, 0.0)
-		self.shader.set_material_specular(0.0, 0.0, 0.0)
-		self.model_matrix.push_matrix()
-		self.model_matrix.add_translation(self.size / 2, -0.5, self.size / 2)
-		self.model_matrix.add_scale(self.size, 1, self.size)
-		self.shader.set_model_matrix(self.model_matrix.matrix)
-		self.cube.draw()
-		self.model_matrix.pop_matrix()
-
-	def draw_perimeter(self):
-		for x in range(self.grid_size):
-			if abs(self.player_row - x) < self.display_radius:
-				tmp_wall = Wall(self.shader, self.model_matrix, self.cube, self.cell_width, Point(1.0, 1.0, (x + 1) * self.cell_width))
-				tmp_wall.draw()
-
-				tmp_wall.pos = Point(self.size, 1.0, (x + 1) * self.cell_width)
-				tmp_wall.draw()
-		
-		for y in range(self.grid_size):
-			if abs(self.player_col - y) < self.display_radius:
-				tmp_wall = Wall(self.shader, self.model_matrix, self.cube, self.cell_width, Point((y + 1) * self.cell_width, 1.0, 1.0), rotated=True)
-				tmp_wall.draw()
-				
-				tmp_wall.pos = Point((y + 1) * self.cell_width, 1.0, self.size)
-				tmp_wall.draw()
-
-	def draw_walls(self):
-		for y in range(len(self.maze)):
-			for x in range(len(self.maze[y])):
-				if abs(self.player_col - x) < self.display_radius and abs(self.player_row - y) < self.display_radius:
-					cell = self.maze[y][x]
-
-					if cell.east_wall and x != 0: # Don't draw walls that are outside the perimeter
-						tmp_wall = Wall(self.shader, self.model_matrix, self.cube, self.cell_width, Point(x * self.cell_width + self.wall_thickness - 0.0001, 1.0, (y + 1) * self.cell_width))
-						tmp_wall.draw()
-					if cell.south_wall and y != 0:
-						tmp_wall = Wall(self.shader, self.model_matrix, self.cube, self.cell_width, Point((x + 1) * self.cell_width, 1.0, y * self.cell_width + self.wall_thickness - 0.0001), rotated=True)
-						tmp_wall.draw()
+			shader.set_material_diffuse(0.0, 0.0, 0.0)
+		shader.set_material_specular(0.0, 0.0, 0.0)
+		glDrawArrays(GL_TRIANGLES, self.floor_offset, self.floor_vertex_count)
+
+	# Only the walls around the player's potentially visible set are drawn
+	# unless use_pvs is False, then every wall within the display radius is.
+	# With a frustum the chunks of the set outside it are dropped as well
+	def draw_walls(self, shader, use_pvs=True, frustum=None):
+		shader.set_material_diffuse(1.0, 1.0, 1.0)
+		shader.set_material_specular(0.0, 0.0, 0.0)
+
+		if use_pvs:
+			cell = self.player_row * self.grid_size + self.player_col
+			if frustum != None:
+				cells = self.wall_cells[cell]
+				in_view = frustum.test_boxes(self.chunk_mins[cells], self.chunk_maxs[cells], "chunks")
+				key = (cell, in_view.tobytes())
+				if key != self.culled_key:
+					self.culled_key = key
+					self.culled_ranges = self.get_wall_ranges(cells[in_view])
+				starts, counts = self.culled_ranges
+			else:
+				starts, counts = self.wall_ranges[cell]
+			if len(starts) > 0:
+				glMultiDrawArrays(GL_TRIANGLES, starts, counts, len(starts))
+			return
+
+		col_min = max(self.player_col - self.display_radius + 1, 0)
+		col_max = min(self.player_col + self.display_radius - 1, self.max_index)
+		row_min = max(self.player_row - self.display_radius + 1, 0)
+		row_max = min(self.player_row + self.display_radius - 1, self.max_index)
+
+		for row in range(row_min, row_max + 1):
+			start = int(self.cell_offsets[row * self.grid_size + col_min])
+			end = int(self.cell_offsets[row * self.grid_size + col_max + 1])
+			if end > start:
+				glDrawArrays(GL_TRIANGLES, start, end - start)
 	
-	def set_texture(self, tex, gl_tex, id, diffuse=True):
+	# Every wall in a single draw with the bound shader, for the minimap
+	def draw_layout(self, shader):
+		shader.set_vertex_array(self.vertex_array_id)
+		shader.set_model_matrix(IDENTITY_MATRIX)
+		shader.set_material_diffuse(1.0, 1.0, 1.0)
+		if self.floor_offset > 0:
+			glDrawArrays(GL_TRIANGLES, 0, self.floor_offset)
+
+	def set_texture(self, shader, tex, gl_tex, id, diffuse=True):
 		if tex != None:
 			glActiveTexture(gl_tex)
 			glBindTexture(GL_TEXTURE_2D, tex)
 
 			if diffuse:
-				self.shader.set_diffuse_texture(id)
+				shader.set_diffuse_texture(id)
 			else:
-				self.shader.set_normal_map_texture(id)
+				shader.set_normal_map_texture(id)
 
-	def unset_texture(self, tex, gl_tex, diffuse=True):
+	def unset_texture(self, shader, tex, gl_tex, diffuse=True):
 		if tex != None:
 			glActiveTexture(gl_tex)
 			glBindTexture(GL_TEXTURE_2D, 0)
 
 			if diffuse:
-				self.shader.set_use_diffuse_texture(False)
+				shader.set_use_diffuse_texture(False)
 			else:
-				self.shader.set_use_normal_texture(False)
-
-	def draw(self, wall_texture=None, wall_normal=None, floor_texture=None, floor_normal=None):
-		self.cube.set_vertices(self.shader)
-		self.shader.set_model_matrix(self.model_matrix.matrix)
-
-		self.set_texture(wall_texture, GL_TEXTURE1, 1)
-		self.set_texture(wall_normal, GL_TEXTURE3, 3, False)
-		self.draw_perimeter()
-		self.draw_walls()
-		self.unset_texture(wall_texture, GL_TEXTURE1)
-		self.unset_texture(wall_normal, GL_TEXTURE3, False)
-		
-		self.shader.set_light_position(Point(self.grid_size / 2 * self.cell_width, 1000.0, self.grid_size / 2 * self.cell_width))
-		
-		self.set_texture(floor_texture, GL_TEXTURE1, 1)
-		self.set_texture(floor_normal, GL_TEXTURE3, 3, False)
-		self.draw_floor(floor_texture)
-		self.unset_texture(floor_texture, GL_TEXTURE1)
-		self.unset_texture(floor_normal, GL_TEXTURE3, False)
-
-	def create_path(self, visited, x, y, num_visited, total_cells):
-		if num_visited >= total_cells - 1:
-			return
-		
-		if not self.maze[y][x].visited:
-			visited.append(self.maze[y][x])
-			self.maze[y][x].visited = True
+				shader.set_use_normal_texture(False)
 
-		available = []
+	# Draws with the maze's own shader unless another (bound) one is given
+	def draw(self, shader=None, wall_texture=None, wall_normal=None, floor_texture=None, floor_normal=None, use_pvs=True, frustum=None):
+		if shader == None:
+			shader = self.shader
+
+		shader.set_vertex_array(self.vertex_array_id)
+		shader.set_model_matrix(self.model_matrix.matrix)
 
-		if x > 0 and not self.maze[y][x - 1].visited:
-			available.append((y, x - 1, "E"))
-		if x < self.max_index and not self.maze[y][x + 1].visited:
-			available.append((y, x + 1, "W"))
-		if y > 0 and not self.maze[y - 1][x].visited:
-			available.append((y - 1, x, "S"))
-		if y < self.max_index and not self.maze[y + 1][x].visited:
-			available.append((y + 1, x, "N"))
+		self.set_texture(shader, wall_texture, GL_TEXTURE1, 1)
+		self.set_texture(shader, wall_normal, GL_TEXTURE3, 3, False)
+		self.draw_walls(shader, use_pvs, frustum)
+		self.unset_texture(shader, wall_texture, GL_TEXTURE1)
+		self.unset_texture(shader, wall_normal, GL_TEXTURE3, False)
 		
-		if len(available) == 0:
-			cell = visited.pop()
-			return self.create_path(visited, cell.x, cell.y, num_visited, total_cells)
+		shader.set_light_position(Point(self.grid_size / 2 * self.cell_width, 1000.0, self.grid_size / 2 * self.cell_width))
 		
-		pick = random.choice(available)
+		self.set_texture(shader, floor_texture, GL_TEXTURE1, 1)
+		self.set_texture(shader, floor_normal, GL_TEXTURE3, 3, False)
+		self.draw_floor(shader, floor_texture)
+		self.unset_texture(shader, floor_texture, GL_TEXTURE1)
+		self.unset_texture(shader, floor_normal, GL_TEXTURE3, False)
 
-		if pick[2] == "S":
-			self.maze[y][x].south_wall = False
-		elif pick[2] == "N":
-			self.maze[y + 1][x].south_wall = False
-		elif pick[2] == "E":
-			self.maze[y][x].east_wall = False
-		elif pick[2] == "W":
-			self.maze[y][x + 1].east_wall = False
-
-		return self.create_path(visited, pick[1], pick[0], num_visited + 1, total_cells)
+		shader.set_vertex_array(0)
 
 	def create_walls(self):
-		self.maze = [[MazeStruct(x, y) for x in range(self.grid_size)] for y in range(self.grid_size)]
-		
-		self.create_path([], 0, 0, 0, self.grid_size ** 2)
-	
-	def hit_edge(self, vel, new_pos):
-		# Edge collision x
-		if vel.x < 0.0:
-			if new_pos.x - self.collision_radius - self.wall_thickness < 0.0:
-				vel.x = 0.0
-		elif vel.x > 0.0:
-			if new_pos.x + self.collision_radius + self.wall_thickness > self.size:
-				vel.x = 0.0
-		
-		# Edge collision y
-		if vel.z < 0.0:
-			if new_pos.z - self.collision_radius - self.wall_thickness < 0.0:
-				vel.z = 0.0
-		elif vel.z > 0.0:
-			if new_pos.z + self.collision_radius + self.wall_thickness > self.size:
-				vel.z = 0.0
-		
-		return vel
-	
-	def check_hit_edge(self, vel, new_pos):
-		# Edge collision x
-		if vel.x < 0.0:
-			if new_pos.x - self.collision_radius - self.wall_thickness < 0.0:
-				return True
-		elif vel.x > 0.0:
-			if new_pos.x + self.collision_radius + self.wall_thickness > self.size:
-				return True
-		
-		# Edge collision y
-		if vel.z < 0.0:
-			if new_pos.z - self.collision_radius - self.wall_thickness < 0.0:
-				return True
-		elif vel.z > 0.0:
-			if new_pos.z + self.collision_radius + self.wall_thickness > self.size:
-				return True
-		
-		return False
-	
-	def hit_x(self, new_pos, row, bias=0):
-		player_z_min = new_pos.z - self.collision_radius
-		player_z_max = new_pos.z + self.collision_radius + self.wall_thickness
-		wall_z_min = row * self.cell_width + bias
-		wall_z_max = wall_z_min + self.wall_thickness
-
-		if (player_z_max > wall_z_min or player_z_min > wall_z_min) and (player_z_max < wall_z_max or player_z_min < wall_z_max):
-			return True
-		
-		return False
-	
-	def hit_z(self, new_pos, col, bias=0):
-		player_x_min = new_pos.x - self.collision_radius
-		player_x_max = new_pos.x + self.collision_radius + self.wall_thickness
-		wall_x_min = col * self.cell_width + bias
-		wall_x_max = wall_x_min + self.wall_thickness
-
-		if (player_x_max > wall_x_min or player_x_min > wall_x_min) and (player_x_max < wall_x_max or player_x_min < wall_x_max):
-			return True
-		
-		return False
-
-	def collision_west(self, new_pos, player_row, player_col):
-		if player_col + 1 <= self.max_index:
-			cell_west = self.maze[player_row][player_col + 1]
-			cell_south_west = self.maze[player_row - 1][player_col + 1]
-			cell_north_west = None
-			
-			if player_row + 1 <= self.max_index:
-				cell_north_west = self.maze[player_row + 1][player_col + 1]
-			
-			player_x_max = new_pos.x + self.collision_radius + self.wall_thickness + 0.1
-			wall_x_max = (player_col + 1) * self.cell_width + self.wall_thickness
-
-			if player_x_max > wall_x_max:
-				if cell_west.east_wall:
-					return True
-				if cell_north_west != None:
-					if cell_north_west.east_wall or cell_north_west.south_wall:
-						if self.hit_x(new_pos, player_row + 1, self.wall_thickness):
-							return True
-				if cell_south_west.east_wall:
-					if self.hit_x(new_pos, player_row, -self.wall_thickness):
-						return True
-				if cell_west.south_wall:
-					if self.hit_x(new_pos, player_row):
-						return True
-	
-	def collision_east(self, new_pos, player_row, player_col):
-		cell = self.maze[player_row][player_col]
-		cell_south = self.maze[player_row - 1][player_col]
-		cell_east = self.maze[player_row][player_col - 1]
-		cell_north_east = None
-		cell_north = None
-		
-		if player_row + 1 <= self.max_index:
-			cell_north = self.maze[player_row + 1][player_col]
-			cell_north_east = self.maze[player_row + 1][player_col - 1]
-		
-		player_x_min = new_pos.x - self.collision_radius - 0.1
-		wall_x_max = player_col * self.cell_width + self.wall_thickness
-		wall_x_min = player_col * self.cell_width
-
-		if player_x_min < wall_x_max:
-			if cell.east_wall:
-				return True
-			if cell_north != None:
-				if cell_north.east_wall:
-					if self.hit_x(new_pos, player_row + 1, self.wall_thickness):
-						return True
-			if cell_south.east_wall:
-				if self.hit_x(new_pos, player_row, -self.wall_thickness):
-					return True
-		if player_x_min < wall_x_min:
-			if cell_east.south_wall:
-				if self.hit_x(new_pos, player_row):
-					return True
-			if cell_north_east != None:
-				if cell_north_east.south_wall:
-					if self.hit_x(new_pos, player_row + 1, self.wall_thickness):
-						return True
-
-	def collision_north(self, new_pos, player_row, player_col):
-		if player_row + 1 <= self.max_index:
-			cell_north = self.maze[player_row + 1][player_col]
-			cell_north_east = self.maze[player_row + 1][player_col - 1]
-			cell_north_west = None
-
-			if player_col + 1 <= self.max_index:
-				cell_north_west = self.maze[player_row + 1][player_col + 1]
-
-			player_z_max = new_pos.z + self.collision_radius + self.wall_thickness + 0.1
-			wall_z_max = (player_row + 1) * self.cell_width + self.wall_thickness
-
-			if player_z_max > wall_z_max:
-				if cell_north.south_wall:
-					return True
-				if cell_north_east.south_wall:
-					if self.hit_z(new_pos, player_col, -self.wall_thickness):
-						return True
-				if cell_north_west != None:
-					if cell_north_west.south_wall or cell_north_west.east_wall:
-						if self.hit_z(new_pos, player_col + 1, self.wall_thickness):
-							return True
-				if cell_north.east_wall:
-					if self.hit_z(new_pos, player_col):
-						return True
-	
-	def collision_south(self, new_pos, player_row, player_col):
-		cell = self.maze[player_row][player_col]
-		cell_east = self.maze[player_row][player_col - 1]
-		cell_south = self.maze[player_row - 1][player_col]
-		cell_west = None
-		cell_south_west = None
-
-		if player_col + 1 <= self.max_index:
-			cell_west = self.maze[player_row][player_col + 1]
-			cell_south_west = self.maze[player_row - 1][player_col + 1]
-
-		player_z_min = new_pos.z - self.collision_radius - 0.1
-		wall_z_max = player_row * self.cell_width + self.wall_thickness
-		wall_z_min = wall_z_max - self.wall_thickness
-
-		if player_z_min < wall_z_max:
-			if cell.south_wall:
-				return True
-			if cell_west != None:
-				if cell_west.south_wall:
-					if self.hit_z(new_pos, player_col + 1, self.wall_thickness):
-						return True
-			if cell_east.south_wall:
-				if self.hit_z(new_pos, player_col, -self.wall_thickness):
-					return True
-		if player_z_min < wall_z_min:
-			if cell_south.east_wall:
-				if self.hit_z(new_pos, player_col):
-					return True
-			if cell_south_west != None:
-				if cell_south_west.east_wall:
-					if self.hit_z(new_pos, player_col + 1, self.wall_thickness):
-						return True
-
+		self.south_walls, self.east_walls = MAZE_GENERATORS[self.algorithm](self.grid_size, numpy.random.default_rng(self.seed))
+
+	# The open neighbours of every cell, by cell index (row * grid_size + col)
+	def build_cell_links(self):
+		cells = numpy.arange(self.grid_size ** 2).reshape(self.grid_size, self.grid_size)
+		self.cell_links = [[] for cell in range(self.grid_size ** 2)]
+		# A cell's east wall is towards the cell before it in the row and its
+		# south wall towards the cell before it in the column
+		open_x = ~self.east_walls[:, 1:]
+		open_z = ~self.south_walls[1:, :]
+		passages = zip(numpy.concatenate((cells[:, :-1][open_x], cells[:-1, :][open_z])).tolist(), numpy.concatenate((cells[:, 1:][open_x], cells[1:, :][open_z])).tolist())
+		for cell, neighbour in passages:
+			self.cell_links[cell].append(neighbour)
+			self.cell_links[neighbour].append(cell)
+
+	# Index of the cell of each of the (N, 3) positions
+	def get_cells(self, positions):
+		cols = numpy.clip((positions[:, 0] // self.cell_width).astype(int), 0, self.max_index)
+		rows = numpy.clip((positions[:, 2] // self.cell_width).astype(int), 0, self.max_index)
+		return rows * self.grid_size + cols
+
+	# Breadth first search through the open cells from the cell of the
+	# position. flow_distances is how many cells away from it each cell is
+	# and flow_next the cell to go to next from each cell, -1 at the target
+	# itself. Only searched again when the position moves to another cell
+	def update_flow_field(self, pos):
+		cell = self.get_cells(numpy.array([(pos.x, pos.y, pos.z)]))[0].item()
+		if cell == self.flow_cell:
+			return
+		self.flow_cell = cell
+
+		distances = [-1] * self.grid_size ** 2
+		next_cells = [-1] * self.grid_size ** 2
+		distances[cell] = 0
+		queue = [cell]
+		index = 0
+		while index < len(queue):
+			current = queue[index]
+			index += 1
+			for neighbour in self.cell_links[current]:
+				if distances[neighbour] < 0:
+					distances[neighbour] = distances[current] + 1
+					next_cells[neighbour] = current
+					queue.append(neighbour)
+
+		self.flow_distances = numpy.array(distances)
+		self.flow_next = numpy.array(next_cells)
+
+	# Where each of the (N, 3) positions should head for to reach the
+	# target of the flow field: the center of the next cell on the way, or
+	# the target position itself once in its cell or the one next to it
+	def get_flow_targets(self, positions, target):
+		next_cells = self.flow_next[self.get_cells(positions)]
+		direct = (next_cells < 0) | (next_cells == self.flow_cell)
+		targets = numpy.empty((len(positions), 3))
+		targets[:, 0] = numpy.where(direct, target.x, (next_cells % self.grid_size + 0.5) * self.cell_width)
+		targets[:, 1] = target.y
+		targets[:, 2] = numpy.where(direct, target.z, (next_cells // self.grid_size + 0.5) * self.cell_width)
+		return targets
+
+	# The walls as MazeStruct objects, [row][col], made the first time they are used
+	def get_maze(self):
+		if self.cells == None:
+			self.cells = [[MazeStruct(x, y, south, east) for x, (south, east) in enumerate(zip(south_row, east_row))] for y, (south_row, east_row) in enumerate(zip(self.south_walls.tolist(), self.east_walls.tolist()))]
+		return self.cells
+
+	maze = property(get_maze)
+
+	# Distance along one axis from each of the N coordinates to each of its
+	# K boxes, zero where the coordinate is between the box's sides
+	def get_box_gaps(self, box_min, box_max, coordinates):
+		coordinates = coordinates[:, None]
+		return numpy.maximum(numpy.maximum(box_min - coordinates, coordinates - box_max), 0.0)
+
+	# Moves N circles by their velocities one axis at a time, x first, and
+	# stops an axis if the move takes the circle into a wall or closer to
+	# one it already overlaps. Positions and velocities are (N, 3) arrays
+	# and radii one radius or N of them. Returns the allowed velocities and
+	# whether each circle hit a wall, the arguments are left unchanged
+	def collide_batch(self, positions, velocities, radii):
+		positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+		new_velocities = numpy.array(velocities, dtype=float).reshape(-1, 3)
+		radii_squared = numpy.square(radii, dtype=float)
+		if numpy.ndim(radii_squared) > 0:
+			radii_squared = radii_squared[:, None]
+
+		x = positions[:, 0]
+		z = positions[:, 2]
+		cells = numpy.minimum(numpy.maximum(z // self.cell_width, 0), self.max_index) * self.grid_size + numpy.minimum(numpy.maximum(x // self.cell_width, 0), self.max_index)
+		boxes = self.cell_wall_boxes[cells.astype(int)]
+		x_min = boxes[:, 0]
+		z_min = boxes[:, 1]
+		x_max = boxes[:, 2]
+		z_max = boxes[:, 3]
+
+		gap_x = self.get_box_gaps(x_min, x_max, x)
+		gap_z = self.get_box_gaps(z_min, z_max, z)
+		gap_z_squared = gap_z * gap_z
+		before = gap_x * gap_x + gap_z_squared
+		moved_gap_x = self.get_box_gaps(x_min, x_max, x + new_velocities[:, 0])
+		after = moved_gap_x * moved_gap_x + gap_z_squared
+		hit_x = numpy.logical_or.reduce(after < numpy.minimum(before, radii_squared), axis=1)
+		new_velocities[hit_x, 0] = 0.0
+
+		gap_x = numpy.where(hit_x[:, None], gap_x, moved_gap_x)
+		gap_x_squared = gap_x * gap_x
+		before = gap_x_squared + gap_z_squared
+		moved_gap_z = self.get_box_gaps(z_min, z_max, z + new_velocities[:, 2])
+		after = gap_x_squared + moved_gap_z * moved_gap_z
+		hit_z = numpy.logical_or.reduce(after < numpy.minimum(before, radii_squared), axis=1)
+		new_velocities[hit_z, 2] = 0.0
+
+		return new_velocities, hit_x | hit_z
+
+	# Sweeps N spheres along their segments (origins and segments are (N, 3)
+	# arrays, only x and z matter) and finds where each one first touches a
+	# wall. The grid cells along every segment are walked in order
+	# (Amanatides and Woo) and only the walls of the cells crossed are tested,
+	# all the segments in a cell step at once. Returns whether each one hit,
+	# the hit time as a fraction of the segment (1 for a miss) and the point
+	def raycast_batch(self, origins, segments, radius=0.0):
+		origins = numpy.asarray(origins, dtype=float).reshape(-1, 3)
+		segments = numpy.asarray(segments, dtype=float).reshape(-1, 3)
+		count = len(origins)
+		hit = numpy.zeros(count, dtype=bool)
+		times = numpy.ones(count)
+
+		# (x, z) of every origin and segment, axis aligned segments get a tiny
+		# component instead of dividing by zero
+		starts = origins[:, [0, 2]]
+		directions = segments[:, [0, 2]]
+		directions[directions == 0.0] = 1e-30
+		inverses = 1.0 / directions
+		forward = directions > 0
+
+		cells = numpy.clip((starts // self.cell_width).astype(int), 0, self.max_index)
+		steps = numpy.where(forward, 1, -1)
+		# Time of the next column and row boundary and between boundaries
+		next_times = ((cells + forward) * self.cell_width - starts) * inverses
+		delta_times = numpy.abs(self.cell_width * inverses)
+
+		active = numpy.arange(count)
+		while len(active) > 0:
+			boxes = self.cell_ray_boxes[cells[active, 1] * self.grid_size + cells[active, 0]]
+			active_starts = starts[active, :, None]
+			active_inverses = inverses[active, :, None]
+
+			# Slab test against every box of the cell, grown by the radius
+			near = (boxes[:, 0:2] - radius - active_starts) * active_inverses
+			far = (boxes[:, 2:4] + radius - active_starts) * active_inverses
+			enter = numpy.minimum(near, far).max(axis=1)
+			leave = numpy.maximum(near, far).min(axis=1)
+			enter = numpy.where((enter <= leave) & (leave >= 0.0), numpy.maximum(enter, 0.0), numpy.inf)
+			first = enter.min(axis=1)
+
+			# A hit counts once it is before the segment leaves the cell
+			cell_exits = next_times[active].min(axis=1)
+			found = (first <= 1.0) & (first <= cell_exits)
+			hit[active[found]] = True
+			times[active[found]] = first[found]
+
+			# The rest step to the next column or row unless the segment ends first
+			active = active[~found & (cell_exits < 1.0)]
+			axes = numpy.argmin(next_times[active], axis=1)
+			cells[active, axes] += steps[active, axes]
+			next_times[active, axes] += delta_times[active, axes]
+			active = active[numpy.all((cells[active] >= 0) & (cells[active] <= self.max_index), axis=1)]
+
+		return hit, times, origins + segments * times[:, None]
+
+	# Single circle version of collide_batch, with just_check it only
+	# returns whether the move hits a wall
 	def collide(self, pos, vel, radius=None, just_check=False):
 		if radius == None:
-			self.collision_radius = self.player_radius
-		else:
-			self.collision_radius = radius
+			radius = self.player_radius
 
-		new_pos = pos + vel
-
-		if just_check:
-			if self.check_hit_edge(vel, new_pos):
-				return True
-		
-		new_vel = self.hit_edge(vel, new_pos)
-
-		player_row = int(pos.z / self.cell_width)
-		player_col = int(pos.x / self.cell_width)
-
-		self.player_row = player_row
-		self.player_col = player_col
-
-		hit_x = False
-		hit_z = False
-
-		# Maze wall collision
-		if new_vel.x > 0.0: # Player moving west
-			hit_x = self.collision_west(new_pos, player_row, player_col)
-		elif new_vel.x < 0.0: # Player moving east
-			hit_x = self.collision_east(new_pos, player_row, player_col)
-		
-		if new_vel.z > 0.0:
-			hit_z = self.collision_north(new_pos, player_row, player_col)
-		elif new_vel.z < 0.0:
-			hit_z = self.collision_south(new_pos, player_row, player_col)
-		
+		new_velocities, hit = self.collide_batch([(pos.x, pos.y, pos.z)], [(vel.x, vel.y, vel.z)], radius)
 		if just_check:
-			if hit_x or hit_z:
-				return True
-			else:
-				return False
-
-		if hit_x:
-			new_vel.x = 0.0
-		
-		if hit_z:
-			new_vel.z = 0.0
+			return bool(hit[0])
+		return Vector(*new_velocities[0].tolist())
 
-		return new_vel
\ No newline at end of file
+	# The walls around this position are the ones drawn by draw_walls
+	def set_player_position(self, pos):
+		self.player_row = min(max(int(pos.z // self.cell_width), 0), self.max_index)
+		self.player_col = min(max(int(pos.x // self.cell_width), 0), self.max_index)
@@ -0,0 +1,126 @@
+from OpenGL.GL import *
+from math import *
+
+import numpy
+
+from Base3DObjects import *
+from Matrices import *
+
+# Texels per unit of the maze in the layout texture, which is never made
+# bigger than MINIMAP_MAX_TEXTURE_SIZE (or what the driver allows) a side
+MINIMAP_TEXELS_PER_UNIT = 16
+MINIMAP_MAX_TEXTURE_SIZE = 4096
+
+# The static layer of the minimap. Every wall of a maze is drawn once from
+# straight above into a texture when the level is made (render_layout),
+# after that each frame only draws the texture on one quad at floor height
+# under the markers, turned and moved by the minimap's own camera
+class MinimapLayer:
+	def __init__(self):
+		self.camera = Camera()
+		self.projection_matrix = ProjectionMatrix()
+		self.texture_size = 0
+		self.texture_id = None
+		self.framebuffer_id = None
+		self.vertex_buffer_id = None
+		self.vertex_array_id = None
+
+	def set_texture_size(self, size):
+		if size == self.texture_size:
+			return
+		self.delete_opengl_buffers()
+		self.texture_size = size
+
+		self.texture_id = glGenTextures(1)
+		glBindTexture(GL_TEXTURE_2D, self.texture_id)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, size, size, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+		glBindTexture(GL_TEXTURE_2D, 0)
+
+		self.framebuffer_id = glGenFramebuffers(1)
+		glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer_id)
+		glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture_id, 0)
+		glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+	def delete_opengl_buffers(self):
+		if self.framebuffer_id != None:
+			glDeleteFramebuffers(1, [self.framebuffer_id])
+			self.framebuffer_id = None
+		if self.texture_id != None:
+			glDeleteTextures([self.texture_id])
+			self.texture_id = None
+		self.texture_size = 0
+
+	# Draws the maze's walls white on the dark grey the floor's ambient light
+	# gave it into the texture, with the given shader and frame uniforms
+	# (which are left holding the layout's camera), and moves the quad over
+	# the area the texture covers. The walls only need to cover the floor,
+	# so there is no depth buffer
+	def render_layout(self, maze, shader, uniforms):
+		low = -maze.wall_thickness
+		high = maze.size + maze.wall_thickness
+		size = min(int(ceil((high - low) * MINIMAP_TEXELS_PER_UNIT)), MINIMAP_MAX_TEXTURE_SIZE, int(glGetIntegerv(GL_MAX_TEXTURE_SIZE)))
+		self.set_texture_size(size)
+
+		center = (low + high) / 2
+		self.camera.look(Point(center, 10.0, center), Point(center, 0.0, center), Vector(0, 0, -1))
+		self.projection_matrix.set_orthographic(low - center, high - center, low - center, high - center, 1.0, 20.0)
+		uniforms.set_projection_matrix(self.projection_matrix.get_matrix())
+		uniforms.set_view_matrix(self.camera.get_matrix())
+		uniforms.set_eye_position(self.camera.eye)
+		uniforms.upload()
+
+		glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer_id)
+		glViewport(0, 0, size, size)
+		glScissor(0, 0, size, size)
+		glClearColor(0.03, 0.03, 0.03, 1.0)
+		glClear(GL_COLOR_BUFFER_BIT)
+
+		shader.use()
+		shader.set_unlit(True)
+		maze.draw_layout(shader)
+		shader.set_unlit(False)
+		glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+		glBindTexture(GL_TEXTURE_2D, self.texture_id)
+		glGenerateMipmap(GL_TEXTURE_2D)
+		glBindTexture(GL_TEXTURE_2D, 0)
+
+		# The quad's uvs are where its corners landed in the texture
+		corners = numpy.array([[low, 0, low], [high, 0, low], [high, 0, high], [low, 0, low], [high, 0, high], [low, 0, high]], dtype=float)
+		matrix = numpy.reshape(self.projection_matrix.get_matrix(), (4, 4)) @ numpy.reshape(self.camera.get_matrix(), (4, 4))
+		clip = numpy.concatenate((corners, numpy.ones((6, 1))), axis=1) @ matrix.T
+		vertices = numpy.zeros((6, 8), dtype='float32')
+		vertices[:, 0:3] = corners
+		vertices[:, 4] = 1.0
+		vertices[:, 6:8] = clip[:, 0:2] / clip[:, 3:4] * 0.5 + 0.5
+		self.set_quad(shader, vertices)
+
+	def set_quad(self, shader, vertices):
+		if self.vertex_buffer_id == None:
+			self.vertex_buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer_id)
+		glBufferData(GL_ARRAY_BUFFER, vertices, GL_STATIC_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+		if self.vertex_array_id == None:
+			self.vertex_array_id = shader.create_vertex_array(self.vertex_buffer_id)
+
+	# The frame uniforms with the minimap's camera must already be uploaded
+	def draw(self, shader):
+		if self.texture_id == None:
+			return
+		shader.set_vertex_array(self.vertex_array_id)
+		shader.set_model_matrix(IDENTITY_MATRIX)
+		shader.set_material_diffuse(1.0, 1.0, 1.0)
+		shader.set_unlit(True)
+
+		glActiveTexture(GL_TEXTURE1)
+		glBindTexture(GL_TEXTURE_2D, self.texture_id)
+		shader.set_diffuse_texture(1)
+		glDrawArrays(GL_TRIANGLES, 0, 6)
+		glBindTexture(GL_TEXTURE_2D, 0)
+		shader.set_use_diffuse_texture(False)
+		shader.set_unlit(False)
@@ -0,0 +1,321 @@
+from OpenGL.GL import *
+import OpenGL.GL
+
+from collections import deque
+import csv
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import pygame
+
+from Maze import Maze
+from Shaders import Shader3D
+
+# GL functions counted every frame, by the counter they add to
+GL_COUNTERS = {
+	"draw_calls": ["glDrawArrays", "glMultiDrawArrays", "glDrawElements", "glDrawArraysInstanced", "glDrawElementsInstanced"],
+	"uniforms": ["glUniform1i", "glUniform1f", "glUniform3f", "glUniform4f", "glUniformMatrix4fv"],
+	"buffer_uploads": ["glBufferData", "glBufferSubData"],
+	"texture_binds": ["glBindTexture"],
+	"viewports": ["glViewport", "glScissor"],
+	"clears": ["glClear"]
+}
+
+# Phases timed every frame, methods of the game unless noted
+GAME_PHASES = ["update", "step", "update_enemies", "update_bullets", "draw", "draw_first_person", "draw_minimap", "draw_ui"]
+MAZE_PHASES = ["collide_batch", "draw_walls"]
+MODULE_PHASES = ["draw_enemies"] # Functions in the game's module
+
+# Kinds of objects the game's frustum tests, see Matrices.Frustum
+CULL_KINDS = ["enemies", "bullets", "chunks"]
+
+# Colours of the overlay bars, in the order of PHASES
+PHASES = GAME_PHASES + ["maze_" + name for name in MAZE_PHASES] + MODULE_PHASES + ["gc"]
+PHASE_COLORS = [
+	(1.0, 1.0, 1.0), (0.6, 0.6, 0.6), (0.9, 0.3, 0.3), (0.9, 0.6, 0.2),
+	(0.3, 0.3, 0.9), (0.2, 0.7, 0.9), (0.2, 0.9, 0.6), (0.6, 0.9, 0.2),
+	(0.9, 0.9, 0.3), (0.7, 0.3, 0.9), (0.9, 0.3, 0.7), (1.0, 0.0, 0.0)
+]
+
+# Size of the overlay's text, with one bar per line of it
+OVERLAY_FONT_SIZE = 16
+OVERLAY_LABEL_WIDTH = 170
+
+# Frames between flushes of the log files
+LOG_FLUSH_INTERVAL = 60
+
+# Toggled while the game runs, see GraphicsProgram3D.program_loop. While
+# enabled it wraps the game's phases and the GL functions every module in
+# the game folder calls (they are imported with *, so each module has its
+# own reference). Every frame is appended to <log_path>.csv and
+# <log_path>.jsonl (one JSON object per line), which are flushed every
+# LOG_FLUSH_INTERVAL frames and moved to <log_path>.1.csv/.jsonl after
+# log_length frames, so the files keep up with a run that is killed
+class Profiler:
+	def __init__(self, game, log_length=600, log_path="profile_log"):
+		self.game = game
+		self.enabled = False
+		self.counting = False
+		self.log = deque(maxlen=log_length)
+		self.log_path = log_path
+		self.csv_file = None
+		self.json_file = None
+		self.wrapped = []
+		self.font = None
+		self.text_texture_id = None
+		self.text_framebuffer_id = None
+		self.reset_frame()
+
+	def reset_frame(self):
+		self.phase_times = dict([(phase, 0.0) for phase in PHASES])
+		self.counters = dict([(counter, 0) for counter in GL_COUNTERS])
+		self.gc_collections = 0
+
+	def toggle(self):
+		if self.enabled:
+			self.disable()
+		else:
+			self.enable()
+
+	def enable(self):
+		if self.enabled:
+			return
+		self.enabled = True
+
+		for name in GAME_PHASES:
+			self.wrap(self.game, name, self.time_phase(name, getattr(self.game, name)))
+		for name in MAZE_PHASES:
+			self.wrap(Maze, name, self.time_phase("maze_" + name, getattr(Maze, name)))
+		game_module = sys.modules[self.game.__class__.__module__]
+		for name in MODULE_PHASES:
+			self.wrap(game_module, name, self.time_phase(name, getattr(game_module, name)))
+
+		for module in self.get_game_modules():
+			for counter, names in GL_COUNTERS.items():
+				for name in names:
+					if getattr(module, name, None) is getattr(OpenGL.GL, name):
+						self.wrap(module, name, self.count_calls(counter, getattr(module, name)))
+
+		gc.callbacks.append(self.on_gc)
+		self.gc_start = None
+		self.frame_start = None
+
+		# Tracing every allocation slows the game down, so it only runs
+		# while the profiler is on
+		self.started_tracing = not tracemalloc.is_tracing()
+		if self.started_tracing:
+			tracemalloc.start()
+		self.open_log_files()
+
+	def disable(self):
+		if not self.enabled:
+			return
+		self.enabled = False
+
+		for target, name, original, replaced in self.wrapped[::-1]:
+			if replaced:
+				setattr(target, name, original)
+			else:
+				delattr(target, name)
+		self.wrapped = []
+		gc.callbacks.remove(self.on_gc)
+		if self.started_tracing:
+			tracemalloc.stop()
+		self.delete_text_buffers()
+		self.close_log_files()
+
+	def get_shaders(self):
+		return [value for value in vars(self.game).values() if isinstance(value, Shader3D)]
+
+	def get_game_modules(self):
+		folder = os.path.dirname(os.path.abspath(__file__))
+		modules = []
+		for module in list(sys.modules.values()):
+			path = getattr(module, "__file__", None)
+			if module is sys.modules[__name__] or path == None:
+				continue
+			if os.path.dirname(os.path.abspath(path)) == folder:
+				modules.append(module)
+		return modules
+
+	# Instance attributes are removed again instead of restored, so the
+	# class methods show through
+	def wrap(self, target, name, func):
+		replaced = name in vars(target)
+		self.wrapped.append((target, name, getattr(target, name), replaced))
+		setattr(target, name, func)
+
+	def time_phase(self, phase, func):
+		def timed(*args, **kwargs):
+			start = time.perf_counter()
+			result = func(*args, **kwargs)
+			self.phase_times[phase] += time.perf_counter() - start
+			return result
+		return timed
+
+	def count_calls(self, counter, func):
+		def counted(*args, **kwargs):
+			if self.counting:
+				self.counters[counter] += 1
+			return func(*args, **kwargs)
+		return counted
+
+	def on_gc(self, phase, info):
+		if phase == "start":
+			self.gc_start = time.perf_counter()
+		elif self.gc_start != None:
+			self.phase_times["gc"] += time.perf_counter() - self.gc_start
+			self.gc_collections += 1
+			self.gc_start = None
+
+	def begin_frame(self):
+		if not self.enabled:
+			return
+		self.reset_frame()
+		self.counting = True
+		self.frame_start = time.perf_counter()
+		tracemalloc.reset_peak()
+		self.traced_start = tracemalloc.get_traced_memory()[0]
+		for shader in self.get_shaders():
+			shader.reset_uniform_counters()
+
+	def end_frame(self):
+		if not self.enabled or self.frame_start == None:
+			return
+		self.counting = False
+		# The peak counts memory that was allocated and freed again during
+		# the frame, which the difference at the end of it doesn't show
+		traced, traced_peak = tracemalloc.get_traced_memory()
+		frame = {
+			"frame_ms": (time.perf_counter() - self.frame_start) * 1000,
+			"allocated_kb": (traced_peak - self.traced_start) / 1024,
+			"retained_kb": (traced - self.traced_start) / 1024,
+			"gc_collections": self.gc_collections
+		}
+		for phase in PHASES:
+			frame[phase + "_ms"] = self.phase_times[phase] * 1000
+		frame.update(self.counters)
+		# Uniforms the shaders sent, and the ones they skipped because the
+		# location already had the value
+		shaders = self.get_shaders()
+		frame["uniform_updates"] = sum([shader.uniform_updates for shader in shaders])
+		frame["uniform_updates_skipped"] = sum([shader.uniform_updates_skipped for shader in shaders])
+		cull_counts = self.game.frustum.counts
+		for kind in CULL_KINDS:
+			frame[kind + "_visible"], frame[kind + "_culled"] = cull_counts.get(kind, (0, 0))
+		self.log.append(frame)
+		self.write_log(frame)
+
+	# Horizontal bars for the phases of the last frame, 10 pixels per
+	# millisecond with a marker at 60 fps, each after a label with its time,
+	# and the frame's counters under them. Bars are scissored clears like the
+	# HUD and the text is blitted from a texture, neither is counted
+	def draw_overlay(self, width, height):
+		if len(self.log) == 0:
+			return
+		frame = self.log[-1]
+		counting = self.counting
+		self.counting = False
+
+		if self.font == None:
+			pygame.font.init()
+			self.font = pygame.font.Font(None, OVERLAY_FONT_SIZE)
+		row_height = self.font.get_linesize()
+		bar_height = row_height - 4
+		pixels_per_ms = 10
+		top = height - 220
+		left = 5 + OVERLAY_LABEL_WIDTH
+
+		# The text's background goes under the bars
+		lines = [f'{phase} {frame[phase + "_ms"]:.2f} ms' for phase in PHASES]
+		lines.append(f'frame {frame["frame_ms"]:.2f} ms')
+		lines.append(" ".join([f'{counter} {frame[counter]}' for counter in GL_COUNTERS]))
+		lines.append(f'shader uniforms sent {frame["uniform_updates"]} skipped {frame["uniform_updates_skipped"]}')
+		lines.append(" ".join([f'{kind} {frame[kind + "_visible"]}/{frame[kind + "_visible"] + frame[kind + "_culled"]}' for kind in CULL_KINDS]))
+		lines.append(f'allocated {frame["allocated_kb"]:.1f} kB retained {frame["retained_kb"]:+.1f} kB gc {frame["gc_collections"]}')
+		self.draw_text(lines, 5, top, row_height, width)
+
+		glClearColor(0.5, 0.5, 0.5, 1.0)
+		glViewport(left + int(1000 / 60 * pixels_per_ms), top - len(PHASES) * row_height, 1, len(PHASES) * row_height)
+		glScissor(left + int(1000 / 60 * pixels_per_ms), top - len(PHASES) * row_height, 1, len(PHASES) * row_height)
+		glClear(GL_COLOR_BUFFER_BIT)
+
+		for i in range(len(PHASES)):
+			bar_width = min(int(frame[PHASES[i] + "_ms"] * pixels_per_ms), width - left - 5)
+			if bar_width <= 0:
+				continue
+			color = PHASE_COLORS[i]
+			glClearColor(color[0], color[1], color[2], 1.0)
+			glViewport(left, top - (i + 1) * row_height + 2, bar_width, bar_height)
+			glScissor(left, top - (i + 1) * row_height + 2, bar_width, bar_height)
+			glClear(GL_COLOR_BUFFER_BIT)
+
+
+		self.counting = counting
+
+	# Renders the lines into a texture and copies it to the window with its
+	# top left corner at (x, y), one line every row_height pixels
+	def draw_text(self, lines, x, y, row_height, width):
+		surfaces = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+		text_width = min(max([surface.get_width() for surface in surfaces]), width - x)
+		text_height = row_height * len(lines)
+		text = pygame.Surface((text_width, text_height))
+		for i in range(len(surfaces)):
+			text.blit(surfaces[i], (0, i * row_height))
+		pixels = pygame.image.tostring(text, "RGBA", True)
+
+		if self.text_texture_id == None:
+			self.text_texture_id = glGenTextures(1)
+			self.text_framebuffer_id = glGenFramebuffers(1)
+		glBindTexture(GL_TEXTURE_2D, self.text_texture_id)
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, text_width, text_height, 0, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+		glBindTexture(GL_TEXTURE_2D, 0)
+
+		glBindFramebuffer(GL_READ_FRAMEBUFFER, self.text_framebuffer_id)
+		glFramebufferTexture2D(GL_READ_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.text_texture_id, 0)
+		glViewport(x, y - text_height, text_width, text_height)
+		glScissor(x, y - text_height, text_width, text_height)
+		glBlitFramebuffer(0, 0, text_width, text_height, x, y - text_height, x + text_width, y, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+		glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+
+	def delete_text_buffers(self):
+		if self.text_framebuffer_id != None:
+			glDeleteFramebuffers(1, [self.text_framebuffer_id])
+			glDeleteTextures([self.text_texture_id])
+			self.text_framebuffer_id = None
+			self.text_texture_id = None
+
+	def open_log_files(self):
+		self.csv_file = open(self.log_path + ".csv", "w", newline="")
+		self.csv_writer = None
+		self.json_file = open(self.log_path + ".jsonl", "w")
+		self.logged_frames = 0
+
+	def close_log_files(self):
+		if self.csv_file != None:
+			self.csv_file.close()
+			self.json_file.close()
+			self.csv_file = None
+			self.json_file = None
+
+	def write_log(self, frame):
+		if self.logged_frames == self.log.maxlen:
+			self.close_log_files()
+			for extension in [".csv", ".jsonl"]:
+				os.replace(self.log_path + extension, self.log_path + ".1" + extension)
+			self.open_log_files()
+
+		if self.csv_writer == None:
+			self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=list(frame.keys()))
+			self.csv_writer.writeheader()
+		self.csv_writer.writerow(frame)
+		self.json_file.write(json.dumps(frame) + "\n")
+		self.logged_frames += 1
+
+		if self.logged_frames % LOG_FLUSH_INTERVAL == 0:
+			self.csv_file.flush()
+			self.json_file.flush()
@@ -3,9 +3,18 @@ from OpenGL.GLU import *
 from math import * # trigonometry
 
 import sys
+import numpy
 
 from Base3DObjects import *
 
+POSITION_LOCATION = 0
+NORMAL_LOCATION = 1
+UV_LOCATION = 2
+INSTANCE_MATRIX_LOCATION = 3 # A mat4 takes up locations 3 to 6
+INSTANCE_HEALTH_LOCATION = 7
+INSTANCE_COLOR_LOCATION = 8
+FRAME_BLOCK_BINDING = 0
+
 class Shader3D:
 	def __init__(self):
 		vert_shader = glCreateShader(GL_VERTEX_SHADER)
@@ -29,6 +38,14 @@ class Shader3D:
 		self.renderingProgramID = glCreateProgram()
 		glAttachShader(self.renderingProgramID, vert_shader)
 		glAttachShader(self.renderingProgramID, frag_shader)
+
+		# Fixed attribute locations so vertex array objects work with every program
+		glBindAttribLocation(self.renderingProgramID, POSITION_LOCATION, "a_position")
+		glBindAttribLocation(self.renderingProgramID, NORMAL_LOCATION, "a_normal")
+		glBindAttribLocation(self.renderingProgramID, UV_LOCATION, "a_uv")
+		glBindAttribLocation(self.renderingProgramID, INSTANCE_MATRIX_LOCATION, "a_instance_matrix")
+		glBindAttribLocation(self.renderingProgramID, INSTANCE_HEALTH_LOCATION, "a_instance_health")
+		glBindAttribLocation(self.renderingProgramID, INSTANCE_COLOR_LOCATION, "a_instance_color")
 		glLinkProgram(self.renderingProgramID)
 
 		self.positionLoc = glGetAttribLocation(self.renderingProgramID, "a_position")
@@ -40,15 +57,13 @@ class Shader3D:
 		self.uvLoc = glGetAttribLocation(self.renderingProgramID, "a_uv")
 		glEnableVertexAttribArray(self.uvLoc)
 
-		self.modelMatrixLoc = glGetUniformLocation(self.renderingProgramID, "u_model_matrix")
-		self.viewMatrixLoc = glGetUniformLocation(self.renderingProgramID, "u_view_matrix")
-		self.projectionMatrixLoc = glGetUniformLocation(self.renderingProgramID, "u_projection_matrix")
+		# Camera, projection, light colour, fog and player health come from the
+		# FrameData block which every program reads from the same binding point
+		self.frameBlockIndex = glGetUniformBlockIndex(self.renderingProgramID, "FrameData")
+		glUniformBlockBinding(self.renderingProgramID, self.frameBlockIndex, FRAME_BLOCK_BINDING)
 
-		self.eyePosLoc = glGetUniformLocation(self.renderingProgramID, "u_eye_position")
-		
+		self.modelMatrixLoc = glGetUniformLocation(self.renderingProgramID, "u_model_matrix")
 		self.lightPosLoc = glGetUniformLocation(self.renderingProgramID, "u_light_position")
-		self.lightDiffuseLoc = glGetUniformLocation(self.renderingProgramID, "u_light_diffuse")
-		self.lightSpecularLoc = glGetUniformLocation(self.renderingProgramID, "u_light_specular")
 		
 		self.matDiffuseLoc = glGetUniformLocation(self.renderingProgramID, "u_mat_diffuse")
 		self.matSpecularLoc = glGetUniformLocation(self.renderingProgramID, "u_mat_specular")
@@ -59,11 +74,17 @@ class Shader3D:
 		self.useDiffuseTextureLoc = glGetUniformLocation(self.renderingProgramID, "u_use_diffuse_tex")
 		self.useNormalTextureLoc = glGetUniformLocation(self.renderingProgramID, "u_use_normal_tex")
 
-		self.useFogLoc = glGetUniformLocation(self.renderingProgramID, "u_use_fog")
-		self.fogMaxDistLoc = glGetUniformLocation(self.renderingProgramID, "u_fog_max_dist")
-		self.fogMinDistLoc = glGetUniformLocation(self.renderingProgramID, "u_fog_min_dist")
+		self.useInstancingLoc = glGetUniformLocation(self.renderingProgramID, "u_use_instancing")
+		self.healthBarLoc = glGetUniformLocation(self.renderingProgramID, "u_health_bar")
+		self.unlitLoc = glGetUniformLocation(self.renderingProgramID, "u_unlit")
+		self.useInstanceColorLoc = glGetUniformLocation(self.renderingProgramID, "u_use_instance_color")
 
-		self.playerHealthLoc = glGetUniformLocation(self.renderingProgramID, "u_player_health")
+		# Shadow copy of the values last sent to each uniform location of this
+		# program, so setting a uniform to the value it already has is skipped
+		self.uniform_values = dict()
+		self.uniform_matrices = dict()
+		self.uniform_updates = 0
+		self.uniform_updates_skipped = 0
 
 	def use(self):
 		try:
@@ -72,44 +93,81 @@ class Shader3D:
 			print(glGetProgramInfoLog(self.renderingProgramID))
 			raise
 
-	def set_model_matrix(self, matrix_array):
-		glUniformMatrix4fv(self.modelMatrixLoc, 1, True, matrix_array)
-	
-	def set_view_matrix(self, matrix_array):
-		glUniformMatrix4fv(self.viewMatrixLoc, 1, True, matrix_array)
+	def uniform_changed(self, location, value):
+		if location == -1:
+			return False
+		if self.uniform_values.get(location) == value:
+			self.uniform_updates_skipped += 1
+			return False
+		self.uniform_values[location] = value
+		self.uniform_updates += 1
+		return True
 
-	def set_projection_matrix(self, matrix_array):
-		glUniformMatrix4fv(self.projectionMatrixLoc, 1, True, matrix_array)
+	def set_uniform_1i(self, location, val):
+		if self.uniform_changed(location, int(val)):
+			glUniform1i(location, val)
 
-	def set_eye_position(self, pos):
-		glUniform4f(self.eyePosLoc, pos.x, pos.y, pos.z, 1.0)
+	def set_uniform_1f(self, location, val):
+		if self.uniform_changed(location, val):
+			glUniform1f(location, val)
 
-	def set_light_position(self, pos):
-		glUniform4f(self.lightPosLoc, pos.x, pos.y, pos.z, 1.0)
-	
-	def set_light_diffuse(self, red, green, blue):
-		glUniform4f(self.lightDiffuseLoc, red, green, blue, 1.0)
+	def set_uniform_4f(self, location, x, y, z, w):
+		if self.uniform_changed(location, (x, y, z, w)):
+			glUniform4f(location, x, y, z, w)
 
-	def set_light_specular(self, red, green, blue):
-		glUniform4f(self.lightSpecularLoc, red, green, blue, 1.0)
+	# Matrices are compared by value since ModelMatrix changes its array in
+	# place, against a float32 copy kept per location that is updated in place
+	def set_uniform_matrix(self, location, matrix_array):
+		if location == -1:
+			return
+		matrix = numpy.asarray(matrix_array, dtype=numpy.float32)
+		shadow = self.uniform_matrices.get(location)
+		if shadow is None:
+			self.uniform_matrices[location] = matrix.copy()
+		elif numpy.array_equal(shadow, matrix):
+			self.uniform_updates_skipped += 1
+			return
+		else:
+			numpy.copyto(shadow, matrix)
+		self.uniform_updates += 1
+		glUniformMatrix4fv(location, 1, True, matrix_array)
+
+	def reset_uniform_counters(self):
+		self.uniform_updates = 0
+		self.uniform_updates_skipped = 0
+
+	def set_model_matrix(self, matrix_array):
+		self.set_uniform_matrix(self.modelMatrixLoc, matrix_array)
+
+	def set_light_position(self, pos):
+		self.set_uniform_4f(self.lightPosLoc, pos.x, pos.y, pos.z, 1.0)
 	
 	def set_material_diffuse(self, red, green, blue):
-		glUniform4f(self.matDiffuseLoc, red, green, blue, 1.0)
+		self.set_uniform_4f(self.matDiffuseLoc, red, green, blue, 1.0)
 	
 	def set_material_diffuse_color(self, color):
-		glUniform4f(self.matDiffuseLoc, color.r, color.g, color.b, 1.0)
+		self.set_uniform_4f(self.matDiffuseLoc, color.r, color.g, color.b, 1.0)
 
 	def set_material_specular(self, red, green, blue):
-		glUniform4f(self.matSpecularLoc, red, green, blue, 1.0)
+		self.set_uniform_4f(self.matSpecularLoc, red, green, blue, 1.0)
 		
 	def set_material_specular_color(self, color):
-		glUniform4f(self.matSpecularLoc, color.r, color.g, color.b, 1.0)
+		self.set_uniform_4f(self.matSpecularLoc, color.r, color.g, color.b, 1.0)
 		
 	def set_material_shininess(self, shininess):
-		glUniform1f(self.matShininessLoc, shininess)
+		self.set_uniform_1f(self.matShininessLoc, shininess)
 	
-	def set_player_health(self, val):
-		glUniform1f(self.playerHealthLoc, val)
+	def set_use_instancing(self, val):
+		self.set_uniform_1i(self.useInstancingLoc, val)
+
+	def set_health_bar(self, val):
+		self.set_uniform_1i(self.healthBarLoc, val)
+
+	def set_unlit(self, val):
+		self.set_uniform_1i(self.unlitLoc, val)
+
+	def set_use_instance_color(self, val):
+		self.set_uniform_1i(self.useInstanceColorLoc, val)
 
 	def set_position_attribute(self, vertex_array):
 		glVertexAttribPointer(self.positionLoc, 3, GL_FLOAT, False, 0, vertex_array)
@@ -122,28 +180,117 @@ class Shader3D:
 	
 	def set_diffuse_texture(self, tex):
 		self.set_use_diffuse_texture(True)
-		glUniform1i(self.diffuseTextureLoc, tex)
+		self.set_uniform_1i(self.diffuseTextureLoc, tex)
 	
 	def set_normal_map_texture(self, tex):
 		self.set_use_normal_texture(True)
-		glUniform1i(self.normalMapTextureLoc, tex)
+		self.set_uniform_1i(self.normalMapTextureLoc, tex)
 
 	def set_use_diffuse_texture(self, val):
-		glUniform1i(self.useDiffuseTextureLoc, val)
+		self.set_uniform_1i(self.useDiffuseTextureLoc, val)
 	
 	def set_use_normal_texture(self, val):
-		glUniform1i(self.useNormalTextureLoc, val)
+		self.set_uniform_1i(self.useNormalTextureLoc, val)
 	
 	def set_attribute_buffers(self, vertex_buffer_id):
 		glBindBuffer(GL_ARRAY_BUFFER, vertex_buffer_id)
 		glVertexAttribPointer(self.positionLoc, 3, GL_FLOAT, False, 6 * sizeof(GLfloat), OpenGL.GLU.ctypes.c_void_p(0))
 		glVertexAttribPointer(self.normalLoc, 3, GL_FLOAT, False, 6 * sizeof(GLfloat), OpenGL.GLU.ctypes.c_void_p(3 * sizeof(GLfloat)))
 
-	def set_fog_max_distance(self, distance):
-		glUniform1f(self.fogMaxDistLoc, distance)
-	
-	def set_fog_min_distance(self, distance):
-		glUniform1f(self.fogMinDistLoc, distance)
-	
+	# Records the layout of an interleaved vertex buffer (stride and offsets
+	# counted in floats) into a vertex array object, so drawing only needs
+	# a single set_vertex_array call. Leave uv_offset as None if there are no uvs
+	# and instance_buffer_id as None if the geometry is never drawn instanced.
+	# An index buffer given here is used by glDrawElements while the array is bound
+	def create_vertex_array(self, vertex_buffer_id, stride=8, normal_offset=3, uv_offset=6, instance_buffer_id=None, index_buffer_id=None):
+		vertex_array_id = glGenVertexArrays(1)
+		glBindVertexArray(vertex_array_id)
+		glBindBuffer(GL_ARRAY_BUFFER, vertex_buffer_id)
+
+		glEnableVertexAttribArray(self.positionLoc)
+		glVertexAttribPointer(self.positionLoc, 3, GL_FLOAT, False, stride * sizeof(GLfloat), OpenGL.GLU.ctypes.c_void_p(0))
+		glEnableVertexAttribArray(self.normalLoc)
+		glVertexAttribPointer(self.normalLoc, 3, GL_FLOAT, False, stride * sizeof(GLfloat), OpenGL.GLU.ctypes.c_void_p(normal_offset * sizeof(GLfloat)))
+
+		if uv_offset != None:
+			glEnableVertexAttribArray(self.uvLoc)
+			glVertexAttribPointer(self.uvLoc, 2, GL_FLOAT, False, stride * sizeof(GLfloat), OpenGL.GLU.ctypes.c_void_p(uv_offset * sizeof(GLfloat)))
+
+		if instance_buffer_id != None:
+			self.set_instance_attributes(instance_buffer_id)
+
+		if index_buffer_id != None:
+			glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_buffer_id)
+
+		glBindVertexArray(0)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+		return vertex_array_id
+
+	# Per instance model matrix (stored column by column) followed by the
+	# health fraction and colour
+	def set_instance_attributes(self, instance_buffer_id):
+		stride = INSTANCE_FLOATS * sizeof(GLfloat)
+		glBindBuffer(GL_ARRAY_BUFFER, instance_buffer_id)
+
+		for column in range(4):
+			location = INSTANCE_MATRIX_LOCATION + column
+			glEnableVertexAttribArray(location)
+			glVertexAttribPointer(location, 4, GL_FLOAT, False, stride, OpenGL.GLU.ctypes.c_void_p(column * 4 * sizeof(GLfloat)))
+			glVertexAttribDivisor(location, 1)
+
+		glEnableVertexAttribArray(INSTANCE_HEALTH_LOCATION)
+		glVertexAttribPointer(INSTANCE_HEALTH_LOCATION, 1, GL_FLOAT, False, stride, OpenGL.GLU.ctypes.c_void_p(16 * sizeof(GLfloat)))
+		glVertexAttribDivisor(INSTANCE_HEALTH_LOCATION, 1)
+
+		glEnableVertexAttribArray(INSTANCE_COLOR_LOCATION)
+		glVertexAttribPointer(INSTANCE_COLOR_LOCATION, 3, GL_FLOAT, False, stride, OpenGL.GLU.ctypes.c_void_p(17 * sizeof(GLfloat)))
+		glVertexAttribDivisor(INSTANCE_COLOR_LOCATION, 1)
+
+	def set_vertex_array(self, vertex_array_id):
+		glBindVertexArray(vertex_array_id)
+
+# Holds the per view state of the FrameData uniform block (std140 layout).
+# The setters only write into a CPU side copy, upload() sends all of it in
+# a single buffer write and binds it for every program using the block
+class FrameUniforms:
+	def __init__(self):
+		self.data = numpy.zeros(48, dtype=numpy.float32)
+		self.int_data = self.data.view(numpy.int32)
+
+		self.buffer_id = glGenBuffers(1)
+		glBindBuffer(GL_UNIFORM_BUFFER, self.buffer_id)
+		glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+		glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+	def set_view_matrix(self, matrix_array):
+		self.data[0:16] = numpy.ravel(matrix_array)
+
+	def set_projection_matrix(self, matrix_array):
+		self.data[16:32] = numpy.ravel(matrix_array)
+
+	def set_eye_position(self, pos):
+		self.data[32:36] = (pos.x, pos.y, pos.z, 1.0)
+
+	def set_light_diffuse(self, red, green, blue):
+		self.data[36:40] = (red, green, blue, 1.0)
+
+	def set_light_specular(self, red, green, blue):
+		self.data[40:44] = (red, green, blue, 1.0)
+
+	def set_player_health(self, val):
+		self.data[44] = val
+
 	def set_use_fog(self, fog):
-		glUniform1i(self.useFogLoc, fog)
\ No newline at end of file
+		self.int_data[45] = fog
+
+	def set_fog_min_distance(self, distance):
+		self.data[46] = distance
+
+	def set_fog_max_distance(self, distance):
+		self.data[47] = distance
+
+	def upload(self):
+		glBindBuffer(GL_UNIFORM_BUFFER, self.buffer_id)
+		glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+		glBindBuffer(GL_UNIFORM_BUFFER, 0)
+		glBindBufferBase(GL_UNIFORM_BUFFER, FRAME_BLOCK_BINDING, self.buffer_id)
@@ -0,0 +1,331 @@
+from math import *
+from random import choice, seed
+import sys
+import time
+
+import numpy
+
+from Matrices import *
+from Maze import *
+from Entities import *
+
+from Helpers import look_at
+
+class PlayerInput:
+	def __init__(self, forward=False, left=False, back=False, right=False, shooting=False, reload=False, mouse_x=0):
+		self.forward = forward
+		self.left = left
+		self.back = back
+		self.right = right
+		self.shooting = shooting
+		self.reload = reload
+		self.mouse_x = mouse_x
+
+# All of the gameplay state and logic, without a window, OpenGL or audio.
+# GraphicsProgram3D builds on this and fills in the hooks (on_shoot,
+# on_reload, on_maze_created) to play sounds and update the renderer
+class Simulation:
+	def __init__(self, maze_seed=None):
+		self.init_variables()
+		self.maze_seed = maze_seed
+		self.init_matrices()
+		self.init_shooting_vars()
+		self.init_cameras()
+		self.init_objects()
+
+	def init_variables(self):
+		self.far = 90
+		self.player_start = Point(5, 2, 5)
+		self.player_look_start = Point(10, 2, 5)
+		self.player_rot = Vector(0, 0, 0)
+		self.up = Vector(0, 1, 0)
+		self.angle = 0
+		self.speed = 12.0
+		self.health = 100
+		self.bullet_damage = 25
+		self.last_hit = 0.0
+		self.regen_start = 3
+		self.regen_interval = 0.5
+		self.regen_amount = 3
+		self.last_regen = self.regen_interval
+		self.player_radius = 1.55
+		self.num_enemies = 30
+		self.enemy_health = 100
+		self.boss_health = 750 # Increased by 250 every time the player beats a level, including the first level so this will start at 1000
+		self.boss_figth = False
+		self.maze = None
+		self.maze_grid_size = 10
+		self.boss_maze_grid_size = 5
+		self.maze_algorithm = "backtracker" # One of MAZE_GENERATORS
+		# With a seed the nth maze made uses maze_seed + n, so a run's levels
+		# can be made again. Without one they follow the random module
+		self.maze_seed = None
+		self.mazes_created = 0
+		self.shader = None # No shader means the maze isn't uploaded to the GPU
+		self.mouse_x = 0
+		self.player_input = PlayerInput()
+
+	def init_matrices(self):
+		self.model_matrix = ModelMatrix()
+
+	def init_cameras(self):
+		self.fp_camera = Camera()
+		self.fp_camera.look(self.player_start, self.player_look_start, self.up)
+
+	def init_objects(self):
+		self.cube = Cube()
+		self.sphere = Sphere()
+		self.obj_enemy = None
+		self.obj_boss = None
+		self.generate_maze()
+
+	def init_shooting_vars(self):
+		self.shooting = False
+		self.fire_rate = 800 / 60
+		self.last_known_fired = 0
+		self.shots_fired = 0
+		self.bullets = BulletSystem()
+		self.bullet_scale = 0.03
+		self.reload_time = 1.7
+		self.reloading = False
+
+	def init_enemies(self):
+		min_cell = 1
+		max_cell = self.maze.grid_size
+		available_cells = [[x, y] for y in range(min_cell, max_cell + 1) for x in range(min_cell, max_cell + 1)]
+		available_cells.pop(available_cells.index([1, 1]))
+		available_cells.pop(available_cells.index([1, 2]))
+		available_cells.pop(available_cells.index([2, 1]))
+		available_cells.pop(available_cells.index([2, 2]))
+		cell_width = self.maze.cell_width
+
+		self.enemies = []
+		self.enemy_batch = EnemyBatch()
+		for i in range(self.num_enemies):
+			if len(available_cells) == 0:
+				break
+
+			# Pick a random row an column from the available ones
+			cell = choice(available_cells)
+
+			# Remove the picked row and column from the available ones
+			available_cells.pop(available_cells.index(cell))
+
+			# Create the enemy and put them in the enemy list
+			tmp_enemy = Enemy(self.maze, Point(cell[0] * cell_width - cell_width / 2, 0, cell[1] * cell_width - cell_width / 2), self.obj_enemy, health=self.enemy_health, speed=8, batch=self.enemy_batch)
+			tmp_enemy.dist = tmp_enemy.get_distance_to(self.fp_camera.eye)
+			self.enemies.append(tmp_enemy)
+
+		self.build_enemy_grid()
+
+	def build_enemy_grid(self):
+		self.enemy_grid = EnemyGrid(self.maze.cell_width)
+		for e in self.enemies:
+			self.enemy_grid.add(e)
+
+	def create_maze(self, cell_width, grid_size):
+		if self.maze != None:
+			self.maze.delete_opengl_buffers()
+		maze_seed = None if self.maze_seed == None else self.maze_seed + self.mazes_created
+		self.mazes_created += 1
+		self.maze = Maze(self.shader, self.model_matrix, Cube(cell_width), self.player_radius, self.sphere, cell_width, grid_size, self.maze_algorithm, maze_seed)
+		self.far = cell_width * (self.maze.display_radius - 1)
+		self.on_maze_created()
+
+	def generate_maze(self):
+		self.boss_figth = False
+		self.create_maze(10, self.maze_grid_size)
+		self.init_enemies()
+
+	def generate_boss_maze(self):
+		self.boss_figth = True
+
+		boss_maze_cell_width = 20
+		boss_maze_grid_size = self.boss_maze_grid_size
+		boss_radius = 2
+
+		self.create_maze(boss_maze_cell_width, boss_maze_grid_size)
+
+		boss_location = boss_maze_cell_width * boss_maze_grid_size / 2 - boss_maze_cell_width
+
+		self.enemy_batch = EnemyBatch()
+		self.enemies = [
+			Enemy(self.maze, Point(boss_location, 0, boss_location), self.obj_boss, health=self.boss_health, collision_radius=boss_radius, speed=6, hit_cooldown=2, damage=50, health_bar_offset=6, batch=self.enemy_batch)
+		]
+
+		for i in range(ceil(self.num_enemies / 3)):
+			self.enemies.append(Enemy(self.maze, Point(boss_location + (random() - 0.5) * 16, 0, boss_location + (random() - 0.5) * 16), self.obj_enemy, health=self.enemy_health, speed=8, batch=self.enemy_batch))
+
+		self.build_enemy_grid()
+
+	def increase_difficulty(self):
+		if self.boss_figth:
+			self.num_enemies += 2
+			self.enemy_health += self.bullet_damage
+		else:
+			self.boss_health += 250
+
+	def reset(self):
+		self.fp_camera.eye = self.player_start
+		self.fp_camera.look(self.fp_camera.eye, self.player_look_start, self.up)
+		self.health = 100
+		self.last_hit = 0.0
+		self.enemies_killed = 0
+
+		if self.boss_figth:
+			self.generate_maze()
+		else:
+			self.generate_boss_maze()
+
+		self.init_shooting_vars()
+
+	# Hooks for the game to react to, they do nothing in the simulation
+	def on_maze_created(self):
+		pass
+
+	def on_shoot(self):
+		pass
+
+	def on_reload(self):
+		pass
+
+	def reload_gun(self):
+		self.on_reload()
+		self.shots_fired = 30
+		self.shooting = False
+		self.last_known_fired = -self.reload_time
+		self.reloading = True
+
+	def update_bullets(self, delta_time):
+		self.last_known_fired += delta_time
+
+		if self.shooting:
+			if self.last_known_fired > 1.0 / self.fire_rate:
+				self.shots_fired += 1
+				bullet_pos = Point(self.fp_camera.eye.x, self.fp_camera.eye.y - 0.3, self.fp_camera.eye.z) + self.fp_camera.get_velocity(Vector(0, 0, -2))
+				bullet_look_pos = bullet_pos + self.fp_camera.get_velocity(Vector(0, 0, -1))
+				bullet_vel = self.fp_camera.get_velocity(Vector(0, 0, -1))
+				self.bullets.spawn(bullet_pos, look_at(bullet_pos, bullet_look_pos), bullet_vel, self.bullet_damage)
+				self.last_known_fired = 0.0
+				self.on_shoot()
+
+		if self.reloading:
+			if self.last_known_fired > 0:
+				self.shots_fired = 0
+				self.reloading = False
+
+		if (self.shots_fired >= 30 or (self.player_input.reload and self.shots_fired > 0)) and not self.reloading:
+			self.reload_gun()
+
+		bullets = self.bullets
+		if len(bullets) == 0:
+			return
+
+		# Walls are checked along the whole path of the bullet this tick
+		hit = self.maze.raycast_batch(bullets.positions[:len(bullets)], bullets.velocities[:len(bullets)] * (bullets.speed * delta_time), self.bullet_scale)[0]
+
+		killed = False
+		for index, e in bullets.collide_enemies(self.enemy_grid):
+			# Already killed by an earlier bullet this tick
+			if not e.alive:
+				continue
+			e.health -= int(bullets.damage[index])
+
+			if e.health <= 0:
+				e.alive = False
+				self.enemy_grid.remove(e)
+				killed = True
+
+			hit[index] = True
+
+		if killed:
+			self.enemies = [e for e in self.enemies if e.alive]
+
+			print(f"Remaining enemies: {len(self.enemies)}")
+
+			if len(self.enemies) == 0:
+				self.increase_difficulty()
+				self.reset()
+				return
+
+		bullets.alive[:len(bullets)] = ~hit
+		bullets.move(delta_time)
+		bullets.compact()
+
+	def update_enemies(self, delta_time):
+		self.maze.update_flow_field(self.fp_camera.eye)
+		for e in self.enemy_batch.update(delta_time, self.fp_camera.eye, self.far, self.maze):
+			self.health -= e.damage
+			self.last_hit = 0.0
+
+			if self.health <= 0:
+				self.boss_figth = not self.boss_figth
+				self.reset()
+				return
+
+	# Advances the game by delta_time seconds with the given input
+	def step(self, delta_time, player_input):
+		self.player_input = player_input
+		player_velocity = Vector(0, 0, 0)
+
+		self.angle += pi * delta_time
+		if self.angle > 2 * pi:
+			self.angle -= (2 * pi)
+
+		if player_input.forward:
+			player_velocity.z -= self.speed * delta_time
+		if player_input.left:
+			player_velocity.x -= self.speed * delta_time
+		if player_input.back:
+			player_velocity.z += self.speed * delta_time
+		if player_input.right:
+			player_velocity.x += self.speed * delta_time
+
+		self.shooting = player_input.shooting
+
+		self.last_hit += delta_time
+		if self.health < 100:
+			if self.last_hit > self.regen_start:
+				self.last_regen += delta_time
+				if self.last_regen > self.regen_interval:
+					self.last_regen = 0.0
+					self.health += self.regen_amount
+					if self.health > 100:
+						self.health = 100
+
+		# Enemy update
+		self.update_enemies(delta_time)
+
+		self.update_bullets(delta_time)
+
+		new_vel = self.maze.collide(self.fp_camera.eye, self.fp_camera.get_velocity(player_velocity))
+		if new_vel == None:
+			self.fp_camera.eye = self.player_start.copy()
+		else:
+			self.fp_camera.move(new_vel)
+		self.maze.set_player_position(self.fp_camera.eye)
+
+		# Use mouse movement to look around
+		self.mouse_x = -player_input.mouse_x
+		self.fp_camera.yaw(self.mouse_x * 0.1 * delta_time)
+
+# Runs the game without a window, e.g. python Simulation.py 10000 0.016 1
+# for 10000 ticks of 16 ms with random seed 1 (also the maze seed). The
+# player walks forward, keeps shooting and turns now and then
+if __name__ == "__main__":
+	ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	delta_time = float(sys.argv[2]) if len(sys.argv) > 2 else 1 / 60
+	maze_seed = None
+	if len(sys.argv) > 3:
+		maze_seed = int(sys.argv[3])
+		seed(maze_seed)
+
+	simulation = Simulation(maze_seed)
+	start = time.perf_counter()
+	for tick in range(ticks):
+		mouse_x = 40 if tick % 120 < 20 else 0
+		simulation.step(delta_time, PlayerInput(forward=True, shooting=True, mouse_x=mouse_x))
+	elapsed = time.perf_counter() - start
+
+	print(f"{ticks} ticks in {elapsed:.2f} s, {ticks / elapsed:.0f} ticks per second")
+	print(f"Enemies: {len(simulation.enemies)} Bullets: {len(simulation.bullets)} Health: {simulation.health}")
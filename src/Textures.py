@@ -0,0 +1,142 @@
+from OpenGL.GL import *
+
+import json
+import os
+import struct
+
+import numpy
+import pygame
+
+from obj_3D_loading import get_file_stamp, is_file_unchanged
+
+# Decoded textures are stored next to the image as <name>.png.texcache,
+# laid out like the mesh cache: magic, version and header length, then a
+# JSON header with the source stamp and the size and offset of every mip
+# level, then the raw RGBA bytes of all levels starting at an aligned offset
+TEXTURE_CACHE_MAGIC = b"TGTC"
+TEXTURE_CACHE_VERSION = 1
+TEXTURE_CACHE_EXTENSION = ".texcache"
+TEXTURE_CACHE_PREFIX = struct.Struct("<4sII")
+TEXTURE_CACHE_ALIGNMENT = 16
+
+def decode_image(path_string):
+	surface = pygame.image.load(path_string)
+	width = surface.get_width()
+	height = surface.get_height()
+	# Flipped so the first row is the bottom of the image, like OpenGL expects
+	pixels = numpy.frombuffer(pygame.image.tostring(surface, "RGBA", 1), dtype="uint8")
+	return pixels.reshape(height, width, 4)
+
+# Halves the image with a 2x2 box filter, an axis that is already 1 pixel
+# wide is left alone
+def downsample(pixels):
+	height, width = pixels.shape[:2]
+	summed = pixels.astype("uint16")
+	count = 1
+	if height > 1:
+		rows = height // 2 * 2
+		summed = summed[0:rows:2] + summed[1:rows:2]
+		count *= 2
+	if width > 1:
+		columns = width // 2 * 2
+		summed = summed[:, 0:columns:2] + summed[:, 1:columns:2]
+		count *= 2
+	return ((summed + count // 2) // count).astype("uint8")
+
+def build_mip_chain(pixels):
+	levels = [pixels]
+	while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+		levels.append(downsample(levels[-1]))
+	return levels
+
+def write_texture_cache(cache_path, levels, source):
+	level_info = []
+	offset = 0
+	for level in levels:
+		level_info.append({"width": level.shape[1], "height": level.shape[0], "offset": offset})
+		offset += level.nbytes
+
+	header = json.dumps({"sources": [source], "levels": level_info}).encode("utf-8")
+	data_offset = TEXTURE_CACHE_PREFIX.size + len(header)
+	padding = -data_offset % TEXTURE_CACHE_ALIGNMENT
+
+	try:
+		fout = open(cache_path + ".tmp", "wb")
+		fout.write(TEXTURE_CACHE_PREFIX.pack(TEXTURE_CACHE_MAGIC, TEXTURE_CACHE_VERSION, len(header) + padding))
+		fout.write(header + b" " * padding)
+		for level in levels:
+			fout.write(numpy.ascontiguousarray(level).tobytes())
+		fout.close()
+		os.replace(cache_path + ".tmp", cache_path)
+	except OSError as error:
+		print("Couldn't write texture cache " + cache_path + ": " + str(error))
+
+# Returns None if there is no usable cache for the image
+def read_texture_cache(cache_path, file_location):
+	try:
+		fin = open(cache_path, "rb")
+	except OSError:
+		return None
+	prefix = fin.read(TEXTURE_CACHE_PREFIX.size)
+	if len(prefix) != TEXTURE_CACHE_PREFIX.size:
+		fin.close()
+		return None
+	magic, version, header_length = TEXTURE_CACHE_PREFIX.unpack(prefix)
+	if magic != TEXTURE_CACHE_MAGIC or version != TEXTURE_CACHE_VERSION:
+		fin.close()
+		return None
+	header = json.loads(fin.read(header_length).decode("utf-8"))
+	fin.close()
+
+	for stamp in header["sources"]:
+		if not is_file_unchanged(file_location, stamp):
+			return None
+
+	# Every level is a view into the same memory map, nothing is copied
+	# until the driver reads it in glTexImage2D
+	data_offset = TEXTURE_CACHE_PREFIX.size + header_length
+	data = numpy.memmap(cache_path, dtype="uint8", mode="r", offset=data_offset)
+	levels = []
+	for level in header["levels"]:
+		size = level["width"] * level["height"] * 4
+		levels.append(data[level["offset"]:level["offset"] + size].reshape(level["height"], level["width"], 4))
+	return levels
+
+# Returns the full mip chain of the image, from the cache if it is up to date
+def load_texture_data(path_string, use_cache=True):
+	file_location, file_name = os.path.split(path_string)
+	cache_path = path_string + TEXTURE_CACHE_EXTENSION
+	levels = None
+
+	if use_cache:
+		levels = read_texture_cache(cache_path, file_location)
+
+	if levels == None:
+		levels = build_mip_chain(decode_image(path_string))
+		if use_cache:
+			write_texture_cache(cache_path, levels, get_file_stamp(file_location, file_name))
+	return levels
+
+# Needs the GL context. With compress=True the driver is asked to store the
+# texture in a compressed sRGB format, which uses less memory and bandwidth
+# when sampling at the cost of some quality
+def upload_texture(levels, compress=False):
+	tex_id = glGenTextures(1)
+	glBindTexture(GL_TEXTURE_2D, tex_id)
+
+	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+
+	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, 0)
+	glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+
+	internal_format = GL_COMPRESSED_SRGB_ALPHA if compress else GL_SRGB_ALPHA
+	glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+	for level, pixels in enumerate(levels):
+		glTexImage2D(GL_TEXTURE_2D, level, internal_format, pixels.shape[1], pixels.shape[0], 0, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+	glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+
+	glBindTexture(GL_TEXTURE_2D, 0)
+	return tex_id
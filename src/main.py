@@ -1,47 +1,63 @@
 from math import *
-from random import choice
 
+import numpy
 import pygame
 from pygame.locals import *
 
 import pyglet.gl
 
 from Shaders import *
-from Matrices import *
-from Maze import *
-from Entities import *
+from Simulation import *
 
-import obj_3D_loading
+from Assets import AssetLoader
+from Minimap import MinimapLayer
+from Profiler import Profiler
 
 from Helpers import look_at
 
-class GraphicsProgram3D:
-	def __init__(self):
-		self.init_pygame()
+class GraphicsProgram3D(Simulation):
+	# The window fills the screen unless a size is given, audio=False skips
+	# loading and playing sounds (for benchmarks and machines without audio)
+	def __init__(self, width=None, height=None, audio=True, maze_seed=None):
+		self.audio = audio
+		self.init_pygame(width, height)
 		self.init_variables()
+		self.maze_seed = maze_seed
 		self.init_matrices()
 		self.init_shooting_vars()
 		self.init_input()
 		self.init_shaders()
-		self.init_textures()
 		self.init_cameras()
+		self.init_assets()
 		self.init_objects()
 		self.init_opengl()
+		self.profiler = Profiler(self)
 
 	def init_shaders(self):
 		self.shader = Shader3D()
 		self.shader_td = Shader3D()
 
+		# Per view state for the first person view and the minimap
+		self.fp_uniforms = FrameUniforms()
+		self.td_uniforms = FrameUniforms()
+
+		self.td_uniforms.set_light_specular(0.0, 0.0, 0.0)
+		self.td_uniforms.set_light_diffuse(1.0, 1.0, 1.0)
+		self.td_uniforms.set_use_fog(False)
+		self.td_uniforms.set_player_health(100)
+
+		self.fp_uniforms.set_light_diffuse(1.0, 1.0, 1.0)
+		self.fp_uniforms.set_light_specular(1.0, 1.0, 1.0)
+		self.fp_uniforms.set_use_fog(True)
+
 		self.shader_td.use()
-		self.shader_td.set_light_specular(0.0, 0.0, 0.0)
 		self.shader_td.set_material_specular(0.0, 0.0, 0.0)
 		self.shader_td.set_material_shininess(0)
 
 		self.shader.use()
+		self.minimap_layer = MinimapLayer()
 	
 	def init_input(self):
-		self.speed = 12.0
-
 		self.W_key_down = False
 		self.A_key_down = False
 		self.S_key_down = False
@@ -61,39 +77,22 @@ class GraphicsProgram3D:
 		self.td_y = self.height - self.td_height
 
 	def init_variables(self):
+		Simulation.init_variables(self)
 		self.fov = pi / 3
 		self.aspect = self.width / self.height
 		self.near = 0.1
-		self.far = 90
-		self.player_start = Point(5, 2, 5)
-		self.player_look_start = Point(10, 2, 5)
-		self.player_rot = Vector(0, 0, 0)
-		self.up = Vector(0, 1, 0)
-		self.angle = 0
 		self.clear_color = 0.1
-		self.health = 100
-		self.bullet_damage = 25
-		self.last_hit = 0.0
-		self.regen_start = 3
-		self.regen_interval = 0.5
-		self.regen_amount = 3
-		self.last_regen = self.regen_interval
-		self.player_radius = 1.55
-		self.num_enemies = 30
-		self.enemy_health = 100
-		self.boss_health = 750 # Increased by 250 every time the player beats a level, including the first level so this will start at 1000
-		self.boss_figth = False
-		self.mouse_x = 0
+		self.compress_textures = False
 		self.gun_rotation = 0
 		self.gun_reload_rotation = 0
 		
 		self.init_top_down()
 	
-	def init_pygame(self):
+	def init_pygame(self, width=None, height=None):
 		pygame.init()
 		display_info = pygame.display.Info() 
-		self.width = display_info.current_w
-		self.height = display_info.current_h
+		self.width = display_info.current_w if width == None else width
+		self.height = display_info.current_h if height == None else height
 		pygame.display.set_mode((self.width, self.height), pygame.OPENGL|pygame.DOUBLEBUF)
 		pygame.mouse.set_visible(False)
 		pygame.event.set_grab(True)
@@ -102,306 +101,87 @@ class GraphicsProgram3D:
 		self.clock.tick()
 
 	def init_cameras(self):
-		self.fp_camera = Camera()
-		self.fp_camera.look(self.player_start, self.player_look_start, self.up)
+		Simulation.init_cameras(self)
 		self.td_camera = Camera()
 	
 	def init_matrices(self):
-		self.model_matrix = ModelMatrix()
+		Simulation.init_matrices(self)
 		self.projection_matrix = ProjectionMatrix()
 		self.projection_matrix.set_perspective(self.fov, self.aspect, self.near, self.far)
+		self.frustum = Frustum()
 
-	def init_enemies(self):
-		min_cell = 1
-		max_cell = 10
-		available_cells = [[x, y] for y in range(min_cell, max_cell + 1) for x in range(min_cell, max_cell + 1)]
-		available_cells.pop(available_cells.index([1, 1]))
-		available_cells.pop(available_cells.index([1, 2]))
-		available_cells.pop(available_cells.index([2, 1]))
-		available_cells.pop(available_cells.index([2, 2]))
-		cell_width = self.maze.cell_width
-
-		self.enemies = []
+	def init_assets(self):
+		# Textures, models and sounds are decoded on worker threads while
+		# the cube and sphere are set up here
+		self.textures_folder = "textures/"
+		loader = AssetLoader()
+		loader.add_texture("wall_texture", self.textures_folder + "brickwall.png", self.compress_textures)
+		loader.add_texture("wall_normal_map", self.textures_folder + "brickwall_normal.png", self.compress_textures)
+		loader.add_texture("floor_texture", self.textures_folder + "floor.png", self.compress_textures)
+		loader.add_texture("floor_normal_map", self.textures_folder + "floor_normal.png", self.compress_textures)
+		loader.add_model("obj_enemy", "Models", "enemy.obj", lods=True)
+		loader.add_model("obj_gun", "Models", "gun.obj")
+		loader.add_model("obj_boss", "Models", "bigboss.obj", lods=True)
+		if self.audio:
+			loader.add_sound("sound_main_theme", "sounds/maintheme.mp3")
+			loader.add_sound("sound_shoot", "sounds/shoot.wav")
+			loader.add_sound("sound_reload", "sounds/reload.wav")
 
-		for _ in range(self.num_enemies):
-			if len(available_cells) == 0:
-				break
-			
-			# Pick a random row an column from the available ones
-			cell = choice(available_cells)
+		self.cube = Cube()
+		self.sphere = Sphere()
 
-			# Remove the picked row and column from the available ones
-			available_cells.pop(available_cells.index(cell))
+		assets = loader.finish()
+		loader.print_timings()
+		self.wall_texture = assets["wall_texture"]
+		self.wall_normal_map = assets["wall_normal_map"]
+		self.floor_texture = assets["floor_texture"]
+		self.floor_normal_map = assets["floor_normal_map"]
+		self.obj_enemy = assets["obj_enemy"]
+		self.obj_gun = assets["obj_gun"]
+		self.obj_boss = assets["obj_boss"]
+		if self.audio:
+			self.sound_main_theme = assets["sound_main_theme"]
+			self.sound_shoot = assets["sound_shoot"]
+			self.sound_reload = assets["sound_reload"]
 
-			# Create the enemy and put them in the enemy list
-			tmp_enemy = Enemy(self.maze, self.model_matrix, Point(cell[0] * cell_width - cell_width / 2, 0, cell[1] * cell_width - cell_width / 2), self.obj_enemy, health=self.enemy_health, speed=8)
-			tmp_enemy.dist = tmp_enemy.get_distance_to(self.fp_camera.eye)
-			self.enemies.append(tmp_enemy)
-	
 	def init_objects(self):
-		self.cube = Cube()
-		self.sphere = Sphere()
-		self.obj_enemy = obj_3D_loading.load_obj_file("models", "enemy.obj")
-		self.obj_gun = obj_3D_loading.load_obj_file("models", "gun.obj")
-		self.obj_boss = obj_3D_loading.load_obj_file("models", "bigboss.obj")
-		self.sound_main_theme = pyglet.media.load("sounds/maintheme.mp3", streaming=False)
-		self.sound_shoot = pyglet.media.load("sounds/shoot.wav", streaming=False)
-		self.sound_reload = pyglet.media.load("sounds/reload.wav", streaming=False)
-		self.sound_shoot.volume = 0.5
-		self.sound_shoot.loop = False
-		self.sound_reload.volume = 0.4
-		self.sound_reload.loop = False
-		self.sound_main_theme.loop = True
-		self.sound_main_theme.play()
+		if self.audio:
+			self.sound_shoot.volume = 0.5
+			self.sound_shoot.loop = False
+			self.sound_reload.volume = 0.4
+			self.sound_reload.loop = False
+			self.sound_main_theme.loop = True
+			self.sound_main_theme.play()
 		self.generate_maze()
 
 	def init_opengl(self):
 		glEnable(GL_DEPTH_TEST)
 		glEnable(GL_SCISSOR_TEST) # For multiple viewports
-	
-	def init_shooting_vars(self):
-		self.shooting = False
-		self.fire_rate = 800 / 60
-		self.last_known_fired = 0
-		self.shots_fired = 0
-		self.bullet_list = []
-		self.bullet_scale = 0.03
-		self.reload_time = 1.7
-		self.reloading = False
-	
-	def init_textures(self):
-		self.textures_folder = "textures/"
-		self.wall_texture = self.load_texture("brickwall.png")
-		self.wall_normal_map = self.load_texture("brickwall_normal.png")
-		self.floor_texture = self.load_texture("floor.png")
-		self.floor_normal_map = self.load_texture("floor_normal.png")
-
-	def load_texture(self, path_string):
-		surface = pygame.image.load(self.textures_folder + path_string)
-		tex_string = pygame.image.tostring(surface, "RGBA", 1)
-		width = surface.get_width()
-		height = surface.get_height()
-		tex_id = glGenTextures(1)
-		glBindTexture(GL_TEXTURE_2D, tex_id)
-		
-		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-
-		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-
-		glTexImage2D(GL_TEXTURE_2D, 0, GL_SRGB_ALPHA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, tex_string)
-		return tex_id
 
-	def generate_maze(self):
-		self.boss_figth = False
+	def on_maze_created(self):
+		cell_width = self.maze.cell_width
+		self.fp_uniforms.set_fog_min_distance(cell_width * (self.maze.display_radius - 1.5))
+		self.fp_uniforms.set_fog_max_distance(self.far)
+		self.minimap_layer.render_layout(self.maze, self.shader_td, self.td_uniforms)
 
-		maze_cell_width = 10
-		maze_grid_size = 10
-		maze_cube = Cube(maze_cell_width)
+	def on_shoot(self):
+		if self.audio:
+			self.sound_shoot.play()
 
-		self.maze = Maze(self.shader, self.model_matrix, maze_cube, self.player_radius, self.sphere, maze_cell_width, maze_grid_size)
+	def on_reload(self):
+		if self.audio:
+			self.sound_reload.play()
 	
-		self.far = maze_cell_width * (self.maze.display_radius - 1)
-
-		self.shader.set_fog_min_distance(maze_cell_width * (self.maze.display_radius - 1.5))
-		self.shader.set_fog_max_distance(self.far)
-
-		self.init_enemies()
-
-	def generate_boss_maze(self):
-		self.boss_figth = True
-
-		boss_maze_cell_width = 20
-		boss_maze_grid_size = 5
-		boss_maze_cube = Cube(boss_maze_cell_width)
-		boss_radius = 2
-		
-		self.maze = Maze(self.shader, self.model_matrix, boss_maze_cube, self.player_radius, self.sphere, boss_maze_cell_width, boss_maze_grid_size)
-
-		self.far = boss_maze_cell_width * (self.maze.display_radius - 1)
-
-		self.shader.set_fog_min_distance(boss_maze_cell_width * (self.maze.display_radius - 1.5))
-		self.shader.set_fog_max_distance(self.far)
-
-		boss_location = boss_maze_cell_width * boss_maze_grid_size / 2 - boss_maze_cell_width
-
-		self.enemies = [
-			Enemy(self.maze, self.model_matrix, Point(boss_location, 0, boss_location), self.obj_boss, health=self.boss_health, collision_radius=boss_radius, speed=6, hit_cooldown=2, damage=50, health_bar_offset=6)
-		]
-
-		for i in range(ceil(self.num_enemies / 3)):
-			self.enemies.append(Enemy(self.maze, self.model_matrix, Point(boss_location + (random() - 0.5) * 16, 0, boss_location + (random() - 0.5) * 16), self.obj_enemy, health=self.enemy_health, speed=8))
-
-	def increase_difficulty(self):
-		if self.boss_figth:
-			self.num_enemies += 2
-			self.enemy_health += self.bullet_damage
-		else:
-			self.boss_health += 250
-
-	def reset(self):
-		self.fp_camera.eye = self.player_start
-		self.fp_camera.look(self.fp_camera.eye, self.player_look_start, self.up)
-		self.health = 100
-		self.last_hit = 0.0
-		self.enemies_killed = 0
-		
-		if self.boss_figth:
-			self.generate_maze()
-		else:
-			self.generate_boss_maze()
-		
-		self.init_shooting_vars()
-
-	def reload_gun(self):
-		self.sound_reload.play()
-		self.shots_fired = 30
-		self.shooting = False
-		self.last_known_fired = -self.reload_time
-		self.reloading = True
-
-	def update_bullets(self, delta_time):
-		self.last_known_fired += delta_time
-		
-		if self.shooting:
-			if self.last_known_fired > 1.0 / self.fire_rate:
-				self.shots_fired += 1
-				bullet_pos = Point(self.fp_camera.eye.x, self.fp_camera.eye.y - 0.3, self.fp_camera.eye.z) + self.fp_camera.get_velocity(Vector(0, 0, -2))
-				bullet_look_pos = bullet_pos + self.fp_camera.get_velocity(Vector(0, 0, -1))
-				bullet_vel = self.fp_camera.get_velocity(Vector(0, 0, -1))
-				bullet = Bullet(bullet_pos, look_at(bullet_pos, bullet_look_pos), bullet_vel, self.bullet_damage)
-				self.bullet_list.append(bullet)
-				self.last_known_fired = 0.0
-				self.sound_shoot.play()
-		
-		if self.reloading:
-			if self.last_known_fired > 0:
-				self.shots_fired = 0
-				self.reloading = False
-
-		if (self.shots_fired >= 30 or (self.R_key_down and self.shots_fired > 0)) and not self.reloading:
-			self.reload_gun()
-		
-		if len(self.bullet_list) > 30:
-			self.bullet_list.pop(0)
-		
-		index = 0
-		bullets_to_remove = []
-		for b in self.bullet_list:
-			enemies_to_remove = []
-			hit = self.maze.collide(Point(b.x, b.y, b.z), b.velocity, self.bullet_scale, True)
-			enemy_index = 0
-			for e in self.enemies:
-				if (b.position - e.pos).__len__() < e.collision_radius:
-					e.health -= b.damage
-					
-					if e.health <= 0:
-						self.enemies[enemy_index].alive = False
-						enemies_to_remove.append(enemy_index)
-					
-					hit = True
-				enemy_index += 1
-			
-			if len(enemies_to_remove) > 0:
-				for e in enemies_to_remove[::-1]:
-					self.enemies.pop(e)
-
-				print(f"Remaining enemies: {len(self.enemies)}")
-				
-				if len(self.enemies) == 0:
-					self.increase_difficulty()
-					self.reset()
-
-			if hit:
-				bullets_to_remove.append(index)
-			else:
-				b.move(delta_time)
-			index += 1
-
-		if len(bullets_to_remove) > 0 and len(self.bullet_list) > 0:
-			for b in bullets_to_remove[::-1]:
-				try:
-					self.bullet_list.pop(b)
-				except:
-					pass
-
-	def check_enemy(self, enemy, calc_dist=False):
-		if enemy == None:
-			return False
-		
-		if not enemy.alive:
-			return False
-		
-		if calc_dist:
-			enemy.dist = enemy.get_distance_to(self.fp_camera.eye)
-		
-		if enemy.dist > self.far:
-			return False
-
-		return True
-
-	def update_enemies(self, delta_time):
-		for e in self.enemies:
-			if not self.check_enemy(e, True):
-				continue
-			
-			#e.dist = e.get_distance_to(self.fp_camera.eye)
-			
-			e.update(delta_time, self.fp_camera.eye)
-			if e.dist < e.collision_radius and e.last_known_hit > e.hit_cooldown:
-				e.last_known_hit = 0.0
-				self.health -= e.damage
-				self.last_hit = 0.0
-
-				if self.health <= 0:
-					self.boss_figth = not self.boss_figth
-					self.reset()
-
 	def update(self):
 		delta_time = self.clock.tick() / 1000.0
 		mouse_movement = pygame.mouse.get_rel()
-		player_velocity = Vector(0, 0, 0)
 
 		pygame.display.set_caption(f'{self.clock.get_fps() :.1f}')
 
-		self.angle += pi * delta_time
-		if self.angle > 2 * pi:
-			self.angle -= (2 * pi)
-
-		if self.W_key_down:
-			player_velocity.z -= self.speed * delta_time
-		if self.A_key_down:
-			player_velocity.x -= self.speed * delta_time
-		if self.S_key_down:
-			player_velocity.z += self.speed * delta_time
-		if self.D_key_down:
-			player_velocity.x += self.speed * delta_time
-		
-		self.shooting = pygame.mouse.get_pressed()[0]
-		
-		self.last_hit += delta_time
-		if self.health < 100:
-			if self.last_hit > self.regen_start:
-				self.last_regen += delta_time
-				if self.last_regen > self.regen_interval:
-					self.last_regen = 0.0
-					self.health += self.regen_amount
-					if self.health > 100:
-						self.health = 100
-
-		# Enemy update
-		self.update_enemies(delta_time)
-
-		self.update_bullets(delta_time)
-
-		new_vel = self.maze.collide(self.fp_camera.eye, self.fp_camera.get_velocity(player_velocity))
-		if new_vel == None:
-			self.fp_camera.eye = self.player_start
-		else:
-			self.fp_camera.move(new_vel)
+		player_input = PlayerInput(self.W_key_down, self.A_key_down, self.S_key_down, self.D_key_down, pygame.mouse.get_pressed()[0], self.R_key_down, mouse_movement[0])
+		self.step(delta_time, player_input)
 
-		# Use mouse movement to look around
+		# Gun sway and reload animation
 		if self.reloading:
 			self.gun_reload_rotation = sin(((-self.last_known_fired / self.reload_time) * 2) * pi / 2)
 		
@@ -416,30 +196,13 @@ class GraphicsProgram3D:
 		else:
 			self.gun_rotation = 0
 		
-		self.mouse_x = -mouse_movement[0]
 		self.gun_rotation += self.mouse_x * delta_time * 10
-		self.fp_camera.yaw(self.mouse_x * 0.1 * delta_time)
-
-	def draw_cube(self, x, y, z, scale):
-		self.shader.set_use_diffuse_texture(False)
-		self.model_matrix.push_matrix()
-		self.model_matrix.add_translation(x, y, z)
-		self.model_matrix.add_scale(scale, scale, scale)
-		self.shader.set_model_matrix(self.model_matrix.matrix)
-		self.cube.draw()
-		self.model_matrix.pop_matrix()
 
 	def draw_bullets(self):
-		for i in self.bullet_list:
-			self.shader.set_material_diffuse(0.8, 0.5, 0.2)
-			self.model_matrix.push_matrix()
-			self.model_matrix.add_translation(i.x, i.y, i.z)
-			self.model_matrix.add_rotation_y(i.rotation)
-			self.model_matrix.add_scale(self.bullet_scale, self.bullet_scale, self.bullet_scale)
-			self.shader.set_model_matrix(self.model_matrix.matrix)
-			self.cube.set_vertices(self.shader)
-			self.cube.draw()
-			self.model_matrix.pop_matrix()
+		count = len(self.bullets)
+		visible = self.frustum.test_spheres(self.bullets.positions[:count], self.bullet_scale * sqrt(3) / 2, "bullets")
+		self.shader.set_material_diffuse(0.8, 0.5, 0.2)
+		self.cube.draw_instanced(self.shader, build_model_matrices(self.bullets.positions[:count][visible], self.bullets.rotations[:count][visible], self.bullet_scale))
 
 	def draw_minimap(self):
 		if not self.TAB_key_down:
@@ -455,45 +218,32 @@ class GraphicsProgram3D:
 		eye = Point(self.fp_camera.eye.x, 10.0, self.fp_camera.eye.z)
 		self.td_camera.look(eye, self.fp_camera.eye, rotation)
 
-		self.shader_td.use()
-
-		self.shader_td.set_light_specular(0.0, 0.0, 0.0)
-		self.shader_td.set_material_specular(0.0, 0.0, 0.0)
-		self.shader_td.set_material_shininess(0)
-
-		self.shader_td.set_eye_position(self.td_camera.eye)
-		self.shader_td.set_light_position(self.td_camera.eye)
-
-		self.shader_td.set_light_diffuse(1.0, 1.0, 1.0)
-		self.shader_td.set_use_fog(False)
-
-		self.shader_td.set_player_health(100)
-		
 		self.projection_matrix.set_orthographic(self.td_left, self.td_right, self.td_bottom, self.td_top, self.near, self.far)
-		self.shader_td.set_projection_matrix(self.projection_matrix.get_matrix())
-
-		self.shader_td.set_view_matrix(self.td_camera.get_matrix())
+		self.td_uniforms.set_projection_matrix(self.projection_matrix.get_matrix())
+		self.td_uniforms.set_view_matrix(self.td_camera.get_matrix())
+		self.td_uniforms.set_eye_position(self.td_camera.eye)
+		self.td_uniforms.upload()
 
+		self.shader_td.use()
 		self.model_matrix.load_identity()
 
-		self.cube.set_vertices(self.shader_td)
-		self.shader_td.set_material_diffuse(0.1, 0.9, 0.1)
-		self.model_matrix.push_matrix()
-		self.model_matrix.add_translation(eye.x, 2.5, eye.z)
-		self.shader_td.set_model_matrix(self.model_matrix.matrix)
-		self.cube.draw()
-		self.model_matrix.pop_matrix()
-
-		# Draw the maze on the minimap
-		self.maze.draw()
+		# The maze layer rendered when the level was made
+		self.minimap_layer.draw(self.shader_td)
 
-		for b in self.bullet_list:
-			self.shader.set_material_diffuse(0.3, 0.3, 0.1)
-			self.draw_cube(b.x, 2.0, b.z, 0.3)
+		# The player, bullets and enemies as flat coloured cubes in one draw
+		bullet_positions = self.bullets.positions[:len(self.bullets)]
+		enemy_positions = self.enemy_batch.positions[[e.index for e in self.enemy_batch.get_visible(self.far)]]
+		positions = numpy.concatenate(([(eye.x, 2.5, eye.z)], bullet_positions, enemy_positions))
+		positions[1:len(bullet_positions) + 1, 1] = 2.0
+		positions[len(bullet_positions) + 1:, 1] = 1.0
+		scales = numpy.concatenate(([1.0], numpy.full(len(bullet_positions), 0.3), numpy.ones(len(enemy_positions))))
+		colors = numpy.concatenate(([(0.1, 0.9, 0.1)], numpy.tile((0.3, 0.3, 0.1), (len(bullet_positions), 1)), numpy.tile((0.9, 0.1, 0.1), (len(enemy_positions), 1))))
 
-		for e in self.enemies:
-			if self.check_enemy(e):
-				e.draw_minimap(self.shader_td)
+		self.shader_td.set_unlit(True)
+		self.shader_td.set_use_instance_color(True)
+		self.cube.draw_instanced(self.shader_td, build_model_matrices(positions, numpy.zeros(len(positions)), scales), colors=colors)
+		self.shader_td.set_use_instance_color(False)
+		self.shader_td.set_unlit(False)
 
 	def draw_first_person(self):
 		glViewport(0, 0, self.width, self.height)
@@ -501,27 +251,22 @@ class GraphicsProgram3D:
 		glClearColor(0, 0, 0, 1.0)
 		glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
 		
-		self.shader.use()
-		
 		self.projection_matrix.set_perspective(self.fov, self.aspect, self.near, self.far)
-		self.shader.set_projection_matrix(self.projection_matrix.get_matrix())
+		self.frustum.set_matrices(self.fp_camera.get_matrix(), self.projection_matrix.get_matrix())
+		self.fp_uniforms.set_projection_matrix(self.projection_matrix.get_matrix())
+		self.fp_uniforms.set_view_matrix(self.fp_camera.get_matrix())
+		self.fp_uniforms.set_eye_position(self.fp_camera.eye)
+		self.fp_uniforms.set_player_health(self.health)
+		self.fp_uniforms.upload()
 
-		self.shader.set_light_diffuse(1.0, 1.0, 1.0)
-		self.shader.set_light_specular(1.0, 1.0, 1.0)
-
-		self.shader.set_view_matrix(self.fp_camera.get_matrix())
-
-		self.shader.set_eye_position(self.fp_camera.eye)
+		self.shader.use()
 		self.shader.set_light_position(self.fp_camera.eye)
 
-		self.shader.set_use_fog(True)
-		self.shader.set_player_health(self.health)
-
 		### DRAW BULLETS ###
 		self.draw_bullets()
 
 		### DRAW MAZE ###
-		self.maze.draw(wall_texture=self.wall_texture, wall_normal=self.wall_normal_map, floor_texture=self.floor_texture, floor_normal=self.floor_normal_map)
+		self.maze.draw(wall_texture=self.wall_texture, wall_normal=self.wall_normal_map, floor_texture=self.floor_texture, floor_normal=self.floor_normal_map, frustum=self.frustum)
 		
 		### DRAW GUN ###
 		self.shader.set_light_position(Point(self.fp_camera.eye.x, 4, self.fp_camera.eye.z))
@@ -546,12 +291,7 @@ class GraphicsProgram3D:
 		self.model_matrix.pop_matrix()
 		
 		### DRAW ENEMIES ###
-		for e in self.enemies:
-			if self.check_enemy(e):
-				try:
-					e.draw(self.shader)
-				except:
-					print(e.obj)
+		draw_enemies(self.shader, self.enemy_batch.get_visible(self.far, self.maze, self.frustum), self.cube, 1 / tan(self.fov / 2))
 
 	def draw_ui(self):
 		border_width = 5
@@ -603,6 +343,9 @@ class GraphicsProgram3D:
 		self.draw_first_person()
 		self.draw_minimap()
 		self.draw_ui()
+
+		if self.profiler.enabled:
+			self.profiler.draw_overlay(self.width, self.height)
 		
 		pygame.display.flip()
 
@@ -629,6 +372,8 @@ class GraphicsProgram3D:
 						self.TAB_key_down = not self.TAB_key_down
 					if event.key == K_r:
 						self.R_key_down = True
+					if event.key == K_F3:
+						self.profiler.toggle()
 					### CHEATCODE FOR TESTING
 					# if event.key == K_SPACE:
 					# 	self.increase_difficulty()
@@ -645,10 +390,13 @@ class GraphicsProgram3D:
 					if event.key == K_r:
 						self.R_key_down = False
 			
+			self.profiler.begin_frame()
 			self.update()
 			self.draw()
+			self.profiler.end_frame()
 
 		#OUT OF GAME LOOP
+		self.profiler.disable()
 		pygame.quit()
 
 	def start(self):
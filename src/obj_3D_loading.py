@@ -1,4 +1,23 @@
 from Base3DObjects import *
+from LevelOfDetail import generate_lods
+
+import hashlib
+import json
+import os
+import struct
+
+# Compiled models are stored next to the .obj file as
+# <name>.obj.meshcache. The file starts with the magic, version and header
+# length, then a JSON header describing materials, meshes and the source
+# files it was built from, then the float32 vertex data and uint32 index
+# data (including any levels of detail, see LevelOfDetail.generate_lods)
+# starting at an aligned offset so they can be memory mapped and handed
+# straight to glBufferData
+MESH_CACHE_MAGIC = b"TGMC"
+MESH_CACHE_VERSION = 3
+MESH_CACHE_EXTENSION = ".meshcache"
+MESH_CACHE_PREFIX = struct.Struct("<4sII")
+MESH_CACHE_ALIGNMENT = 16
 
 def load_mtl_file(file_location, file_name, mesh_model):
     mtl = None
@@ -17,37 +36,261 @@ def load_mtl_file(file_location, file_name, mesh_model):
         elif tokens[0] == "Ns":
             mtl.shininess = float(tokens[1])
 
-def load_obj_file(file_location, file_name):
+def parse_floats(lines, width):
+    if len(lines) == 0:
+        return numpy.zeros((0, width), dtype="float32")
+    values = numpy.fromstring(" ".join(lines), dtype="float32", sep=" ")
+    return values.reshape(len(lines), -1)[:, :width]
+
+# Turns the face corners (v, v/vt, v//vn or v/vt/vn) into an (N, 3) array of
+# zero based position, uv and normal indices where -1 means missing. Groups
+# exported separately can use different formats, so faces are parsed in bulk
+# per format (v//vn is read as v/0/vn), and the rare face that mixes formats
+# between its own corners is parsed corner by corner
+def parse_face_corners(face_lines, position_count, uv_count, normal_count):
+    face_lines = [face.replace("//", "/0/") for face in face_lines]
+    face_sizes = numpy.array([len(face.split()) for face in face_lines])
+    field_counts = numpy.array([face.split(None, 1)[0].count("/") + 1 for face in face_lines])
+    slash_counts = numpy.array([face.count("/") for face in face_lines])
+    mixed = slash_counts != (field_counts - 1) * face_sizes
+    field_counts[mixed] = 0
+
+    corners = numpy.zeros((face_sizes.sum(), 3), dtype="int64")
+    corner_fields = numpy.repeat(field_counts, face_sizes)
+    for fields in numpy.unique(field_counts).tolist():
+        if fields == 0:
+            continue
+        lines = [face_lines[i] for i in numpy.flatnonzero(field_counts == fields).tolist()]
+        values = numpy.fromstring(" ".join(lines).replace("/", " "), dtype="int64", sep=" ").reshape(-1, fields)
+        corners[corner_fields == fields, :min(fields, 3)] = values[:, :3]
+
+    face_starts = numpy.cumsum(face_sizes) - face_sizes
+    for face in numpy.flatnonzero(mixed).tolist():
+        for i, corner in enumerate(face_lines[face].split()):
+            values = [int(value) for value in corner.split("/")[:3]]
+            corners[face_starts[face] + i, :len(values)] = values
+
+    # Negative indices count back from the end of each list
+    for column, count in enumerate((position_count, uv_count, normal_count)):
+        indices = corners[:, column]
+        indices[indices < 0] += count + 1
+    return corners - 1
+
+def parse_obj_file(file_location, file_name):
     mesh_model = MeshModel()
-    current_object_id = None
-    current_position_list = []
-    current_normal_list = []
+    mtl_files = []
+    mesh_indices = {None: 0}
+    current_mesh = 0
+    position_lines = []
+    uv_lines = []
+    normal_lines = []
+    face_lines = []
+    face_meshes = []
+
+    # Only sort the lines by type here, the numbers are all converted in bulk afterwards
     fin = open(file_location + "/" + file_name)
-    for line in fin.readlines():
-        tokens = line.split()
-        if len(tokens) == 0:
+    for line in fin.read().splitlines():
+        parts = line.split(None, 1)
+        if len(parts) < 2:
             continue
-        if tokens[0] == "mtllib":
-            load_mtl_file(file_location, tokens[1], mesh_model)
-        elif tokens[0] == "o":
-            current_object_id = tokens[1]
-        elif tokens[0] == "v":
-            current_position_list.append(Point(float(tokens[1]), float(tokens[2]), float(tokens[3])))
-        elif tokens[0] == "vn":
-            current_normal_list.append(Vector(float(tokens[1]), float(tokens[2]), float(tokens[3])))
-        elif tokens[0] == "usemtl":
-            mesh_model.set_mesh_material(current_object_id, tokens[1])
-        elif tokens[0] == "f":
-            for i in range(1, len(tokens)):
-                tokens[i] = tokens[i].split("/")
-            vertex_count = len(tokens) - 1
-            for i in range(vertex_count - 2):
-                if current_position_list == None:
-                    current_position_list = []
-                if current_normal_list == None:
-                    current_normal_list = []
-                mesh_model.add_vertex(current_object_id, current_position_list[int(tokens[1][0])-1], current_normal_list[int(tokens[1][2])-1])
-                mesh_model.add_vertex(current_object_id, current_position_list[int(tokens[i+2][0])-1], current_normal_list[int(tokens[i+2][2])-1])
-                mesh_model.add_vertex(current_object_id, current_position_list[int(tokens[i+3][0])-1], current_normal_list[int(tokens[i+3][2])-1])
-    mesh_model.set_opengl_buffers()
+        keyword, rest = parts
+        if keyword == "v":
+            position_lines.append(rest)
+        elif keyword == "vn":
+            normal_lines.append(rest)
+        elif keyword == "vt":
+            uv_lines.append(rest)
+        elif keyword == "f":
+            face_lines.append(rest)
+            face_meshes.append(current_mesh)
+        elif keyword == "o":
+            mesh_id = rest.split()[0]
+            current_mesh = mesh_indices.setdefault(mesh_id, len(mesh_indices))
+        elif keyword == "usemtl":
+            mesh_model.set_mesh_material(list(mesh_indices)[current_mesh], rest.split()[0])
+        elif keyword == "mtllib":
+            load_mtl_file(file_location, rest.split()[0], mesh_model)
+            mtl_files.append(rest.split()[0])
+    fin.close()
+
+    if len(face_lines) == 0:
+        return mesh_model, mtl_files
+
+    positions = parse_floats(position_lines, 3)
+    uvs = parse_floats(uv_lines, 2)
+    normals = parse_floats(normal_lines, 3)
+    corners = parse_face_corners(face_lines, len(positions), len(uvs), len(normals))
+
+    # Split every face into a fan of triangles (indices into corners)
+    face_sizes = numpy.array([len(face.split()) for face in face_lines])
+    triangle_counts = face_sizes - 2
+    face_starts = numpy.cumsum(face_sizes) - face_sizes
+    triangle_faces = numpy.repeat(numpy.arange(len(face_sizes)), triangle_counts)
+    fan_index = numpy.arange(len(triangle_faces)) - numpy.repeat(numpy.cumsum(triangle_counts) - triangle_counts, triangle_counts)
+    first_corner = face_starts[triangle_faces]
+    triangles = numpy.stack((first_corner, first_corner + fan_index + 1, first_corner + fan_index + 2), axis=1)
+
+    # Every distinct position/uv/normal combination becomes one vertex,
+    # kept in the order they first appear in the file
+    unique_corners, first_seen, corner_vertex = numpy.unique(corners, axis=0, return_index=True, return_inverse=True)
+    order = numpy.argsort(first_seen)
+    vertex_rank = numpy.empty_like(order)
+    vertex_rank[order] = numpy.arange(len(order))
+    unique_corners = unique_corners[order]
+    corner_vertex = vertex_rank[corner_vertex.reshape(-1)]
+
+    vertex_array = numpy.zeros((len(unique_corners), 8), dtype="float32")
+    vertex_array[:, 0:3] = positions[unique_corners[:, 0]]
+    if len(normals) > 0:
+        vertex_array[:, 3:6] = numpy.where(unique_corners[:, 2:3] >= 0, normals[unique_corners[:, 2]], 0.0)
+    if len(uvs) > 0:
+        vertex_array[:, 6:8] = numpy.where(unique_corners[:, 1:2] >= 0, uvs[unique_corners[:, 1]], 0.0)
+
+    # Group the triangles by mesh so each mesh is one range of the index buffer
+    triangle_meshes = numpy.array(face_meshes)[triangle_faces]
+    mesh_order = numpy.argsort(triangle_meshes, kind="stable")
+    index_array = corner_vertex[triangles[mesh_order]].reshape(-1).astype("uint32")
+    mesh_triangle_counts = numpy.bincount(triangle_meshes, minlength=len(mesh_indices))
+    mesh_offsets = numpy.cumsum(mesh_triangle_counts) - mesh_triangle_counts
+
+    mesh_model.set_mesh_data(vertex_array, index_array)
+    for mesh_id, mesh_index in mesh_indices.items():
+        mesh_model.add_mesh(mesh_id, int(mesh_offsets[mesh_index]) * 3, int(mesh_triangle_counts[mesh_index]) * 3)
+    return mesh_model, mtl_files
+
+def get_file_stamp(file_location, file_name):
+    path = file_location + "/" + file_name
+    stat = os.stat(path)
+    fin = open(path, "rb")
+    sha1 = hashlib.sha1(fin.read()).hexdigest()
+    fin.close()
+    return {"name": file_name, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha1": sha1}
+
+# A source file is unchanged if its modification time and size match, or
+# failing that (e.g. after a fresh checkout) if its contents hash the same
+def is_file_unchanged(file_location, stamp):
+    try:
+        stat = os.stat(file_location + "/" + stamp["name"])
+    except OSError:
+        return False
+    if stat.st_mtime_ns == stamp["mtime_ns"] and stat.st_size == stamp["size"]:
+        return True
+    if stat.st_size != stamp["size"]:
+        return False
+    return get_file_stamp(file_location, stamp["name"])["sha1"] == stamp["sha1"]
+
+def write_mesh_cache(cache_path, mesh_model, sources):
+    vertex_array = numpy.asarray(mesh_model.vertex_array, dtype="float32")
+    index_array = numpy.asarray(mesh_model.index_array, dtype="uint32")
+
+    meshes = []
+    for mesh_id in mesh_model.index_offsets.keys():
+        meshes.append({
+            "id": mesh_id,
+            "material": mesh_model.mesh_materials.get(mesh_id),
+            "index_offset": mesh_model.index_offsets[mesh_id],
+            "index_count": mesh_model.index_counts[mesh_id]
+        })
+
+    lods = []
+    for level in range(1, mesh_model.get_lod_count()):
+        lods.append([{"id": mesh_id, "index_offset": index_offset, "index_count": mesh_model.lod_index_counts[level][mesh_id]} for mesh_id, index_offset in mesh_model.lod_index_offsets[level].items()])
+
+    materials = dict()
+    for mat_id, mat in mesh_model.materials.items():
+        materials[mat_id] = {
+            "diffuse": [mat.diffuse.r, mat.diffuse.g, mat.diffuse.b],
+            "specular": [mat.specular.r, mat.specular.g, mat.specular.b],
+            "shininess": mat.shininess
+        }
+
+    header = json.dumps({
+        "sources": sources,
+        "materials": materials,
+        "meshes": meshes,
+        "lods": lods,
+        "vertex_count": len(vertex_array),
+        "index_count": len(index_array)
+    }).encode("utf-8")
+    data_offset = MESH_CACHE_PREFIX.size + len(header)
+    padding = -data_offset % MESH_CACHE_ALIGNMENT
+
+    # Written to a temporary file first so a half written cache is never read
+    try:
+        fout = open(cache_path + ".tmp", "wb")
+        fout.write(MESH_CACHE_PREFIX.pack(MESH_CACHE_MAGIC, MESH_CACHE_VERSION, len(header) + padding))
+        fout.write(header + b" " * padding)
+        fout.write(vertex_array.tobytes())
+        fout.write(index_array.tobytes())
+        fout.close()
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as error:
+        print("Couldn't write mesh cache " + cache_path + ": " + str(error))
+
+# Returns None if there is no usable cache for the model
+def read_mesh_cache(cache_path, file_location):
+    try:
+        fin = open(cache_path, "rb")
+    except OSError:
+        return None
+    prefix = fin.read(MESH_CACHE_PREFIX.size)
+    if len(prefix) != MESH_CACHE_PREFIX.size:
+        fin.close()
+        return None
+    magic, version, header_length = MESH_CACHE_PREFIX.unpack(prefix)
+    if magic != MESH_CACHE_MAGIC or version != MESH_CACHE_VERSION:
+        fin.close()
+        return None
+    header = json.loads(fin.read(header_length).decode("utf-8"))
+    fin.close()
+
+    for stamp in header["sources"]:
+        if not is_file_unchanged(file_location, stamp):
+            return None
+
+    mesh_model = MeshModel()
+    for mat_id, mat in header["materials"].items():
+        mesh_model.add_material(mat_id, Material(Color(*mat["diffuse"]), Color(*mat["specular"]), mat["shininess"]))
+
+    data_offset = MESH_CACHE_PREFIX.size + header_length
+    vertex_count = header["vertex_count"]
+    index_count = header["index_count"]
+    if vertex_count == 0:
+        return mesh_model
+    vertex_array = numpy.memmap(cache_path, dtype="float32", mode="r", offset=data_offset, shape=(vertex_count, 8))
+    index_array = numpy.memmap(cache_path, dtype="uint32", mode="r", offset=data_offset + vertex_array.nbytes, shape=(index_count,))
+    mesh_model.set_mesh_data(vertex_array, index_array)
+
+    for mesh in header["meshes"]:
+        mesh_model.add_mesh(mesh["id"], mesh["index_offset"], mesh["index_count"])
+        if mesh["material"] != None:
+            mesh_model.set_mesh_material(mesh["id"], mesh["material"])
+    for level, meshes in enumerate(header["lods"]):
+        for mesh in meshes:
+            mesh_model.add_mesh(mesh["id"], mesh["index_offset"], mesh["index_count"], level + 1)
+    return mesh_model
+
+# With upload=False no OpenGL calls are made, so the model can be loaded on
+# another thread and uploaded later with mesh_model.set_opengl_buffers().
+# lods=True adds the simplified levels, which only models drawn at many
+# distances need. A cache made without them is parsed again
+def load_obj_file(file_location, file_name, use_cache=True, upload=True, lods=False):
+    cache_path = file_location + "/" + file_name + MESH_CACHE_EXTENSION
+    mesh_model = None
+
+    if use_cache:
+        mesh_model = read_mesh_cache(cache_path, file_location)
+        if mesh_model != None and lods and mesh_model.get_lod_count() == 1:
+            mesh_model = None
+
+    if mesh_model == None:
+        mesh_model, mtl_files = parse_obj_file(file_location, file_name)
+        if lods:
+            generate_lods(mesh_model)
+        if use_cache:
+            sources = [get_file_stamp(file_location, name) for name in [file_name] + mtl_files]
+            write_mesh_cache(cache_path, mesh_model, sources)
+
+    if upload:
+        mesh_model.set_opengl_buffers()
     return mesh_model
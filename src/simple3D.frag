@@ -4,25 +4,35 @@ uniform bool u_use_normal_tex;
 uniform sampler2D u_diffuse_tex;
 uniform sampler2D u_normal_map_tex;
 
-uniform vec4 u_light_diffuse;
-uniform vec4 u_light_specular;
+// Per view state, shared with the vertex shader and filled by FrameUniforms
+layout(std140, row_major) uniform FrameData
+{
+	mat4 u_view_matrix;
+	mat4 u_projection_matrix;
+	vec4 u_eye_position;
+	vec4 u_light_diffuse;
+	vec4 u_light_specular;
+	float u_player_health;
+	bool u_use_fog;
+	float u_fog_min_dist;
+	float u_fog_max_dist;
+};
 
 uniform vec4 u_mat_diffuse;
 uniform vec4 u_mat_specular;
 
 uniform float u_shininess;
 
-uniform float u_player_health;
-
-uniform bool u_use_fog;
-uniform float u_fog_max_dist;
-uniform float u_fog_min_dist;
+// Flat colours for the minimap, optionally one per instance
+uniform bool u_unlit;
+uniform bool u_use_instance_color;
 
 varying vec4 v_normal;
 varying vec4 v_s;
 varying vec4 v_h;
 varying vec2 v_uv;
 varying vec4 v_position;
+varying vec4 v_instance_color;
 
 vec4 calculate_normal_texture()
 {
@@ -41,9 +51,18 @@ void main(void)
 {
 	vec4 mat_diffuse = u_mat_diffuse;
 	vec4 normal = v_normal;
+
+	if (u_use_instance_color)
+		mat_diffuse = v_instance_color;
 	
 	if (u_use_diffuse_tex)
-		mat_diffuse = u_mat_diffuse * texture2D(u_diffuse_tex, v_uv);
+		mat_diffuse = mat_diffuse * texture2D(u_diffuse_tex, v_uv);
+
+	if (u_unlit)
+	{
+		gl_FragColor = mat_diffuse;
+		return;
+	}
 	
 	if (u_use_normal_tex)
 		normal = calculate_normal_texture();
@@ -2,14 +2,30 @@
 attribute vec3 a_position;
 attribute vec3 a_normal;
 attribute vec2 a_uv;
+attribute mat4 a_instance_matrix;
+attribute float a_instance_health;
+attribute vec3 a_instance_color;
 
-uniform mat4 u_model_matrix;
-uniform mat4 u_view_matrix;
-uniform mat4 u_projection_matrix;
+// Per view state, shared with the fragment shader and filled by FrameUniforms
+layout(std140, row_major) uniform FrameData
+{
+	mat4 u_view_matrix;
+	mat4 u_projection_matrix;
+	vec4 u_eye_position;
+	vec4 u_light_diffuse;
+	vec4 u_light_specular;
+	float u_player_health;
+	bool u_use_fog;
+	float u_fog_min_dist;
+	float u_fog_max_dist;
+};
 
-uniform vec4 u_eye_position;
+uniform mat4 u_model_matrix;
 uniform vec4 u_light_position;
 
+uniform bool u_use_instancing;
+uniform bool u_health_bar;
+
 varying vec4 v_normal;
 varying vec4 v_s;
 varying vec4 v_h;
@@ -17,18 +33,30 @@ varying vec2 v_uv;
 varying vec4 v_frag_pos;
 varying vec4 v_cam_pos;
 varying vec4 v_position;
+varying vec4 v_instance_color;
 
 void main(void)
 {
 	// Send the UV coordinates to the fragment shader
 	v_uv = a_uv;
 	v_cam_pos = u_eye_position;
+	v_instance_color = vec4(a_instance_color, 1.0);
 
 	vec4 position = vec4(a_position.xyz, 1.0);
 	vec4 normal = vec4(a_normal.xyz, 0.0);
+	mat4 model_matrix = u_model_matrix;
+
+	if (u_use_instancing)
+	{
+		model_matrix = a_instance_matrix;
+
+		// Health bars shrink along their length with the health fraction
+		if (u_health_bar)
+			position.z *= a_instance_health;
+	}
 
-	position = u_model_matrix * position;
-	v_normal = normalize(u_model_matrix * normal);
+	position = model_matrix * position;
+	v_normal = normalize(model_matrix * normal);
 	
 	v_s = normalize(u_light_position - position);
 	v_frag_pos = position;